@@ -5,8 +5,12 @@ import sys
 
 sys.path.insert(0, join(dirname(realpath(sys.argv[0])), '..', 'src'))
 
-from toolshelf.toolshelf import main
-
 
 if __name__ == '__main__':
+    # if `toolshelf serve` is running, let it answer, if it will
+    from toolshelf.client import forward
+    status = forward(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+    from toolshelf.toolshelf import main
     main(sys.argv[1:])
@@ -28,12 +28,25 @@ export PKG_CONFIG_PATH="$TOOLSHELF/.pkgconfig:$PKG_CONFIG_PATH"
 export LUA_PATH="$TOOLSHELF/.lua/?.lua;$LUA_PATH"
 export LUA_CPATH="$TOOLSHELF/.lib/?.so;$LUA_CPATH"
 
+# `toolshelf cd` looks the spec up in the resolution table which toolshelf
+# keeps in `.toolshelf/resolve.sh`, and only runs toolshelf to resolve it if
+# it is not there.
+
 toolshelf() {
   if [ x$1 = xcd ]; then
     shift
-    DIR=`$TOOLSHELF/.toolshelf/bin/toolshelf.py --unique resolve $*`
-    if [ ! -z $DIR ]; then
-      cd $DIR
+    DIR=
+    if [ $# -eq 1 ] && [ -r "$TOOLSHELF/.toolshelf/resolve.sh" ]; then
+      . "$TOOLSHELF/.toolshelf/resolve.sh"
+      if [ -d "$TOOLSHELF_DIR" ]; then
+        DIR=$TOOLSHELF_DIR
+      fi
+    fi
+    if [ -z "$DIR" ]; then
+      DIR=`$TOOLSHELF/.toolshelf/bin/toolshelf.py --unique resolve $*`
+    fi
+    if [ ! -z "$DIR" ]; then
+      cd "$DIR"
     fi
   else
     $TOOLSHELF/.toolshelf/bin/toolshelf.py $*
@@ -0,0 +1,215 @@
+"""
+Caching the results of builds, so that a source which has been built
+before (at the same revision, with the same hints, on the same OS, in
+the same place) can have those results restored instead of being
+built again.
+
+A cached build is an archive of the files which the build created or
+changed in the source tree, found by comparing the tree before the
+build with the tree after it, along with a list of the files the build
+removed.  The cache is stored in `dirname`, with an index in
+`dirname/index.json`; when it grows larger than its maximum size, the
+least recently used builds are evicted.
+
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tarfile
+import time
+
+from toolshelf.toolshelf import makedirs, load_json
+
+
+def tree_state(dirname):
+    """Return a dict which maps the path (relative to `dirname`) of each
+    file, link and directory in the tree at `dirname` to a tuple which
+    changes when it is modified.  Version control directories are not
+    included.
+
+    """
+    state = {}
+    for root, dirs, files in os.walk(dirname):
+        for vcs_dir in ('.git', '.hg'):
+            if vcs_dir in dirs:
+                dirs.remove(vcs_dir)
+        for name in dirs + files:
+            filename = os.path.join(root, name)
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                value = ('dir',)
+            else:
+                value = (st.st_mode, st.st_size, st.st_mtime)
+            state[os.path.relpath(filename, dirname)] = value
+    return state
+
+
+class BuildCache(object):
+    def __init__(self, shelf, dirname, max_size):
+        self.shelf = shelf
+        self.dirname = dirname
+        self.max_size = max_size
+        self.index_filename = os.path.join(dirname, 'index.json')
+        self._index = None
+
+    ### index ###
+
+    @property
+    def index(self):
+        with self.shelf.lock:
+            if self._index is None:
+                self._index = {}
+                if os.path.exists(self.index_filename):
+                    with open(self.index_filename, 'r') as index_file:
+                        try:
+                            self._index = load_json(index_file)
+                        except ValueError as e:
+                            self.shelf.warn(
+                                "Ignoring corrupt build cache index %s: %s" %
+                                (self.index_filename, e)
+                            )
+        return self._index
+
+    def save_index(self):
+        makedirs(self.dirname)
+        temp_filename = self.index_filename + '.tmp'
+        with open(temp_filename, 'w') as index_file:
+            json.dump(self.index, index_file, indent=0, sort_keys=True)
+        os.rename(temp_filename, self.index_filename)
+
+    def key(self, source, stamp):
+        """Return the key of the cached build of the given source, with
+        the given build stamp (see `Source.build_stamp`.)  The source's
+        directory is part of the key, as builds often record absolute
+        paths to themselves.
+
+        """
+        return hashlib.sha1(stamp + '\0' + source.dir).hexdigest()
+
+    def archive_filename(self, key):
+        return os.path.join(self.dirname, key[:2], key + '.tar.gz')
+
+    def entries(self):
+        """Return a list of (key, entry) pairs for every cached build,
+        least recently used first.
+
+        """
+        with self.shelf.lock:
+            return sorted(self.index.iteritems(),
+                          key=lambda (key, entry): entry['used'])
+
+    def total_size(self):
+        with self.shelf.lock:
+            return sum([entry['size'] for entry in self.index.itervalues()])
+
+    ### storing and restoring builds ###
+
+    def snapshot(self, source):
+        """Return the state of the given source's tree, to be passed to
+        `store` once it has been built.
+
+        """
+        return tree_state(source.dir)
+
+    def store(self, source, key, before):
+        """Cache what building the given source changed in its tree,
+        given the state of its tree from before it was built.
+
+        """
+        after = tree_state(source.dir)
+        changed = sorted([
+            path for (path, value) in after.iteritems()
+            if before.get(path) != value
+        ])
+        removed = sorted([path for path in before if path not in after])
+        if not changed and not removed:
+            return
+        archive_filename = self.archive_filename(key)
+        makedirs(os.path.dirname(archive_filename))
+        temp_filename = archive_filename + '.tmp'
+        archive = tarfile.open(temp_filename, 'w:gz')
+        try:
+            for path in changed:
+                archive.add(os.path.join(source.dir, path), arcname=path,
+                            recursive=False)
+        finally:
+            archive.close()
+        os.rename(temp_filename, archive_filename)
+        now = time.time()
+        with self.shelf.lock:
+            self.index[key] = {
+                'source': source.name,
+                'size': os.path.getsize(archive_filename),
+                'files': len(changed),
+                'removed': removed,
+                'created': now,
+                'used': now,
+            }
+            self.shelf.note("Cached build of %s (%d files, %d bytes)" % (
+                source.name, len(changed), self.index[key]['size']
+            ))
+            self.prune(self.max_size)
+
+    def restore(self, source, key):
+        """Restore the cached build of the given source into its tree.
+        Returns False if there is no such cached build.
+
+        """
+        with self.shelf.lock:
+            entry = self.index.get(key)
+        archive_filename = self.archive_filename(key)
+        if entry is None or not os.path.exists(archive_filename):
+            return False
+        self.shelf.note("Restoring cached build of %s" % source.name)
+        archive = tarfile.open(archive_filename, 'r:gz')
+        try:
+            members = archive.getmembers()
+            archive.extractall(source.dir, members)
+        finally:
+            archive.close()
+        # restored files should be newer than the sources they came from,
+        # which were just checked out
+        for member in members:
+            if not member.issym():
+                os.utime(os.path.join(source.dir, member.name), None)
+        for path in entry['removed']:
+            filename = os.path.join(source.dir, path)
+            if os.path.isdir(filename) and not os.path.islink(filename):
+                shutil.rmtree(filename, ignore_errors=True)
+            elif os.path.lexists(filename):
+                os.unlink(filename)
+        with self.shelf.lock:
+            entry['used'] = time.time()
+            self.save_index()
+        return True
+
+    def remove(self, key):
+        with self.shelf.lock:
+            archive_filename = self.archive_filename(key)
+            if os.path.exists(archive_filename):
+                os.unlink(archive_filename)
+            self.index.pop(key, None)
+
+    def prune(self, max_size=0):
+        """Evict the least recently used builds until the cache is no
+        larger than `max_size` bytes.  Returns the number evicted.
+
+        """
+        count = 0
+        with self.shelf.lock:
+            total_size = self.total_size()
+            for (key, entry) in self.entries():
+                if total_size <= max_size:
+                    break
+                self.shelf.note("Evicting cached build of %s" %
+                                entry['source'])
+                self.remove(key)
+                total_size -= entry['size']
+                count += 1
+            self.save_index()
+        return count
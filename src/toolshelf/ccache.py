@@ -0,0 +1,80 @@
+"""
+Running the C and C++ compilers of builds through `ccache`, with one
+cache, in `.toolshelf/ccache`, shared by every source, so that
+rebuilding a source after pulling only recompiles what has changed.
+
+Each build gets its own ccache log file, from which the number of
+compilations which hit and missed the cache while building that source
+are counted afterwards.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import tempfile
+
+from toolshelf.toolshelf import makedirs
+
+
+# ccache 3 logs 'cache hit (direct)'; ccache 4 logs 'direct_cache_hit'
+RESULT_RE = re.compile(r'Result: (.*?)\s*$')
+HIT_RESULTS = (
+    'cache hit (direct)', 'cache hit (preprocessed)',
+    'direct_cache_hit', 'preprocessed_cache_hit',
+)
+MISS_RESULTS = ('cache miss', 'cache_miss')
+
+
+class CompilerCache(object):
+    def __init__(self, shelf, dirname, executable):
+        self.shelf = shelf
+        self.dirname = dirname
+        self.executable = executable
+
+    def wrap(self, compiler):
+        if compiler.split()[0] in ('ccache', self.executable):
+            return compiler
+        return '%s %s' % (self.executable, compiler)
+
+    def environ(self, environ):
+        """Return a copy of the given environment in which `CC` and `CXX`
+        run the compiler through ccache, and the name of the log file
+        ccache will log the build's compilations to.
+
+        """
+        makedirs(self.dirname)
+        (fd, log_filename) = tempfile.mkstemp(
+            prefix='build-', suffix='.log', dir=self.dirname
+        )
+        os.close(fd)
+        environ = dict(environ)
+        # an empty (or blank) CC or CXX is taken to be unset
+        environ['CC'] = self.wrap(environ.get('CC', '').strip() or 'cc')
+        environ['CXX'] = self.wrap(environ.get('CXX', '').strip() or 'c++')
+        environ['CCACHE_DIR'] = self.dirname
+        # lets sources docked in different places share cached objects
+        environ['CCACHE_BASEDIR'] = self.shelf.dir
+        environ['CCACHE_LOGFILE'] = log_filename
+        return (environ, log_filename)
+
+    def stats(self, log_filename):
+        """Return a tuple of the numbers of cache hits and misses logged
+        in the given log file, and remove the log file.
+
+        """
+        hits = misses = 0
+        try:
+            with open(log_filename, 'r') as log_file:
+                for line in log_file:
+                    match = RESULT_RE.search(line)
+                    if not match:
+                        continue
+                    if match.group(1) in HIT_RESULTS:
+                        hits += 1
+                    elif match.group(1) in MISS_RESULTS:
+                        misses += 1
+        finally:
+            os.unlink(log_filename)
+        return (hits, misses)
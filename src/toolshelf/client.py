@@ -0,0 +1,81 @@
+"""
+The client side of `toolshelf serve`: handing a toolshelf command line
+to the daemon serving `$TOOLSHELF`, if there is one, and passing on
+what it outputs.
+
+This is imported by `bin/toolshelf.py` before anything else in
+toolshelf is, so it should stay small.
+
+Requests and responses are sent over the daemon's Unix socket in the
+same framing as the Mercurial command server uses (see
+`toolshelf.hgserver`): a one-byte channel, a four-byte big-endian
+length, and that many bytes of data.  The request is the working
+directory followed by the arguments, separated by NULs; the response is
+any number of 'o' (standard output) and 'e' (standard error) messages,
+followed by an 'r' message with the exit status, unless it is a single
+'f' message, meaning that the command should be run without the daemon.
+
+"""
+
+import os
+import socket
+import struct
+import sys
+
+
+def socket_filename(directory):
+    return os.path.join(directory, '.toolshelf', 'serve.sock')
+
+
+def write_message(f, channel, data):
+    f.write(struct.pack('>cI', channel, len(data)) + data)
+    f.flush()
+
+
+def read_message(f):
+    header = f.read(5)
+    if len(header) < 5:
+        return (None, None)
+    (channel, length) = struct.unpack('>cI', header)
+    return (channel, f.read(length))
+
+
+def forward(args):
+    """Have the daemon serving `$TOOLSHELF` run toolshelf with the given
+    arguments.  Returns its exit status, or None if there is no daemon
+    or it would not run the command.
+
+    """
+    directory = os.environ.get('TOOLSHELF')
+    if not directory:
+        return None
+    filename = socket_filename(directory)
+    if not os.path.exists(filename):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(filename)
+    except socket.error:
+        # a daemon which is no longer running
+        sock.close()
+        return None
+    try:
+        f = sock.makefile('rwb', 0)
+        write_message(f, 'q', '\0'.join([os.getcwd()] + list(args)))
+        outputs = {'o': sys.stdout, 'e': sys.stderr}
+        while True:
+            (channel, data) = read_message(f)
+            if channel in outputs:
+                outputs[channel].write(data)
+            elif channel == 'r':
+                return struct.unpack('>i', data)[0]
+            elif channel == 'f':
+                return None
+            else:
+                break
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+    sys.stderr.write("toolshelf: lost connection to daemon\n")
+    return 1
@@ -0,0 +1,70 @@
+"""
+The toolshelf commands, one module per command.
+
+`DESCRIPTIONS` maps the name of each command to the first line of its
+module's docstring, so that the commands can be found and listed
+without importing (or even looking for) all of their modules.  When
+adding a command, add it here too.
+
+"""
+
+DESCRIPTIONS = {
+    'bbuser': "Dump a catalog for all of a Bitbucket user's repositories.",
+    'build': "Build (or re-build) the executables for the specified "
+             "docked sources.",
+    'buildcache': "Show the builds in the build cache.",
+    'checkfarms': "Check the link manifest against the link farms, "
+                  "and repair it.",
+    'chrometrace': "Convert a trace written with --trace to Chrome's trace "
+                   "event format.",
+    'cleanfarms': "Remove broken links from link farms.",
+    'collectdocs': "Find documentation files and write out Yaml file "
+                   "summarizing them.",
+    'disable': "Temporarily remove links to executables and libraries "
+               "in specified sources.",
+    'enable': "Restore any previously disabled links for the given sources.",
+    'export': "Clones a copy of each of the docked sources to the output "
+              "directory.",
+    'ghstars': "Dump a catalog for all of a Github user's starred "
+               "repositories.",
+    'ghuser': "Dump a catalog for all of a Github user's repositories.",
+    'hgrcify': "Update config of Mercurial sources to include username.",
+    'latesttag': "Echo the latest tag in a docked source.",
+    'lint': "Check that the layouts of given sources conform to some "
+            "guidelines.",
+    'log': "Show the revision log of a docked source.",
+    'outgoing': "Crudely reports docked sources that have changes not in "
+                "the upstream repo.",
+    'prunecache': "Remove builds from the build cache.",
+    'pull': "Pull latest revision of specified sources from each's "
+            "upstream repository.",
+    'pullalt': "Pull updates from an alternative toolshelf.",
+    'pullgh': "Pull updates from a Github git mirror of a Mercurial "
+              "repository.",
+    'push': "Push changes from specified sources to each's upstream "
+            "repository.",
+    'pushalt': "Push updates to an alternative toolshelf.",
+    'pushgh': "Push updates to a Github git mirror of a Mercurial "
+              "repository.",
+    'rectify': "Traverse sources and set executable permissions "
+               "'reasonably' on all files.",
+    'release': "Create a release distfile from the latest tag in a docked "
+               "source.",
+    'relink': "Update link farms to contain links to executables and "
+              "libraries in sources.",
+    'remove': "Delete the specified source trees and relink all remaining "
+              "docked sources.",
+    'resolve': "Emit the names of the directories of the docked sources.",
+    'serve': "Answer read-only commands (resolve, which, show) from a "
+             "daemon.",
+    'show': "Display links made in links farms from the specified sources.",
+    'status': "Show `hg st` or `git status` as appropriate for specified "
+              "sources.",
+    'survey': "Generate report summarizing various properties of the "
+              "specified sources.",
+    'test': "Look for test suites in docked sources and run them.",
+    'tether': "Obtain external source trees (repos or distfiles, from "
+              "internet or filesystem).",
+    'which': "Display locations within sources where executable or "
+             "library is found.",
+}
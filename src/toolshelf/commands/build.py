@@ -10,5 +10,14 @@ class Command(BaseCommand):
     def show_progress(self):  # only if quiet
         return False
 
+    def builds_sources(self):
+        return True
+
     def perform(self, shelf, source):
         source.build()
+        if source.compiler_cache_stats is not None:
+            (hits, misses) = source.compiler_cache_stats
+            with shelf.lock:
+                print "%s: %d compilations, %d from ccache" % (
+                    source.name, hits + misses, hits
+                )
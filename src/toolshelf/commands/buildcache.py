@@ -0,0 +1,30 @@
+"""
+Show the builds in the build cache.
+
+buildcache
+
+Lists each cached build, least recently used first, with the source it
+is a build of, its size, and when it was last used or restored.
+"""
+
+import time
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        build_cache = shelf.build_cache
+        if build_cache is None:
+            print "The build cache is disabled; give --build-cache-size."
+            return []
+        for (key, entry) in build_cache.entries():
+            print "%s  %-40s %8d KB  %s" % (
+                key[:12], entry['source'], entry['size'] / 1024,
+                time.strftime('%Y-%m-%d %H:%M',
+                              time.localtime(entry['used']))
+            )
+        print "%d cached builds, %d KB (of at most %d KB)" % (
+            len(build_cache.entries()), build_cache.total_size() / 1024,
+            build_cache.max_size / 1024
+        )
+        return []
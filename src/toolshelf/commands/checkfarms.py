@@ -0,0 +1,20 @@
+"""
+Check the link manifest against the link farms, and repair it.
+
+checkfarms
+
+The link manifest records which links in the link farms belong to
+which docked source.  This reads every link farm directory, reports
+any links which the manifest has wrong, and rebuilds the manifest
+from what was found.
+"""
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        differences = shelf.link_manifest.verify()
+        for difference in differences:
+            print difference
+        shelf.note("%d differences found and repaired." % len(differences))
+        return []
@@ -0,0 +1,33 @@
+"""
+Convert a trace written with --trace to Chrome's trace event format.
+
+chrometrace <trace-file> [<output-file>]
+
+Writes the events recorded in the trace file (one JSON object per line)
+as a single JSON object in the Trace Event Format, to the output file
+(by default, the trace file's name with `.json` added,) which can be
+loaded into Chrome's about:tracing, Perfetto or speedscope to see the
+phases and subprocesses of each thread laid out as a flame graph.
+"""
+
+import json
+
+from toolshelf.toolshelf import BaseCommand, CommandLineSyntaxError
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        from toolshelf.trace import read_events, chrome_trace
+        if len(args) not in (1, 2):
+            raise CommandLineSyntaxError(
+                "Usage: chrometrace <trace-file> [<output-file>]"
+            )
+        filename = args[0]
+        output_filename = args[1] if len(args) > 1 else filename + '.json'
+        with open(filename) as f:
+            trace = chrome_trace(read_events(f))
+        with open(output_filename, 'w') as f:
+            json.dump(trace, f)
+        shelf.note("Wrote %d trace events to %s" % (
+            len(trace['traceEvents']), output_filename
+        ))
+        return []
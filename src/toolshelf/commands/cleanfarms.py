@@ -9,11 +9,11 @@ from toolshelf.toolshelf import BaseCommand
 class Command(BaseCommand):
     def process_args(self, shelf, args):
         for (name, farm) in shelf.link_farms.iteritems():
-            for (linkname, sourcename) in farm.links():
+            for (linkname, sourcename) in list(farm.links()):
                 if not os.path.exists(sourcename):
                     shelf.note(
                         '`%s` does not exist, deleting `%s`...' %
                         (sourcename, linkname)
                     )
-                    os.unlink(linkname)
+                    farm.remove_link(linkname)
         return []
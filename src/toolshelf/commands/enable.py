@@ -10,6 +10,9 @@ The sources will be removed from the persistent blacklist.
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         shelf.blacklist.remove(source)
         source.relink()
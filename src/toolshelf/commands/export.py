@@ -7,6 +7,9 @@ import os
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         dest_dir = os.path.join(shelf.options.output_dir, source.name)
         if os.path.isdir(dest_dir):
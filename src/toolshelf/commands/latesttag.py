@@ -14,5 +14,8 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         print source.get_latest_release_tag()
@@ -31,17 +31,18 @@ class Command(BaseCommand):
 
     def perform(self, shelf, source):
         prob = []
-        if not os.path.exists('README.markdown'):
+        exists = lambda name: os.path.exists(os.path.join(source.dir, name))
+        if not exists('README.markdown'):
             prob.append("No README.markdown")
-        if not os.path.exists('LICENSE') and not os.path.exists('UNLICENSE'):
+        if not exists('LICENSE') and not exists('UNLICENSE'):
             prob.append("No LICENSE or UNLICENSE")
-        if os.path.exists('LICENSE') and os.path.exists('UNLICENSE'):
+        if exists('LICENSE') and exists('UNLICENSE'):
             prob.append("Both LICENSE and UNLICENSE")
-        for root, dirnames, filenames in os.walk('.'):
+        for root, dirnames, filenames in os.walk(source.dir):
             if root.endswith(".hg"):
                 del dirnames[:]
                 continue
-            if root == '.':
+            if root == source.dir:
                 root_files = []
                 for filename in filenames:
                     if filename not in OK_ROOT_FILES:
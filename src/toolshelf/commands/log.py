@@ -14,6 +14,9 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         shelf.chdir(source.dir)
         if os.path.isdir(os.path.join(source.dir, '.hg')):
@@ -6,6 +6,9 @@ Crudely reports docked sources that have changes not in the upstream repo.
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         print source.name
         shelf.run('hg', 'out')
@@ -0,0 +1,24 @@
+"""
+Remove builds from the build cache.
+
+prunecache [<size-in-MB>]
+
+With no argument, removes every cached build.  Otherwise, removes the
+least recently used builds until the cache is no larger than the given
+size.
+"""
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        build_cache = shelf.build_cache
+        if build_cache is None:
+            print "The build cache is disabled; give --build-cache-size."
+            return []
+        max_size = 0
+        if args:
+            max_size = int(args[0]) * 1024 * 1024
+        count = build_cache.prune(max_size)
+        shelf.note("%d cached builds removed." % count)
+        return []
@@ -4,17 +4,45 @@ Pull latest revision of specified sources from each's upstream repository.
 Upstream repo is always the external source from which
 it was originally docked.  Does not work on distfile-based sources.
 
+Before anything is pulled, the upstream repos of all the sources are
+probed (concurrently) to see which of them have changed, and only those
+sources are pulled.  The sources which changed are listed afterwards.
+
 pull {<docked-source-spec>}
 
 """
 
-# TODO: figure out how to propogate was_changed to a subsequent 'build'
+# A subsequent 'build' (as in 'update') skips sources whose head ref has
+# not changed, by way of their build stamps; see Source.build.
 
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def stage(self):
+        return 'network'
+
     def show_progress(self):
         return False
 
+    def process_args(self, shelf, specs):
+        sources = BaseCommand.process_args(self, shelf, specs)
+        from toolshelf.probe import UpstreamProber
+        UpstreamProber(shelf).run(sources)
+        return sources
+
+    def setup(self, shelf):
+        self.changed = []
+
     def perform(self, shelf, source):
-        source.update()
+        if source.upstream_changed is False:
+            shelf.note("%s is unchanged upstream, not pulling" % source.name)
+            return
+        if source.update():
+            with shelf.lock:
+                self.changed.append(source.name)
+
+    def teardown(self, shelf):
+        if self.changed:
+            print "Changed upstream:"
+            for name in sorted(self.changed):
+                print "  %s" % name
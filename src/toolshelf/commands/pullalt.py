@@ -12,6 +12,9 @@ import os
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def stage(self):
+        return 'network'
+
     def show_progress(self):
         return False
 
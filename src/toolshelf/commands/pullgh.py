@@ -9,6 +9,9 @@ that the name of the repository on Github is the same as the project name
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def stage(self):
+        return 'network'
+
     def show_progress(self):
         return False
 
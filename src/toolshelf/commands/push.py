@@ -16,11 +16,14 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         shelf.chdir(source.dir)
-        if os.path.isdir('.git'):
+        if os.path.isdir(os.path.join(source.dir, '.git')):
             shelf.run('git', 'push', 'origin')
-        elif os.path.isdir('.hg'):
+        elif os.path.isdir(os.path.join(source.dir, '.hg')):
             shelf.run('hg', 'push', '-r', 'tip')
             # TODO: if the output contains 'no changes found',
             # a failure-exit code is to be expected
@@ -15,18 +15,21 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         alt_toolshelf = os.getenv('ALT_TOOLSHELF', None)
         assert alt_toolshelf is not None
         upstream = os.path.join(alt_toolshelf, source.name)
 
-        if os.path.isdir('.git'):
+        if os.path.isdir(os.path.join(source.dir, '.git')):
             # can't push directly to another git repo in the filesystem, b/c
             # "updating the current branch in a non-bare repository is denied",
             # so we cd there and pull from the main one instead.
             shelf.chdir(upstream)
             shelf.run('git', 'pull', source.dir, 'master')
-        elif os.path.isdir('.hg'):
+        elif os.path.isdir(os.path.join(source.dir, '.hg')):
             shelf.chdir(source.dir)
             shelf.run('hg', 'push', upstream)                
         else:
@@ -12,6 +12,9 @@ class Command(BaseCommand):
     def show_progress(self):
         return False
 
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         shelf.run('hg', 'bookmark', '-f', '-r', 'tip', 'master')
         url = "git+ssh://git@github.com/%s/%s.git" % (source.user, source.project)
@@ -52,6 +52,9 @@ class Command(BaseCommand):
     source tree.
 
     """
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         tag = source.tag
         if not tag:
@@ -7,5 +7,8 @@ Update link farms to contain links to executables and libraries in sources.
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def concurrent(self):
+        return False
+
     def perform(self, shelf, source):
         source.relink()
@@ -7,6 +7,8 @@ from toolshelf.toolshelf import BaseCommand
 class Command(BaseCommand):
     def perform(self, shelf, source):
         shelf.run('rm', '-rf', source.dir)
+        shelf.docked_index.discard(source)
+        shelf.build_stamps.discard(source)
 
     def trigger_relink(self, shelf):
         return ['all']
@@ -0,0 +1,20 @@
+"""
+Answer read-only commands (resolve, which, show) from a daemon.
+
+serve
+
+Runs until interrupted, listening on `$TOOLSHELF/.toolshelf/serve.sock`.
+While it is running, `toolshelf` hands those commands to it, instead of
+loading everything it needs to answer them itself.
+"""
+
+from toolshelf.toolshelf import BaseCommand
+
+class Command(BaseCommand):
+    def process_args(self, shelf, args):
+        from toolshelf.server import ShelfServer
+        try:
+            ShelfServer(shelf).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return []
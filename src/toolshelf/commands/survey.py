@@ -8,6 +8,9 @@ Sort of a "deep status".
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def concurrent(self):
+        return False
+
     def setup(self, shelf):
         self.repos = {}
 
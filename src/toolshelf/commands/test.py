@@ -5,19 +5,17 @@ Look for test suites in docked sources and run them.
 import os
 import subprocess
 import sys
+import time
 
 from toolshelf.toolshelf import BaseCommand, Path
 
 class Command(BaseCommand):
     def setup(self, shelf):
-        self.sources = 0
         self.no_tests = []
         self.passes = []
         self.fails = []
 
     def perform(self, shelf, source):
-        self.sources += 1
-
         test_requires = source.hints.get('test_requires', '')
         if test_requires:
             search_path = Path()
@@ -32,14 +30,21 @@ class Command(BaseCommand):
             if os.path.exists(os.path.join(source.dir, 'test.sh')):
                 test_command = './test.sh'
         if test_command:
+            started = time.time()
             process = subprocess.Popen(
-                test_command, shell=True,
+                test_command, shell=True, cwd=shelf.getcwd(),
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
             (std_output, std_error) = process.communicate()
+            if shelf.tracer is not None:
+                shelf.tracer.subprocess(
+                    test_command, shelf.getcwd(), started, process.returncode,
+                    len(std_output), len(std_error)
+                )
             if shelf.options.verbose:
-                sys.stdout.write(std_output)
-                sys.stdout.write(std_error)
+                with shelf.lock:
+                    sys.stdout.write(std_output)
+                    sys.stdout.write(std_error)
             if process.returncode == 0:
                 self.passes.append(source)
             else:
@@ -48,7 +53,8 @@ class Command(BaseCommand):
             self.no_tests.append(source)
 
     def teardown(self, shelf):
-        print "Total docked sources tested:      %s" % self.sources
+        sources = len(self.no_tests) + len(self.passes) + len(self.fails)
+        print "Total docked sources tested:      %s" % sources
         print "Total without discoverable tests: %s" % len(self.no_tests)
         if shelf.options.verbose:
             print '(%s)' % ' '.join([s.name for s in self.no_tests])
@@ -7,6 +7,9 @@ Obtain external source trees (repos or distfiles, from internet or filesystem).
 from toolshelf.toolshelf import BaseCommand
 
 class Command(BaseCommand):
+    def stage(self):
+        return 'network'
+
     def show_progress(self):
         return False
 
@@ -21,4 +24,5 @@ class Command(BaseCommand):
                 print "%s already docked." % source.name
         else:
             source.checkout()
+            shelf.docked_index.add(source)
             source.rectify_permissions_if_needed()
@@ -0,0 +1,314 @@
+"""
+Downloading distfiles, and caching them by their contents.
+
+A `Downloader` fetches files over HTTP and HTTPS itself, keeping idle
+connections open so that several files from the same host share one
+connection, and resuming partial downloads with `Range` requests.
+(Other schemes, such as FTP, are handed to `urllib2`.)
+
+A `DistfileCache` stores each distfile under the SHA-256 of its contents,
+with an index from URLs to those checksums, so that a distfile is only
+ever downloaded once, no matter how many times (or under how many
+names) it is tethered.
+
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import httplib
+import os
+import re
+import shutil
+import socket
+import threading
+import urllib2
+import urlparse
+
+from toolshelf.toolshelf import makedirs
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+CONTENT_RANGE_RE = re.compile(r'^\s*bytes\s+(\d+)-\d+/(\d+|\*)\s*$', re.I)
+
+
+class DownloadError(IOError):
+    pass
+
+
+def content_range_start(response):
+    """Return the first byte position given in the Content-Range header
+    of the given response, or None if it has none (that we understand.)
+
+    """
+    match = CONTENT_RANGE_RE.match(response.getheader('Content-Range', ''))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ConnectionPool(object):
+    """Idle keep-alive HTTP(S) connections, by scheme, host and port.
+
+    """
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, netloc):
+        """Return a tuple of an idle connection to the given host (or a
+        new one, if there are none) and whether it was re-used.
+
+        """
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return (connections.pop(), True)
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return (connection, False)
+
+    def put(self, scheme, netloc, connection):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.itervalues():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
+class Downloader(object):
+    def __init__(self, shelf, pool=None):
+        self.shelf = shelf
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def download(self, url, filename):
+        """Download the given URL to the given filename.
+
+        The file is first written to `filename + '.part'`; if that
+        already exists (because an earlier download was interrupted,)
+        only the rest of the file is requested.
+
+        """
+        partial = filename + '.part'
+        self.shelf.note("Downloading `%s`..." % url)
+        for redirect in xrange(MAX_REDIRECTS):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                self._download_with_urllib(url, partial)
+                break
+            location = self._download_http(parts, partial)
+            if location is None:
+                break
+            url = urlparse.urljoin(url, location)
+            self.shelf.debug("Redirected to `%s`" % url)
+        else:
+            raise DownloadError("Too many redirects fetching %s" % url)
+        os.rename(partial, filename)
+        return filename
+
+    def _request(self, parts, headers):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        while True:
+            (connection, reused) = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers=headers)
+                return (connection, connection.getresponse())
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # the server may have closed an idle connection on us
+                if not reused:
+                    raise
+
+    def _download_http(self, parts, partial):
+        """Fetch (the rest of) the file into `partial`.  Returns the
+        location to redirect to, if the server asked for a redirect.
+
+        """
+        offset = 0
+        if os.path.exists(partial):
+            offset = os.path.getsize(partial)
+        headers = {
+            'User-Agent': 'toolshelf',
+            'Accept-Encoding': 'identity',
+        }
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        (connection, response) = self._request(parts, headers)
+        try:
+            if response.status in REDIRECT_STATUSES:
+                response.read()
+                return response.getheader('Location')
+            if response.status == 416 and offset:
+                # our partial file is no good; start over
+                response.read()
+                os.unlink(partial)
+                return urlparse.urlunsplit(parts)
+            if response.status == 206 and offset:
+                start = content_range_start(response)
+                if start == offset:
+                    self.shelf.debug("Resuming download at byte %d" % offset)
+                    mode = 'ab'
+                elif start == 0:
+                    mode = 'wb'
+                else:
+                    # not the range we asked for; start over
+                    connection.close()
+                    os.unlink(partial)
+                    return urlparse.urlunsplit(parts)
+            elif response.status == 200:
+                mode = 'wb'
+            else:
+                raise DownloadError("%s: HTTP %d %s" % (
+                    urlparse.urlunsplit(parts), response.status,
+                    response.reason
+                ))
+            with open(partial, mode) as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(parts.scheme, parts.netloc, connection)
+        return None
+
+    def _download_with_urllib(self, url, partial):
+        response = urllib2.urlopen(url)
+        try:
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(response, f, CHUNK_SIZE)
+        finally:
+            response.close()
+
+    def close(self):
+        self.pool.close_all()
+
+
+class DistfileCache(object):
+    """Distfiles, stored in `dirname/sha256/` under the SHA-256 of their
+    contents, with an index in `dirname/urls/` which maps (the SHA-1 of)
+    each URL to the SHA-256 of what was downloaded from it.
+
+    """
+    def __init__(self, shelf, dirname, downloader=None):
+        self.shelf = shelf
+        self.dirname = dirname
+        if downloader is None:
+            downloader = Downloader(shelf)
+        self.downloader = downloader
+        self.lock = threading.Lock()
+        self.url_locks = {}
+
+    def _url_key(self, url):
+        return hashlib.sha1(url).hexdigest()
+
+    def _url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def content_path(self, checksum):
+        return os.path.join(self.dirname, 'sha256', checksum[:2], checksum)
+
+    def lookup(self, url, checksum=None):
+        """Return the filename of the cached distfile for the given URL
+        (and, if given, with the given checksum,) or None if it has not
+        been fetched.
+
+        """
+        if checksum is None:
+            index_filename = os.path.join(
+                self.dirname, 'urls', self._url_key(url)
+            )
+            if not os.path.exists(index_filename):
+                return None
+            with open(index_filename, 'r') as f:
+                checksum = f.read().strip()
+        filename = self.content_path(checksum)
+        if not os.path.exists(filename):
+            return None
+        return filename
+
+    def add(self, url, filename, checksum=None):
+        """Move the given file into the cache as the distfile for the
+        given URL, and return its new filename.  If a checksum is given
+        and the file does not match it, DownloadError is raised.
+
+        """
+        actual = file_sha256(filename)
+        if checksum is not None and actual != checksum:
+            os.unlink(filename)
+            raise DownloadError("%s: expected SHA-256 %s, got %s" %
+                                (url, checksum, actual))
+        content_filename = self.content_path(actual)
+        makedirs(os.path.dirname(content_filename))
+        os.rename(filename, content_filename)
+        index_dirname = os.path.join(self.dirname, 'urls')
+        makedirs(index_dirname)
+        index_filename = os.path.join(index_dirname, self._url_key(url))
+        with open(index_filename + '.tmp', 'w') as f:
+            f.write(actual + '\n')
+        os.rename(index_filename + '.tmp', index_filename)
+        return content_filename
+
+    def adopt(self, url, filename, checksum=None):
+        """Add a copy of the given file (which is left where it is) to
+        the cache as the distfile for the given URL, as `add` does, and
+        return the copy's filename.
+
+        """
+        with self._url_lock(url):
+            adopted_dirname = os.path.join(self.dirname, 'adopted')
+            makedirs(adopted_dirname)
+            copy = os.path.join(adopted_dirname, self._url_key(url))
+            if os.path.exists(copy):
+                os.unlink(copy)
+            try:
+                os.link(filename, copy)
+            except OSError:
+                shutil.copyfile(filename, copy)
+            return self.add(url, copy, checksum=checksum)
+
+    def fetch(self, url, checksum=None):
+        """Return the filename of the cached distfile for the given URL,
+        downloading it first if it is not already cached.
+
+        """
+        with self._url_lock(url):
+            filename = self.lookup(url, checksum=checksum)
+            if filename is not None:
+                self.shelf.note("Using cached distfile for `%s`" % url)
+                return filename
+            partial_dirname = os.path.join(self.dirname, 'partial')
+            makedirs(partial_dirname)
+            filename = os.path.join(partial_dirname, self._url_key(url))
+            self.downloader.download(url, filename)
+            return self.add(url, filename, checksum=checksum)
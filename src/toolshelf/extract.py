@@ -0,0 +1,291 @@
+"""
+Extracting distfiles directly into the directory of a docked source.
+
+Each member of the archive is streamed straight to its final location.
+Whether the archive is well-structured (all files in one top-level
+directory, which is stripped off) or a "tarbomb" (files in the root
+of the archive) is decided as the members go by, and if an archive
+which looked well-structured turns out to be a tarbomb, what has been
+extracted so far is moved down a level, with a single rename.
+
+As GNU tar does, symbolic links are only made once everything else has
+been extracted, so that no member can be written through one, and links
+which point outside of the directory are refused.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import time
+import zipfile
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from toolshelf.toolshelf import makedirs, looks_executable
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class Extraction(object):
+    """Maps the names of archive members to filenames under `dest_dir`,
+    stripping the top-level directory for as long as every member has
+    been in it.
+
+    """
+    def __init__(self, shelf, dest_dir):
+        self.shelf = shelf
+        self.dest_dir = dest_dir
+        self.prefix = None  # top-level dir being stripped; '' if tarbomb
+        self.count = 0
+        self.symlinks = []  # (name, linkname) of each one still to make
+        makedirs(dest_dir)
+
+    def components(self, name):
+        components = [c for c in name.split('/') if c not in ('', '.')]
+        if name.startswith('/') or '..' in components:
+            raise ValueError("Refusing to extract unsafe archive member %r" %
+                             name)
+        return components
+
+    def target(self, name, is_dir=False):
+        """Return the filename to extract the named member to, or None
+        if it is the top-level directory itself.
+
+        """
+        components = self.components(name)
+        if not components:
+            return None
+        if self.prefix is None:
+            if len(components) == 1 and not is_dir:
+                self.prefix = ''
+            else:
+                self.prefix = components[0]
+        if self.prefix:
+            if components[0] != self.prefix or (len(components) == 1 and
+                                                not is_dir):
+                self.unstrip()
+            else:
+                components = components[1:]
+        if not components:
+            return None
+        return os.path.join(self.dest_dir, *components)
+
+    def link_target(self, name):
+        """Return the filename which the named member was extracted to,
+        for making links to it.
+
+        """
+        components = self.components(name)
+        if self.prefix and components and components[0] == self.prefix:
+            components = components[1:]
+        return os.path.join(self.dest_dir, *components)
+
+    def add_symlink(self, name, linkname):
+        """Make a note to make the named member, a symbolic link, once
+        everything else has been extracted.
+
+        """
+        self.symlinks.append((name, linkname))
+
+    def check_parents(self, filename):
+        """Raise ValueError if any directory between `dest_dir` and the
+        given filename is a symbolic link.
+
+        """
+        dirname = os.path.dirname(filename)
+        while dirname != self.dest_dir and dirname.startswith(self.dest_dir):
+            if os.path.islink(dirname):
+                raise ValueError("Refusing to extract `%s` through a "
+                                 "symbolic link" % filename)
+            dirname = os.path.dirname(dirname)
+
+    def make_symlinks(self):
+        dest_dir = os.path.join(self.dest_dir, '')
+        for (name, linkname) in self.symlinks:
+            filename = self.link_target(name)
+            resolved = os.path.normpath(
+                os.path.join(os.path.dirname(filename), linkname)
+            )
+            if (os.path.isabs(linkname) or
+                not (resolved + os.sep).startswith(dest_dir)):
+                raise ValueError("Refusing to extract symbolic link %r "
+                                 "pointing outside of the archive (to %r)" %
+                                 (name, linkname))
+            self.check_parents(filename)
+            if os.path.lexists(filename):
+                if os.path.isdir(filename) and not os.path.islink(filename):
+                    raise ValueError("Refusing to replace directory `%s` "
+                                     "with a symbolic link" % filename)
+                os.unlink(filename)
+            makedirs(os.path.dirname(filename))
+            os.symlink(linkname, filename)
+
+    def unstrip(self):
+        self.shelf.debug("Archive is not all in `%s` after all" % self.prefix)
+        temp_dir = self.dest_dir + '.extract'
+        os.rename(self.dest_dir, temp_dir)
+        makedirs(self.dest_dir)
+        os.rename(temp_dir, os.path.join(self.dest_dir, self.prefix))
+        self.prefix = ''
+
+    def finish(self):
+        if self.prefix:
+            self.shelf.note("Archive is well-structured "
+                            "(all files in one directory)")
+        else:
+            self.shelf.note("Archive is a 'tarbomb' "
+                            "(all files in the root of the archive)")
+        self.shelf.note("Extracted %d files into `%s`" %
+                        (self.count, self.dest_dir))
+
+    def write(self, filename, fileobj, mode, mtime):
+        makedirs(os.path.dirname(filename))
+        if os.path.lexists(filename):
+            os.unlink(filename)
+        with open(filename, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+        os.chmod(filename, mode)
+        os.utime(filename, (mtime, mtime))
+        self.count += 1
+
+
+def rectify_mode(filename, mode):
+    """Return the given mode, with the owner-executable bit set if and
+    only if the file looks executable.
+
+    """
+    if looks_executable(filename):
+        return mode | stat.S_IXUSR
+    return mode & ~stat.S_IXUSR
+
+
+def open_tarfile(filename, type):
+    """Return a tuple of a streaming TarFile for the given distfile, and
+    the decompressing process feeding it, if any.
+
+    """
+    if type in ('tgz', 'tar.gz'):
+        return (tarfile.open(filename, 'r|gz'), None)
+    if type == 'tar.bz2':
+        return (tarfile.open(filename, 'r|bz2'), None)
+    if type == 'tar.xz':
+        if lzma is not None:
+            return (tarfile.open(fileobj=lzma.LZMAFile(filename), mode='r|'),
+                    None)
+        process = subprocess.Popen(['xz', '-d', '-c', filename],
+                                   stdout=subprocess.PIPE)
+        return (tarfile.open(fileobj=process.stdout, mode='r|'), process)
+    raise NotImplementedError(type)
+
+
+def extract_tarfile(shelf, extraction, filename, type, rectify=None):
+    umask = get_umask()
+    started = time.time()
+    (tar, process) = open_tarfile(filename, type)
+    try:
+        for member in tar:
+            target = extraction.target(member.name, is_dir=member.isdir())
+            if target is None:
+                continue
+            if member.isdir():
+                makedirs(target)
+            elif member.isfile():
+                mode = member.mode & 0777 & ~umask
+                extraction.write(target, tar.extractfile(member),
+                                 mode, member.mtime)
+                if rectify is not None and rectify(target):
+                    os.chmod(target, rectify_mode(target, mode))
+            elif member.issym():
+                extraction.add_symlink(member.name, member.linkname)
+            elif member.islnk():
+                makedirs(os.path.dirname(target))
+                os.link(extraction.link_target(member.linkname), target)
+            else:
+                shelf.debug("Skipping special file %s" % member.name)
+    finally:
+        tar.close()
+        if process is not None:
+            process.stdout.close()
+            process.wait()
+            if shelf.tracer is not None:
+                # what xz output was read by tarfile, and not counted
+                shelf.tracer.subprocess(
+                    ['xz', '-d', '-c', filename], shelf.getcwd(), started,
+                    process.returncode
+                )
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, 'xz')
+
+
+def extract_zipfile(shelf, extraction, filename, rectify=None):
+    umask = get_umask()
+    archive = zipfile.ZipFile(filename)
+    try:
+        for info in archive.infolist():
+            is_dir = info.filename.endswith('/')
+            target = extraction.target(info.filename, is_dir=is_dir)
+            if target is None:
+                continue
+            if is_dir:
+                makedirs(target)
+                continue
+            unix_mode = 0
+            if info.create_system == 3:  # created on Unix
+                unix_mode = info.external_attr >> 16
+            if stat.S_ISLNK(unix_mode):
+                extraction.add_symlink(info.filename, archive.read(info))
+                continue
+            mode = (unix_mode & 0777 or 0666) & ~umask
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            member = archive.open(info)
+            try:
+                extraction.write(target, member, mode, mtime)
+            finally:
+                member.close()
+            if rectify is not None and rectify(target):
+                os.chmod(target, rectify_mode(target, mode))
+    finally:
+        archive.close()
+
+
+def extract_distfile(shelf, filename, type, dest_dir, rectify=None):
+    """Extract the given distfile, of the given type, into `dest_dir`,
+    which should not yet exist.  If extraction fails, `dest_dir` is
+    removed again.
+
+    If `rectify` is given, it is called with the filename of each
+    extracted file; if it returns True, the file's owner-executable bit
+    is set according to whether it looks executable.
+
+    """
+    shelf.note("Extracting `%s` into `%s`..." % (filename, dest_dir))
+    extraction = Extraction(shelf, dest_dir)
+    try:
+        if type == 'zip':
+            extract_zipfile(shelf, extraction, filename, rectify=rectify)
+        else:
+            extract_tarfile(shelf, extraction, filename, type,
+                            rectify=rectify)
+        extraction.make_symlinks()
+    except:
+        shutil.rmtree(dest_dir, ignore_errors=True)
+        raise
+    extraction.finish()
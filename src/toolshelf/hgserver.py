@@ -0,0 +1,152 @@
+"""
+Running Mercurial commands through `hg serve --cmdserver pipe` (the
+Mercurial command server) instead of starting a new `hg` for each one,
+so that Mercurial's start-up is paid once per working directory rather
+than once per command.
+
+Servers are started as they are needed, one for each working directory
+that commands are run in (a server cannot change its directory,) and
+are kept for re-use, up to `max_idle` of them at once.  A server exits
+as soon as its input is closed, which at the latest is when toolshelf
+exits.
+
+Only commands which only look at the local repository, and never ask
+for input, are run through a server; everything else (and everything,
+if the command server cannot be started) is run as it always was.
+
+"""
+
+from __future__ import absolute_import
+
+import struct
+import subprocess
+
+
+# subcommands which only read the local repository and never prompt
+LOCAL_COMMANDS = set([
+    'status', 'st', 'diff', 'log', 'tags', 'tip', 'heads', 'parents',
+    'branch', 'branches', 'paths', 'archive', 'cat', 'manifest',
+])
+
+
+class CommandServerError(Exception):
+    pass
+
+
+class CommandServer(object):
+    """One `hg serve --cmdserver pipe` process, running in `cwd`."""
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self.process = subprocess.Popen(
+            ['hg', 'serve', '--cmdserver', 'pipe'], cwd=cwd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True
+        )
+        (channel, hello) = self.read_channel()
+        if channel != 'o' or 'runcommand' not in hello.split('\n')[0]:
+            self.close()
+            raise CommandServerError("unexpected greeting %r" % hello)
+
+    def read_channel(self):
+        header = self.process.stdout.read(5)
+        if len(header) < 5:
+            raise CommandServerError("command server went away")
+        (channel, length) = struct.unpack('>cI', header)
+        if channel in 'IL':
+            # input requests give the most that may be sent, not data
+            return (channel, length)
+        return (channel, self.process.stdout.read(length))
+
+    def runcommand(self, args):
+        """Run `hg` with the given arguments (not including `hg` itself.)
+        Returns a tuple of its exit code, and what it wrote to standard
+        output and to standard error.
+
+        """
+        data = '\0'.join(args)
+        self.process.stdin.write('runcommand\n' +
+                                 struct.pack('>I', len(data)) + data)
+        self.process.stdin.flush()
+        output = {'o': [], 'e': []}
+        while True:
+            (channel, data) = self.read_channel()
+            if channel in output:
+                output[channel].append(data)
+            elif channel == 'r':
+                return (struct.unpack('>i', data)[0],
+                        ''.join(output['o']), ''.join(output['e']))
+            elif channel in 'IL':
+                # LOCAL_COMMANDS shouldn't ask; answer with end-of-file
+                self.process.stdin.write(struct.pack('>I', 0))
+                self.process.stdin.flush()
+            elif channel.isupper():
+                raise CommandServerError("unknown channel %r" % channel)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+
+class CommandServerPool(object):
+    def __init__(self, shelf, max_idle=4):
+        self.shelf = shelf
+        self.max_idle = max_idle
+        self.idle = []  # least recently used first
+        self.available = True
+
+    def routable(self, args, kwargs={}):
+        """Return True if `hg` with the given arguments (not including
+        `hg` itself,) given to `Toolshelf.run` with the given keyword
+        arguments, can be run through a command server.
+
+        """
+        if not self.available or not args:
+            return False
+        if set(kwargs) - set(['cwd', 'ignore_exit_code']):
+            return False
+        return args[0] in LOCAL_COMMANDS
+
+    def acquire(self, cwd):
+        with self.shelf.lock:
+            for server in reversed(self.idle):
+                if server.cwd == cwd:
+                    self.idle.remove(server)
+                    return server
+        try:
+            return CommandServer(cwd)
+        except (OSError, CommandServerError) as e:
+            self.shelf.debug("Can't start hg command server (%s); "
+                             "running hg directly" % e)
+            self.available = False
+            return None
+
+    def release(self, server):
+        with self.shelf.lock:
+            self.idle.append(server)
+            evicted = self.idle[:-self.max_idle]
+            self.idle = self.idle[-self.max_idle:]
+        for server in evicted:
+            server.close()
+
+    def run(self, args, cwd):
+        """Run `hg` with the given arguments in `cwd` through a command
+        server, as `CommandServer.runcommand` does.  Returns None if it
+        could not be run through a command server (in which case it
+        should be run directly.)
+
+        """
+        server = self.acquire(cwd)
+        if server is None:
+            return None
+        try:
+            result = server.runcommand(args)
+        except (IOError, CommandServerError) as e:
+            self.shelf.debug("hg command server failed running `hg %s` "
+                             "(%s); running hg directly" % (' '.join(args), e))
+            server.close()
+            return None
+        self.release(server)
+        return result
@@ -0,0 +1,82 @@
+"""
+A GNU make jobserver shared by every build toolshelf runs.
+
+The jobserver is a pipe holding one token (byte) per job slot.  Every
+`make` started by a build (directly, or from a `build_command` or build
+script) finds the pipe through `MAKEFLAGS`, and takes a token from it
+for every job it runs beyond its first.  That first job is covered by
+the token the build itself holds while it runs (see `slot`), so the
+number of jobs running across all concurrent builds never exceeds the
+number of slots.
+
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import re
+import select
+from contextlib import contextmanager
+
+
+class JobServer(object):
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        (self.read_fd, self.write_fd) = os.pipe()
+        os.write(self.write_fd, '+' * self.slots)
+
+    def acquire(self):
+        while True:
+            try:
+                token = os.read(self.read_fd, 1)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                # make 4.3 and later make the pipe non-blocking, and the
+                # pipe is shared with us, so wait for a token to arrive
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    select.select([self.read_fd], [], [])
+                    continue
+                raise
+            if token:
+                return token
+
+    def release(self, token):
+        os.write(self.write_fd, token)
+
+    @contextmanager
+    def slot(self):
+        """Hold a job slot for the duration of the `with` block."""
+        token = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def makeflags(self, makeflags=''):
+        """Return the given MAKEFLAGS, with any -j option replaced by
+        the options which make `make` use this jobserver.
+
+        """
+        flags = [
+            flag for flag in makeflags.split()
+            if not re.match(r'^(-j\d*|--jobs(=\d*)?|--jobserver-\w+=.*)$',
+                            flag)
+        ]
+        # make 4.2 calls this --jobserver-auth, but still accepts this
+        flags += ['-j', '--jobserver-fds=%d,%d' %
+                  (self.read_fd, self.write_fd)]
+        return ' ' + ' '.join(flags)
+
+    def environ(self, environ=None):
+        """Return a copy of the given environment (by default, that of
+        this process) which directs `make` to use this jobserver.
+
+        """
+        if environ is None:
+            environ = os.environ
+        environ = dict(environ)
+        environ['MAKEFLAGS'] = self.makeflags(environ.get('MAKEFLAGS', ''))
+        environ.pop('MFLAGS', None)
+        return environ
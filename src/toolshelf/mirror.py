@@ -0,0 +1,97 @@
+"""
+Local mirrors of the git and Mercurial repositories which sources are
+cloned from, so that re-tethering a source, or updating it, mostly
+reads from local disk instead of the network.
+
+Each mirror is a bare repository (a git repository with no working
+tree, or a Mercurial repository with no working directory) stored in
+`dirname/git/` or `dirname/hg/` under the SHA-1 of the URL it mirrors.
+A mirror is brought up to date from its URL before it is used.
+
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import threading
+
+from toolshelf.toolshelf import makedirs
+
+
+class MirrorStore(object):
+    def __init__(self, shelf, dirname):
+        self.shelf = shelf
+        self.dirname = dirname
+        self.lock = threading.Lock()
+        self.url_locks = {}
+
+    def _url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+    def mirror_dir(self, type, url):
+        return os.path.join(self.dirname, type, hashlib.sha1(url).hexdigest())
+
+    def refresh(self, type, url):
+        """Create or update the mirror of the given URL, and return the
+        directory it is in.
+
+        """
+        mirror_dir = self.mirror_dir(type, url)
+        with self._url_lock(url):
+            if os.path.isdir(mirror_dir):
+                self.shelf.note("Refreshing mirror of `%s`..." % url)
+                if type == 'git':
+                    self.shelf.run('git', '--git-dir', mirror_dir,
+                                   'fetch', '--prune', '--tags', 'origin')
+                else:
+                    self.shelf.run('hg', '-R', mirror_dir, 'pull')
+                return mirror_dir
+            self.shelf.note("Creating mirror of `%s`..." % url)
+            makedirs(os.path.dirname(mirror_dir))
+            try:
+                if type == 'git':
+                    self.shelf.run('git', 'clone', '--bare', url, mirror_dir)
+                    self.shelf.run('git', '--git-dir', mirror_dir, 'config',
+                                   'remote.origin.fetch',
+                                   '+refs/heads/*:refs/heads/*')
+                else:
+                    self.shelf.run('hg', 'clone', '-U', url, mirror_dir)
+            except:
+                shutil.rmtree(mirror_dir, ignore_errors=True)
+                raise
+            return mirror_dir
+
+    def clone(self, type, url, dest_dir, *args):
+        """Clone the given URL into `dest_dir`, by way of its mirror,
+        passing any further arguments on to `clone`.  The clone does not
+        depend on the mirror afterwards, and its default remote is the
+        URL itself, not the mirror.
+
+        """
+        mirror_dir = self.refresh(type, url)
+        if type == 'git':
+            self.shelf.run('git', 'clone', '--reference', mirror_dir,
+                           '--dissociate', *(list(args) + [url, dest_dir]))
+        else:
+            # a local clone hard-links the store files where it can
+            self.shelf.run('hg', 'clone', *(list(args) +
+                                            [mirror_dir, dest_dir]))
+            with open(os.path.join(dest_dir, '.hg', 'hgrc'), 'w') as f:
+                f.write('[paths]\ndefault = %s\n' % url)
+
+    def prefetch(self, type, url, dest_dir):
+        """Refresh the mirror of the given URL, and fetch what is new in
+        it into the clone in `dest_dir`, so that pulling from the URL
+        afterwards has little or nothing left to download.
+
+        """
+        mirror_dir = self.refresh(type, url)
+        if type == 'git':
+            self.shelf.run('git', 'fetch', '--tags', mirror_dir,
+                           '+refs/heads/*:refs/remotes/origin/*',
+                           cwd=dest_dir)
+        else:
+            self.shelf.run('hg', 'pull', mirror_dir, cwd=dest_dir)
@@ -0,0 +1,225 @@
+"""
+Running a sequence of commands (such as `tether+build+relink`) over many
+Sources as a pipeline of stages, so that one Source can be building
+while the next is being fetched and the one before is being relinked.
+
+Consecutive commands in the same stage (see `BaseCommand.stage`) are
+grouped into one stage.  Each stage has its own worker threads (just
+one, for a 'serial' stage) and a bounded queue of Sources waiting for
+it, and each Source moves on to the next stage as soon as it is done
+with the current one.  A Source for which a command fails does not go
+on to the next stage.
+
+If any of the commands builds Sources, Sources are held back before the
+first stage which builds them until every Source they require (see
+`BuildScheduler`) has made it all the way through the pipeline.
+
+"""
+
+from __future__ import absolute_import
+
+import Queue
+import sys
+import threading
+
+from toolshelf.schedule import BuildScheduler
+
+
+class Stage(object):
+    def __init__(self, name, commands, jobs):
+        self.name = name
+        self.commands = commands
+        self.jobs = jobs
+        self.queue = Queue.Queue(maxsize=jobs)
+        self.workers_left = jobs
+
+
+def make_stages(commands, jobs):
+    stages = []
+    for command in commands:
+        name = command.stage()
+        if stages and stages[-1].name == name:
+            stages[-1].commands.append(command)
+        else:
+            stages.append(Stage(name, [command], 1 if name == 'serial'
+                                                  else jobs))
+    return stages
+
+
+class Pipeline(object):
+    def __init__(self, shelf, commands, jobs):
+        self.shelf = shelf
+        self.stages = make_stages(commands, jobs)
+        self.lock = threading.Lock()
+        # commands which are not concurrent still see one Source at a
+        # time, even when they are in different stages
+        self.serial_lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.failure = None
+        self.scheduler = None
+        self.gate = None
+        self.events = Queue.Queue()
+
+    def run(self, sources, progress=lambda x: x):
+        sources = list(sources)
+        for (n, stage) in enumerate(self.stages):
+            if any(command.builds_sources() for command in stage.commands):
+                self.scheduler = BuildScheduler(self.shelf, sources)
+                self.gate = n
+                break
+
+        threads = []
+        for (n, stage) in enumerate(self.stages):
+            for i in xrange(stage.jobs):
+                threads.append(threading.Thread(target=self._work, args=(n,)))
+        if self.scheduler is not None:
+            threads.append(threading.Thread(target=self._dispatch,
+                                            args=(sources,)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for source in progress(sources):
+                if self.cancelled.is_set():
+                    break
+                self._forward(-1, source)
+        finally:
+            if self.gate != 0:
+                for i in xrange(self.stages[0].jobs):
+                    self.stages[0].queue.put(None)
+            elif self.cancelled.is_set():
+                self.events.put(('cancelled', None))
+            try:
+                for thread in threads:
+                    # join with a timeout so that KeyboardInterrupt gets
+                    # through
+                    while thread.is_alive():
+                        thread.join(0.1)
+            except KeyboardInterrupt:
+                self.cancelled.set()
+                raise
+        if self.failure is not None:
+            (exc_type, exc_value, exc_tb) = self.failure
+            raise exc_type, exc_value, exc_tb
+
+    def _forward(self, n, source):
+        """Pass the Source, which is done with stage `n`, to the next
+        stage (by way of the dispatcher, if that is the gate.)
+
+        """
+        if n + 1 == self.gate:
+            self.events.put(('arrived', source))
+        elif n + 1 < len(self.stages):
+            self.stages[n + 1].queue.put(source)
+        else:
+            self._finish(source)
+
+    def _finish(self, source):
+        """Note that the Source has left the pipeline."""
+        if self.scheduler is None:
+            return
+        if self.scheduler.required_by[source] and source.docked and \
+           not self.cancelled.is_set():
+            # make its executables available to what requires it
+            source.relink()
+        self.events.put(('finished', source))
+
+    def _perform(self, stage, source):
+        """Perform the stage's commands on the Source.  Returns True if
+        they all succeeded.
+
+        """
+        succeeded = []
+        def perform(source):
+            for command in stage.commands:
+                if command.concurrent():
+                    command.traced_perform(self.shelf, source)
+                else:
+                    with self.serial_lock:
+                        command.traced_perform(self.shelf, source)
+            succeeded.append(source)
+        self.shelf.perform_on_source(source, perform)
+        return bool(succeeded)
+
+    def _work(self, n):
+        stage = self.stages[n]
+        while True:
+            source = stage.queue.get()
+            if source is None:
+                break
+            if self.cancelled.is_set():
+                self._finish(source)
+                continue
+            try:
+                succeeded = self._perform(stage, source)
+            except Exception:
+                with self.lock:
+                    if self.failure is None:
+                        self.failure = sys.exc_info()
+                self.cancelled.set()
+                self.events.put(('cancelled', None))
+                succeeded = False
+            if succeeded:
+                self._forward(n, source)
+            else:
+                self._finish(source)
+        with self.lock:
+            stage.workers_left -= 1
+            last = (stage.workers_left == 0)
+        if last and n + 1 < len(self.stages) and n + 1 != self.gate:
+            for i in xrange(self.stages[n + 1].jobs):
+                self.stages[n + 1].queue.put(None)
+
+    def _dispatch(self, sources):
+        """Pass Sources on to the gate stage once everything they
+        require has left the pipeline, in the order they were given.
+
+        """
+        scheduler = self.scheduler
+        gate = self.stages[self.gate]
+        state = dict((source, 'upstream') for source in sources)
+        waiting = dict(
+            (source, set(required)) for (source, required)
+            in scheduler.requires.iteritems()
+        )
+        ready = []
+        counts = {'upstream': len(sources), 'arrived': 0, 'released': 0}
+
+        def set_state(source, new_state):
+            counts[state[source]] = counts.get(state[source], 0) - 1
+            state[source] = new_state
+            counts[new_state] = counts.get(new_state, 0) + 1
+
+        while not self.cancelled.is_set():
+            for source in sorted(ready, key=scheduler.position.get):
+                set_state(source, 'released')
+                gate.queue.put(source)
+            ready = []
+            if not (counts['upstream'] or counts['arrived']):
+                break
+            if counts['arrived'] and not (counts['upstream'] or
+                                          counts['released']):
+                # everything left is waiting on something else left
+                source = min([s for s in sources if state[s] == 'arrived'],
+                             key=scheduler.position.get)
+                self.shelf.warn("Dependency cycle involving %s; "
+                                "building it anyway" % source.name)
+                waiting[source] = set()
+                ready.append(source)
+                continue
+            (event, source) = self.events.get()
+            if event == 'arrived':
+                set_state(source, 'arrived')
+                if not waiting[source]:
+                    ready.append(source)
+            elif event == 'finished':
+                set_state(source, 'finished')
+                for dependent in scheduler.required_by[source]:
+                    waiting[dependent].discard(source)
+                    if not waiting[dependent] and \
+                       state[dependent] == 'arrived' and \
+                       dependent not in ready:
+                        ready.append(dependent)
+        for i in xrange(gate.jobs):
+            gate.queue.put(None)
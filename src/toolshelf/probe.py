@@ -0,0 +1,67 @@
+"""
+Probing the upstream repositories of many Sources at once, to find out
+which of them have moved on since they were last pulled, before pulling
+any of them (see `Source.probe_upstream`.)
+
+A probe is a single `git ls-remote` or `hg identify`, which is much
+cheaper than the fetch negotiation of a pull, but is still mostly spent
+waiting on the network, so many probes are run concurrently; but no
+more than `per_host` of them against any one host at once.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import threading
+
+from toolshelf.toolshelf import WorkerPool
+
+
+# most of a probe is spent waiting on the network, so this many are run
+# at once whatever the --jobs option is
+PROBE_JOBS = 16
+PROBES_PER_HOST = 4
+
+
+class UpstreamProber(object):
+    def __init__(self, shelf, jobs=PROBE_JOBS, per_host=PROBES_PER_HOST):
+        self.shelf = shelf
+        self.jobs = jobs
+        self.per_host = per_host
+        self.host_slots = {}
+
+    def host_slot(self, host):
+        with self.shelf.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.per_host)
+            return self.host_slots[host]
+
+    def probe(self, source):
+        if not os.path.isdir(source.dir):
+            return
+        with self.host_slot(source.host):
+            try:
+                changed = source.probe_upstream()
+            except Exception as e:
+                # a failed probe only means the source gets pulled
+                self.shelf.warn("Could not probe upstream of %s: %s" %
+                                (source.name, e))
+                changed = None
+        source.upstream_changed = changed
+        if changed is False:
+            self.shelf.note("Upstream of %s is unchanged" % source.name)
+
+    def run(self, sources):
+        """Probe the upstreams of all of the given Sources, setting the
+        `upstream_changed` attribute of each.
+
+        """
+        pool = WorkerPool(min(self.jobs, len(sources)))
+        try:
+            for source in sources:
+                if not pool.submit(self.shelf.perform_on_source, source,
+                                   self.probe):
+                    break
+        finally:
+            pool.join()
@@ -0,0 +1,184 @@
+"""
+Profiling toolshelf itself, for the --profile and --profile-memory options.
+
+With --profile, the command is run under cProfile, and afterwards a
+report of the functions which took the most time (including the time
+taken by the functions they called) is written to standard error, and
+the full profile is dumped to `toolshelf.pstats` in the --output-dir,
+for browsing with `python -m pstats` (or snakeviz, gprof2dot, etc.)
+
+A cProfile profiler only sees the thread it was enabled in, so each
+Source is profiled separately as it is processed (in whichever thread
+it is processed in,) and the profiles are added together at the end.
+This also gives the profile of each Source, which --profile-sources
+reports on as well.
+
+Python 2 has no tracemalloc, so --profile-memory reports what can be
+had without it: how much the process's peak resident set size grew, and
+how many more objects the garbage collector is tracking afterwards (in
+all, and by type,) over the whole command, and for each Source.  When
+Sources are processed concurrently, what is attributed to each Source
+includes whatever the other Sources did at the same time.
+
+"""
+
+from __future__ import absolute_import
+
+import cProfile
+import gc
+import os
+import pstats
+import resource
+import sys
+import threading
+
+
+REPORT_LINES = 25
+SOURCE_REPORT_LINES = 10
+PSTATS_FILENAME = 'toolshelf.pstats'
+
+
+def max_rss():
+    """Return the peak resident set size of this process, in kilobytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def object_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class Profiler(object):
+    def __init__(self, shelf, cpu=True, memory=False, by_source=False):
+        self.shelf = shelf
+        self.cpu = cpu
+        self.memory = memory
+        self.by_source = by_source
+        self.lock = threading.Lock()
+        # the profiler enabled in each thread, if any
+        self.local = threading.local()
+        self.stats = None
+        self.source_stats = {}
+        self.memory_usage = {}
+
+    def _merge(self, profile, key):
+        stats = pstats.Stats(profile)
+        with self.lock:
+            if self.stats is None:
+                self.stats = stats
+            else:
+                self.stats.add(stats)
+            if key is not None and self.by_source:
+                if key in self.source_stats:
+                    self.source_stats[key].add(profile)
+                else:
+                    self.source_stats[key] = pstats.Stats(profile)
+
+    def _profile(self, key, fun, args):
+        # only one profiler can be enabled in a thread, so the one for
+        # the whole command is suspended while each Source is profiled
+        outer = getattr(self.local, 'profile', None)
+        if outer is not None:
+            outer.disable()
+        profile = cProfile.Profile()
+        self.local.profile = profile
+        profile.enable()
+        try:
+            return fun(*args)
+        finally:
+            profile.disable()
+            self.local.profile = outer
+            self._merge(profile, key)
+            if outer is not None:
+                outer.enable()
+
+    def call(self, key, fun, *args):
+        """Call `fun` with the given arguments, profiling it as the
+        Source named `key` (or the command as a whole, if `key` is None.)
+
+        """
+        if self.memory:
+            (rss, objects) = (max_rss(), len(gc.get_objects()))
+        try:
+            if self.cpu:
+                return self._profile(key, fun, args)
+            return fun(*args)
+        finally:
+            if self.memory and key is not None:
+                with self.lock:
+                    (old_rss, old_objects) = self.memory_usage.get(key, (0, 0))
+                    self.memory_usage[key] = (
+                        old_rss + max_rss() - rss,
+                        old_objects + len(gc.get_objects()) - objects
+                    )
+
+    def run(self, fun, *args):
+        """Call `fun` with the given arguments, profiling it as a whole,
+        and return what it returns.
+
+        """
+        if self.memory:
+            gc.collect()
+            self.initial_rss = max_rss()
+            self.initial_counts = object_counts()
+        return self.call(None, fun, *args)
+
+    def report(self, out=sys.stderr):
+        """Write the reports to `out`, and dump the profile."""
+        if self.cpu and self.stats is not None:
+            self.report_cpu(out)
+        if self.memory:
+            self.report_memory(out)
+
+    def report_cpu(self, out):
+        filename = os.path.join(self.shelf.options.output_dir,
+                                PSTATS_FILENAME)
+        self.stats.dump_stats(filename)
+        self.stats.stream = out
+        out.write("\nPROFILE (by cumulative time):\n")
+        self.stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        if self.by_source:
+            sources = sorted(self.source_stats.iteritems(),
+                             key=lambda item: -item[1].total_tt)
+            out.write("PROFILE BY SOURCE:\n\n")
+            for (name, stats) in sources:
+                out.write("%8.3fs  %s\n" % (stats.total_tt, name))
+            for (name, stats) in sources:
+                out.write("\n%s:\n" % name)
+                stats.stream = out
+                stats.sort_stats('cumulative').print_stats(SOURCE_REPORT_LINES)
+        out.write("Profile written to %s\n" % filename)
+
+    def report_memory(self, out):
+        gc.collect()
+        counts = object_counts()
+        growth = sorted(
+            [(count - self.initial_counts.get(name, 0), name)
+             for (name, count) in counts.iteritems()],
+            reverse=True
+        )
+        out.write("\nMEMORY:\n\n")
+        out.write("peak RSS: %d KB (grew by %d KB)\n" % (
+            max_rss(), max_rss() - self.initial_rss
+        ))
+        out.write("objects tracked by gc: %d (%+d)\n\n" % (
+            sum(counts.values()), sum(counts.values()) -
+                                  sum(self.initial_counts.values())
+        ))
+        for (count, name) in growth[:REPORT_LINES]:
+            if count <= 0:
+                break
+            out.write("%+10d  %s\n" % (count, name))
+        if self.memory_usage:
+            out.write("\nMEMORY BY SOURCE (peak RSS growth, objects):\n\n")
+            for (name, (rss, objects)) in sorted(
+                self.memory_usage.iteritems(),
+                key=lambda item: (-item[1][0], -item[1][1])
+            ):
+                out.write("%8d KB %+10d  %s\n" % (rss, objects, name))
@@ -0,0 +1,265 @@
+"""
+Reading the metadata of git and Mercurial repositories -- which
+revision is checked out, where refs point, and what tags there are --
+straight from the files in `.git` and `.hg`, instead of running `git`
+or `hg`.
+
+Only the common, simple repository formats are understood.  Anything
+else (git worktrees and reftables, Mercurial shares and new revlog or
+dirstate formats, and so forth) raises `UnsupportedRepository`, upon
+which the caller should ask `git` or `hg` instead.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import stat
+import struct
+
+
+class UnsupportedRepository(Exception):
+    pass
+
+
+def read_file(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+### git ###
+
+GIT_OBJECT_ID_RE = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+
+class GitMetadata(object):
+    def __init__(self, dirname):
+        gitdir = os.path.join(dirname, '.git')
+        if os.path.isfile(gitdir):
+            contents = read_file(gitdir) or ''
+            if not contents.startswith('gitdir: '):
+                raise UnsupportedRepository(gitdir)
+            gitdir = os.path.join(dirname, contents[len('gitdir: '):].strip())
+        if not os.path.isdir(gitdir):
+            raise UnsupportedRepository(gitdir)
+        for name in ('commondir', 'reftable'):
+            # linked worktrees, and refs which are not kept in files
+            if os.path.exists(os.path.join(gitdir, name)):
+                raise UnsupportedRepository(os.path.join(gitdir, name))
+        self.gitdir = gitdir
+        self._packed_refs = None
+
+    @property
+    def packed_refs(self):
+        """A dict mapping the name of each packed ref to the object id
+        it names.
+
+        """
+        if self._packed_refs is None:
+            self._packed_refs = {}
+            contents = read_file(os.path.join(self.gitdir, 'packed-refs'))
+            for line in (contents or '').splitlines():
+                # '^' lines give the commits which annotated tags point to
+                if not line or line.startswith(('#', '^')):
+                    continue
+                fields = line.split(' ', 1)
+                if len(fields) != 2 or not GIT_OBJECT_ID_RE.match(fields[0]):
+                    raise UnsupportedRepository('packed-refs')
+                self._packed_refs[fields[1].strip()] = fields[0]
+        return self._packed_refs
+
+    def ref(self, name, depth=0):
+        """Return the object id which the given ref (such as `HEAD` or
+        `refs/remotes/origin/master`) names, or None if there is no
+        such ref.
+
+        """
+        if depth > 5:
+            raise UnsupportedRepository(name)
+        contents = read_file(os.path.join(self.gitdir, name))
+        if contents is None:
+            return self.packed_refs.get(name)
+        contents = contents.strip()
+        if contents.startswith('ref: '):
+            return self.ref(contents[len('ref: '):], depth=depth + 1)
+        if not GIT_OBJECT_ID_RE.match(contents):
+            raise UnsupportedRepository(name)
+        return contents
+
+    def head(self):
+        return self.ref('HEAD')
+
+
+### Mercurial ###
+
+HG_REQUIREMENTS = set([
+    'revlogv1', 'store', 'fncache', 'dotencode', 'generaldelta',
+    'sparserevlog', 'share-safe', 'persistent-nodemap', 'treemanifest',
+    'revlog-compression-zstd', 'exp-compression-zstd', 'largefiles', 'lfs',
+    'internal-phase', 'bookmarksinstore', 'exp-sparse',
+])
+HG_NULL_ID = '\0' * 20
+REVLOG_INLINE = 1 << 16
+REVLOG_ENTRY = struct.Struct('>QiiiiII20s12x')
+DIRSTATE_ENTRY = struct.Struct('>ciiii')
+
+
+class HgMetadata(object):
+    def __init__(self, dirname):
+        hgdir = os.path.join(dirname, '.hg')
+        if not os.path.isdir(hgdir):
+            raise UnsupportedRepository(hgdir)
+        requires = set((read_file(os.path.join(hgdir, 'requires')) or '')
+                       .split())
+        if 'share-safe' in requires:
+            # the requirements of the store are kept in the store
+            requires |= set((read_file(os.path.join(hgdir, 'store',
+                                                    'requires')) or '')
+                            .split())
+        if requires - HG_REQUIREMENTS:
+            raise UnsupportedRepository(', '.join(requires - HG_REQUIREMENTS))
+        self.hgdir = hgdir
+        if 'store' in requires:
+            self.changelog = os.path.join(hgdir, 'store', '00changelog.i')
+        else:
+            self.changelog = os.path.join(hgdir, '00changelog.i')
+        self._nodes = None
+
+    @property
+    def nodes(self):
+        """The list of the (binary) node ids of the changesets in the
+        repository, in revision number order.
+
+        """
+        if self._nodes is None:
+            data = read_file(self.changelog) or ''
+            nodes = []
+            if data:
+                version = struct.unpack('>I', data[:4])[0]
+                if version & 0xFFFF != 1:
+                    raise UnsupportedRepository(self.changelog)
+                inline = version & REVLOG_INLINE
+                offset = 0
+                while offset + REVLOG_ENTRY.size <= len(data):
+                    entry = REVLOG_ENTRY.unpack_from(data, offset)
+                    nodes.append(entry[7])
+                    offset += REVLOG_ENTRY.size
+                    if inline:
+                        offset += entry[1]
+                if offset != len(data):
+                    raise UnsupportedRepository(self.changelog)
+            self._nodes = nodes
+        return self._nodes
+
+    def tip(self):
+        """Return the revision number and hex node id of the tip."""
+        if not self.nodes:
+            return (-1, '0' * 40)
+        return (len(self.nodes) - 1, self.nodes[-1].encode('hex'))
+
+    def parents(self):
+        """Return a list of the hex node ids of the working directory's
+        parents.
+
+        """
+        data = read_file(os.path.join(self.hgdir, 'dirstate'))
+        if data is None:
+            return []
+        if len(data) < 40 or data.startswith('dirstate-v2'):
+            raise UnsupportedRepository('dirstate')
+        return [node.encode('hex') for node in (data[:20], data[20:40])
+                if node != HG_NULL_ID]
+
+    def head(self):
+        return '+'.join(self.parents())
+
+    def possibly_modified(self):
+        """Return True if the working directory may have uncommitted
+        changes: if any file is added, removed or being merged, or if
+        the size, type, executable bit or modification time of any
+        tracked file is not what the dirstate recorded.  (Such a file
+        may still be unchanged; `hg status` would go on to compare its
+        contents.)
+
+        """
+        data = read_file(os.path.join(self.hgdir, 'dirstate'))
+        if data is None:
+            return False
+        if len(data) < 40 or data.startswith('dirstate-v2'):
+            raise UnsupportedRepository('dirstate')
+        root = os.path.dirname(self.hgdir)
+        offset = 40
+        while offset < len(data):
+            if offset + DIRSTATE_ENTRY.size > len(data):
+                raise UnsupportedRepository('dirstate')
+            (state, mode, size, mtime, length) = \
+                DIRSTATE_ENTRY.unpack_from(data, offset)
+            offset += DIRSTATE_ENTRY.size
+            # the name may be followed by a NUL and the name it was
+            # copied from
+            filename = data[offset:offset + length].split('\0')[0]
+            offset += length
+            if state != 'n' or size < 0 or mtime == -1:
+                return True
+            try:
+                st = os.lstat(os.path.join(root, filename))
+            except OSError:
+                return True
+            if (st.st_size & 0x7fffffff != size or
+                int(st.st_mtime) & 0x7fffffff != mtime or
+                stat.S_ISLNK(st.st_mode) != stat.S_ISLNK(mode) or
+                (st.st_mode ^ mode) & 0100):
+                return True
+        return False
+
+    def read_tag_lines(self, contents, tags):
+        for line in contents.splitlines():
+            fields = line.strip().split(' ', 1)
+            if len(fields) == 2 and re.match(r'^[0-9a-f]{40}$', fields[0]):
+                tags[fields[1].strip()] = fields[0]
+
+    def tags(self):
+        """Return a dict mapping each tag (including `tip`) to the
+        revision number of the changeset it is applied to, as `hg tags`
+        would list them.
+
+        The global tags are taken from the tags cache, if it is up to
+        date, or else from the `.hgtags` file in the working directory,
+        if the working directory is at the tip (so that it is the tip's
+        `.hgtags`.)
+
+        """
+        (tip_rev, tip_node) = self.tip()
+        node_tags = {}
+        for name in ('tags2-visible', 'tags2'):
+            contents = read_file(os.path.join(self.hgdir, 'cache', name))
+            if contents is None:
+                continue
+            lines = contents.split('\n', 1)
+            # the header may go on to give a hash of the filtered revisions
+            if lines[0].split()[:2] == [str(tip_rev), tip_node]:
+                self.read_tag_lines(lines[1] if len(lines) > 1 else '',
+                                    node_tags)
+                break
+        else:
+            if self.parents() != [tip_node]:
+                raise UnsupportedRepository('.hgtags')
+            self.read_tag_lines(read_file(os.path.join(
+                os.path.dirname(self.hgdir), '.hgtags'
+            )) or '', node_tags)
+        self.read_tag_lines(read_file(os.path.join(self.hgdir, 'localtags'))
+                            or '', node_tags)
+
+        revs = dict([(node, rev) for (rev, node) in enumerate(self.nodes)])
+        tags = {}
+        for (tag, hexnode) in node_tags.iteritems():
+            rev = revs.get(hexnode.decode('hex'))
+            # tags of unknown changesets, or removed tags, are not listed
+            if rev is not None:
+                tags[tag] = rev
+        tags['tip'] = tip_rev
+        return tags
@@ -0,0 +1,137 @@
+"""
+Ordering the processing of Sources so that each Source is built after
+the Sources which provide the executables it requires.
+
+The executables a Source requires are given by its `build_requires`
+and `require_executables` hints.  A Source being processed in the same
+run is taken to provide an executable if it already has a link to it
+in the `bin` link farm, if the executable is listed in its
+`interesting_executables` hint, or if the executable is named after
+the Source's project (so `m4-1.4.17` provides `m4`.)
+
+"""
+
+from __future__ import absolute_import
+
+import Queue
+import re
+
+from toolshelf.toolshelf import WorkerPool, default_jobs
+
+
+class BuildScheduler(object):
+    def __init__(self, shelf, sources):
+        self.shelf = shelf
+        self.sources = list(sources)
+        self.position = dict(
+            (source, n) for (n, source) in enumerate(self.sources)
+        )
+
+        providers = {}
+        for source in self.sources:
+            for name in self.provided_executables(source):
+                providers.setdefault(name, source)
+
+        # maps each Source to the Sources it must wait for, and vice versa
+        self.requires = dict((source, set()) for source in self.sources)
+        self.required_by = dict((source, set()) for source in self.sources)
+        for source in self.sources:
+            for name in self.required_executables(source):
+                provider = providers.get(name)
+                if provider is None or provider is source:
+                    continue
+                self.shelf.debug("%s requires %s, provided by %s" %
+                                 (source.name, name, provider.name))
+                self.requires[source].add(provider)
+                self.required_by[provider].add(source)
+
+    def required_executables(self, source):
+        names = []
+        for hint in ('build_requires', 'require_executables'):
+            names.extend(source.hints.get(hint, '').split())
+        return names
+
+    def provided_executables(self, source):
+        names = set(source.hints.get('interesting_executables', '').split())
+        for (farm, name, target) in \
+                self.shelf.link_manifest.links_for_source(source.dir):
+            if farm == 'bin':
+                names.add(name)
+        match = re.match(r'^(.*?)(-v?\d.*)?$', source.project)
+        if match.group(1):
+            names.add(match.group(1))
+            names.add(match.group(1).lower())
+        return names
+
+    def run(self, fun, progress=lambda x: x, jobs=None):
+        """Call `fun` for each Source (by way of `perform_on_source`),
+        concurrently, but never before it has been called for every
+        Source that Source requires, and that Source has been relinked.
+
+        """
+        if jobs is None:
+            jobs = self.shelf.options.jobs or default_jobs()
+        done = Queue.Queue()
+
+        def perform(source):
+            try:
+                self.shelf.perform_on_source(source, fun)
+                if self.required_by[source] and source.docked:
+                    # make its executables available to what requires it
+                    source.relink()
+            finally:
+                done.put(source)
+
+        pool = WorkerPool(jobs)
+        try:
+            for source in progress(self.each_ready_source(pool, done, jobs)):
+                if not pool.submit(perform, source):
+                    break
+        finally:
+            pool.join()
+
+    def each_ready_source(self, pool, done, jobs):
+        """Yield each Source once everything it requires is done, in the
+        order the Sources were given, keeping no more than `jobs` of
+        them running at once.
+
+        """
+        waiting = dict(
+            (source, set(required)) for (source, required)
+            in self.requires.iteritems()
+        )
+        ready = [source for source in self.sources if not waiting[source]]
+        for source in ready:
+            del waiting[source]
+        running = 0
+        remaining = len(self.sources)
+        while remaining:
+            while ready and running < jobs:
+                running += 1
+                yield ready.pop(0)
+            if not running:
+                # everything left is waiting on something else left
+                source = min(waiting, key=self.position.get)
+                self.shelf.warn("Dependency cycle involving %s; "
+                                "building it anyway" % source.name)
+                del waiting[source]
+                ready.append(source)
+                continue
+            finished = None
+            while finished is None:
+                if pool.cancelled.is_set():
+                    return
+                try:
+                    finished = done.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            running -= 1
+            remaining -= 1
+            for source in self.required_by[finished]:
+                if source not in waiting:
+                    continue
+                waiting[source].discard(finished)
+                if not waiting[source]:
+                    del waiting[source]
+                    ready.append(source)
+            ready.sort(key=self.position.get)
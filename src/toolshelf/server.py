@@ -0,0 +1,181 @@
+"""
+A long-running toolshelf (`toolshelf serve`) which answers read-only
+commands, such as `resolve`, from a Toolshelf it keeps in memory, so
+that they need not start up, and load the cookies, the docked index,
+the link manifest and so forth, every time.
+
+Commands are received from clients (see `toolshelf.client`) over a Unix
+socket in `.toolshelf/serve.sock`, and answered one at a time.  Before
+each one, the files (and directories) the Toolshelf's state was loaded
+from are `stat`ed, and any state whose files have changed since (because
+another toolshelf docked a source, say) is thrown away, to be loaded
+again when it is next needed.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+from toolshelf.client import socket_filename, read_message, write_message
+from toolshelf.toolshelf import (
+    ALIASES, LINK_FARM_NAMES, make_option_parser, execute
+)
+
+
+# commands which do not change anything, and so may be answered from
+# the daemon's Toolshelf
+SERVED_COMMANDS = ('resolve', 'which', 'show')
+
+
+def file_stamps(filenames):
+    stamps = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            stamps.append((st.st_mtime, st.st_size))
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+class Channel(object):
+    """A file-like object which sends what is written to it to the
+    client, on the given channel.
+
+    """
+    def __init__(self, f, channel):
+        self.f = f
+        self.channel = channel
+        self.softspace = 0
+
+    def write(self, data):
+        if data:
+            write_message(self.f, self.channel, data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class ShelfServer(object):
+    def __init__(self, shelf):
+        self.shelf = shelf
+        self.filename = socket_filename(shelf.dir)
+        self.stamps = {}
+
+    def watched_files(self):
+        """Return a dict mapping the name of each part of the Toolshelf's
+        state which may be thrown away to the files it depends on.
+
+        """
+        state_dir = os.path.join(self.shelf.dir, '.toolshelf')
+        return {
+            'cookies': [os.path.join(state_dir, 'local-cookies.catalog'),
+                        os.path.join(state_dir, 'cookies.catalog')],
+            'blacklist': [os.path.join(state_dir, 'blacklist.txt')],
+            'link_manifest': [os.path.join(state_dir, 'links.json')] + [
+                os.path.join(self.shelf.dir, '.' + farm)
+                for farm in LINK_FARM_NAMES
+            ],
+        }
+
+    def revalidate(self):
+        """Throw away whatever state has changed on disk since it was
+        loaded.
+
+        """
+        shelf = self.shelf
+        for (name, filenames) in self.watched_files().iteritems():
+            stamps = file_stamps(filenames)
+            if self.stamps.get(name) == stamps:
+                continue
+            if name in self.stamps:
+                shelf.debug("%s changed; reloading it" % name)
+            self.stamps[name] = stamps
+            shelf.forget(name)
+        # this only lists the directories which have changed
+        shelf.docked_index.refresh()
+
+    def serve_forever(self):
+        if os.path.exists(self.filename):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.filename)
+                raise SystemError("Already serving %s" % self.shelf.dir)
+            except socket.error:
+                # left behind by a daemon which is no longer running
+                os.unlink(self.filename)
+            finally:
+                sock.close()
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.filename)
+        sock.listen(16)
+        self.shelf.warn("Serving %s on %s" % (self.shelf.dir, self.filename))
+        try:
+            while True:
+                (connection, address) = sock.accept()
+                try:
+                    self.handle(connection)
+                except socket.error as e:
+                    self.shelf.debug("Lost client: %s" % e)
+                finally:
+                    connection.close()
+        finally:
+            sock.close()
+            os.unlink(self.filename)
+
+    def handle(self, connection):
+        f = connection.makefile('rwb', 0)
+        (channel, data) = read_message(f)
+        if channel != 'q':
+            return
+        args = data.split('\0')
+        (cwd, args) = (args[0], args[1:])
+        (stdout, stderr) = (sys.stdout, sys.stderr)
+        sys.stdout = Channel(f, 'o')
+        sys.stderr = Channel(f, 'e')
+        try:
+            try:
+                status = self.run(cwd, args)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        finally:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+        if status is None:
+            write_message(f, 'f', '')
+        else:
+            write_message(f, 'r', struct.pack('>i', status))
+
+    def run(self, cwd, args):
+        """Run toolshelf with the given arguments, as if in `cwd`.
+        Returns the exit status, or None if the command is not one
+        which is served.
+
+        """
+        (options, args) = make_option_parser(cwd).parse_args(args)
+        if not args or ALIASES.get(args[0], args[0]) not in SERVED_COMMANDS:
+            return None
+        if options.profile or options.profile_memory:
+            # profile the command itself, not the daemon
+            return None
+        self.revalidate()
+        shelf = self.shelf
+        shelf.options = options
+        shelf.cwd = cwd
+        shelf.errors = {}
+        shelf.chdir(cwd)
+        return execute(shelf, [ALIASES.get(args[0], args[0])], args[1:])
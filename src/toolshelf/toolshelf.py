@@ -37,20 +37,27 @@ same parameters may be combined and executed aggregatively.
 
 """
 
+from __future__ import absolute_import
+
+import bisect
 import errno
 import fnmatch
+import hashlib
+import json
 import os
 import optparse
-import pkgutil
+import pipes
+import Queue
 import re
+import shlex
+import stat
+import struct
 import subprocess
 import sys
+import threading
+import time
 
-try:
-    from tqdm import tqdm
-except ImportError:
-    def tqdm(x):
-        return x
+from toolshelf.commands import DESCRIPTIONS as COMMAND_DESCRIPTIONS
 
 
 __all__ = ['Toolshelf']
@@ -58,8 +65,7 @@ __all__ = ['Toolshelf']
 
 ### Constants
 
-COMMANDS_PATH = os.path.join(os.path.dirname(__file__), 'commands')
-COMMANDS = [name for _, name, _ in pkgutil.iter_modules([COMMANDS_PATH])]
+COMMANDS = sorted(COMMAND_DESCRIPTIONS)
 ALIASES = {
     'dock':   'tether+build+relink',
     'update': 'pull+build+relink',
@@ -110,6 +116,10 @@ UNINTERESTING_EXECUTABLES = (
     'dirname', 'basename', 'mt',
 )
 
+UNINTERESTING_EXECUTABLES_RE = re.compile(
+    '|'.join(['(?:%s)$' % pattern for pattern in UNINTERESTING_EXECUTABLES])
+)
+
 UNINTERESTING_PATHS = (
     'test', 'tests', 'dep', 'deps'
 )
@@ -127,8 +137,21 @@ HINT_NAMES = (
     'python_modules',
     'lua_modules',
     'include_dirs',  # defaults to '/install/include' if it exists
+    'distfile_sha256',
+    'clone_depth',
+    'sparse_checkout',
+)
+
+HINT_RE = re.compile(
+    r'^(%s)(@\w+)?\s+(.*?)\s*$' % '|'.join(HINT_NAMES)
 )
 
+# changes whenever the hints which are recognized do, so that cookies
+# parsed before then are not re-used (see `Cookies`)
+COOKIES_CACHE_VERSION = hashlib.sha1(' '.join(HINT_NAMES)).hexdigest()
+
+DISTFILE_TYPES = ('zip', 'tgz', 'tar.gz', 'tar.xz', 'tar.bz2')
+
 LINK_FARM_NAMES = ('bin', 'lib', 'include', 'pkgconfig', 'python', 'lua')
 
 ### Exceptions
@@ -153,13 +176,21 @@ def is_executable(filename):
     return os.path.isfile(filename) and os.access(filename, os.X_OK)
 
 
+def is_shared_object_name(filename):
+    return re.match('^.*?\.so(\.\d+)?$', filename)
+
+
 def is_shared_object(filename):
-    match = re.match('^.*?\.so(\.\d+)?$', filename)
+    match = is_shared_object_name(filename)
     return ((os.path.isfile(filename) or os.path.islink(filename)) and match)
 
 
+def is_static_lib_name(filename):
+    return re.match('^.*?\.a$', filename)
+
+
 def is_static_lib(filename):
-    match = re.match('^.*?\.a$', filename)
+    match = is_static_lib_name(filename)
     return ((os.path.isfile(filename) or os.path.islink(filename)) and match)
 
 
@@ -190,6 +221,191 @@ def is_lua_module(filename):
     return filename.endswith('.lua') and os.path.isfile(filename)
 
 
+class ListdirEntry(object):
+    """Stands in for the entries returned by `scandir` when it is not
+    available.  Each one `lstat`s its file at most once, and `stat`s it
+    at most once more if it is a symbolic link.
+
+    """
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._lstat = None
+        self._stat = None
+
+    def _mode(self, follow_symlinks):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if not follow_symlinks or not stat.S_ISLNK(self._lstat.st_mode):
+            return self._lstat.st_mode
+        if self._stat is None:
+            try:
+                self._stat = os.stat(self.path)
+            except OSError:
+                # broken link; neither a file nor a directory
+                return 0
+        return self._stat.st_mode
+
+    def is_dir(self, follow_symlinks=True):
+        return stat.S_ISDIR(self._mode(follow_symlinks))
+
+    def is_file(self, follow_symlinks=True):
+        return stat.S_ISREG(self._mode(follow_symlinks))
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._mode(False))
+
+
+# optional modules are only imported once they are needed, so that
+# commands which don't need them start up sooner
+
+def tqdm(iterable):
+    """Show a progress bar while iterating over the iterable, if tqdm
+    is installed.
+
+    """
+    try:
+        from tqdm import tqdm as progress_bar
+    except ImportError:
+        return iterable
+    return progress_bar(iterable)
+
+
+scandir = Ellipsis  # not looked for yet
+
+
+def iterdir(dirname):
+    """Return a list of the entries (see `ListdirEntry`) in the
+    given directory, using `scandir` if it is available.
+
+    """
+    global scandir
+    if scandir is Ellipsis:
+        try:
+            from os import scandir as found
+        except ImportError:
+            try:
+                from scandir import scandir as found
+            except ImportError:
+                found = None
+        scandir = found
+    if scandir is not None:
+        return list(scandir(dirname))
+    return [ListdirEntry(dirname, name) for name in os.listdir(dirname)]
+
+
+def load_json(file):
+    """Load JSON from the given file, with all strings as (UTF-8
+    encoded) `str`s rather than `unicode`s, like the rest of our
+    strings.
+
+    """
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        if isinstance(value, dict):
+            return dict(
+                (encode(k), encode(v)) for (k, v) in value.iteritems()
+            )
+        return value
+    return encode(json.load(file))
+
+
+def dirs_unchanged(dir_mtimes):
+    """Return True if every directory in the given dict still exists
+    and still has the modification time recorded for it.
+
+    """
+    for (dirname, mtime) in dir_mtimes.iteritems():
+        try:
+            if os.stat(dirname).st_mtime != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def default_jobs():
+    """Return the number of jobs to run concurrently when none was
+    requested explicitly: one per CPU.
+
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+ELF_MAGIC = '\x7fELF'
+MACHO_MAGICS = {
+    '\xfe\xed\xfa\xce': '>', '\xfe\xed\xfa\xcf': '>',
+    '\xce\xfa\xed\xfe': '<', '\xcf\xfa\xed\xfe': '<',
+}
+
+
+def looks_executable(filename):
+    """Return True if the given file looks like an executable, judging
+    by its first few bytes: a `#!` script, an ELF executable (including
+    position-independent ones, but not shared libraries,) a Mach-O
+    executable, or a DOS/Windows executable.
+
+    This is meant to agree with whether `file` would call it an
+    `executable`, without running `file`.
+
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = f.read(64)
+            if header.startswith(('#!', 'MZ')):
+                return True
+            if header.startswith(ELF_MAGIC):
+                return elf_is_executable(f, header)
+            if header[:4] in MACHO_MAGICS and len(header) >= 16:
+                filetype = struct.unpack(MACHO_MAGICS[header[:4]] + 'I',
+                                         header[12:16])[0]
+                return filetype == 2  # MH_EXECUTE
+    except (IOError, OSError, struct.error):
+        pass
+    return False
+
+
+def elf_is_executable(f, header):
+    """Given an open ELF file and its first 64 bytes, return True if it
+    is an executable (as opposed to a shared library or an object.)
+
+    """
+    if len(header) < 52:
+        return False
+    endian = {'\x01': '<', '\x02': '>'}.get(header[5])
+    if endian is None:
+        return False
+    e_type = struct.unpack(endian + 'H', header[16:18])[0]
+    if e_type == 2:  # ET_EXEC
+        return True
+    if e_type != 3:  # ET_DYN, either a PIE executable or a shared library
+        return False
+    if header[4] == '\x02':  # 64-bit
+        if len(header) < 64:
+            return False
+        phoff = struct.unpack(endian + 'Q', header[32:40])[0]
+        (phentsize, phnum) = struct.unpack(endian + 'HH', header[54:58])
+    else:
+        phoff = struct.unpack(endian + 'I', header[28:32])[0]
+        (phentsize, phnum) = struct.unpack(endian + 'HH', header[42:46])
+    if phentsize < 4 or phnum > 4096:
+        return False
+    f.seek(phoff)
+    table = f.read(phentsize * phnum)
+    for offset in xrange(0, len(table) - 3, phentsize):
+        p_type = struct.unpack(endian + 'I', table[offset:offset + 4])[0]
+        if p_type == 3:  # PT_INTERP; only executables ask for one
+            return True
+    return False
+
+
 def makedirs(dirname):
     try:
         os.makedirs(dirname)
@@ -201,13 +417,103 @@ def makedirs(dirname):
 
 ### Classes
 
+class NoSpan(object):
+    """What `Toolshelf.span` returns when not tracing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class WorkerPool(object):
+    """A bounded pool of worker threads which call functions submitted
+    to it.
+
+    At most `jobs` calls are queued ahead of the workers, so `submit`
+    blocks when the pool is busy.  If a call raises an exception, no
+    further calls are started, and the exception is re-raised from
+    `join` in the thread which owns the pool.
+
+    """
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.queue = Queue.Queue(maxsize=self.jobs)
+        self.failure = None
+        self.cancelled = threading.Event()
+        self.threads = []
+        for n in xrange(self.jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (fun, args) = item
+            if self.cancelled.is_set():
+                continue
+            try:
+                fun(*args)
+            except Exception:
+                if self.failure is None:
+                    self.failure = sys.exc_info()
+                self.cancelled.set()
+
+    def submit(self, fun, *args):
+        """Queue a call to `fun` with the given arguments.  Returns
+        False (and queues nothing) if the pool has been cancelled.
+
+        """
+        if self.cancelled.is_set():
+            return False
+        self.queue.put((fun, args))
+        return True
+
+    def join(self):
+        try:
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                # join with a timeout so that KeyboardInterrupt gets through
+                while thread.is_alive():
+                    thread.join(0.1)
+        except KeyboardInterrupt:
+            # don't start anything else; what is running is left to die
+            # with the interrupted subprocesses it is running
+            self.cancelled.set()
+            raise
+        if self.failure is not None:
+            (exc_type, exc_value, exc_tb) = self.failure
+            raise exc_type, exc_value, exc_tb
+
+
 # hints are stored under a 'spec key' which is a glob which
 # matches a *docked* source spec.
 
 class Cookies(object):
-    def __init__(self, shelf):
+    """The hints given in the cookies files, and the means to apply
+    them to Sources.
+
+    Each cookies file is parsed into a list of (spec key, hints) pairs,
+    in the order the spec keys first appear in the file.  If a
+    `cache_filename` is given, the parsed result is cached there, and
+    re-used for as long as the modification times and sizes of the
+    cookies files, and the names of the hints, do not change.
+
+    """
+    def __init__(self, shelf, cache_filename=None):
         self.shelf = shelf
+        self.cache_filename = cache_filename
         self._hint_maps = None
+        self._matchers = None
         self.filenames = []
 
     def add_file(self, filename):
@@ -216,45 +522,130 @@ class Cookies(object):
         if os.path.exists(filename):
             self.filenames.append(filename)
 
-    def _load_hints(self):
-        self._hint_maps = []
+    def _file_stamps(self):
+        stamps = []
         for filename in self.filenames:
-            self._load_hints_from_file(filename)
+            st = os.stat(filename)
+            stamps.append([filename, st.st_mtime, st.st_size])
+        return stamps
+
+    def _load_hints(self):
+        stamps = self._file_stamps()
+        hint_lists = self._load_cache(stamps)
+        if hint_lists is None:
+            hint_lists = [
+                self._load_hints_from_file(filename)
+                for filename in self.filenames
+            ]
+            self._save_cache(stamps, hint_lists)
+        self._hint_maps = [dict(hint_list) for hint_list in hint_lists]
+        self._matchers = [
+            self._compile_matcher(hint_list) for hint_list in hint_lists
+        ]
+
+    def _load_cache(self, stamps):
+        if self.cache_filename is None or \
+           not os.path.exists(self.cache_filename):
+            return None
+        try:
+            with open(self.cache_filename, 'r') as cache_file:
+                data = load_json(cache_file)
+        except ValueError:
+            return None
+        if data.get('version') != COOKIES_CACHE_VERSION or \
+           data.get('files') != stamps:
+            return None
+        self.shelf.debug("Loaded cached hints from %s" % self.cache_filename)
+        return [
+            [(key, hints) for (key, hints) in hint_list]
+            for hint_list in data['hints']
+        ]
+
+    def _save_cache(self, stamps, hint_lists):
+        if self.cache_filename is None:
+            return
+        temp_filename = self.cache_filename + '.tmp'
+        try:
+            with open(temp_filename, 'w') as cache_file:
+                json.dump({'version': COOKIES_CACHE_VERSION,
+                           'files': stamps, 'hints': hint_lists}, cache_file)
+            os.rename(temp_filename, self.cache_filename)
+        except (IOError, OSError) as e:
+            self.shelf.debug("Could not cache hints: %s" % e)
 
     def _load_hints_from_file(self, filename):
+        """Return a list of (spec key, hints) pairs from the given file."""
         hint_map = {}
+        spec_keys = []
         with open(filename, 'r') as hints_file:
             spec_key = None
             for line in hints_file:
                 line = line.strip()
                 if line == '' or line.startswith('#'):
                     continue
-                found_hint = False
-                for hint_name in HINT_NAMES:
-                    pattern = r'^%s(@\w+)?\s+(.*?)\s*$' % hint_name
-                    match = re.match(pattern, line)
-                    if match:
-                        if spec_key is None:
-                            raise SourceSpecError(
-                                'Found hint %s before any spec' % hint_name
-                            )
-                        arch_hint_name = hint_name + (match.group(1) or '')
-                        hint_value = match.group(2)
-                        self.shelf.debug("Adding hint '%s %s' to %s" %
-                            (arch_hint_name, hint_value, spec_key)
-                        )
-                        hint_map[spec_key][arch_hint_name] = hint_value
-                        if (hint_name == 'rectify_permissions' and
-                            hint_value not in ('yes', 'no')):
-                            raise ValueError(
-                                "rectify_permissions must be 'yes' or 'no'"
-                            )
-                        found_hint = True
-                        break
-                if not found_hint:  # ... then we found a spec
+                match = HINT_RE.match(line)
+                if not match:  # ... then we found a spec
                     spec_key = line
-                    hint_map.setdefault(spec_key, {})
-        self._hint_maps.append(hint_map)
+                    if spec_key not in hint_map:
+                        hint_map[spec_key] = {}
+                        spec_keys.append(spec_key)
+                    continue
+                hint_name = match.group(1)
+                if spec_key is None:
+                    raise SourceSpecError(
+                        'Found hint %s before any spec' % hint_name
+                    )
+                arch_hint_name = hint_name + (match.group(2) or '')
+                hint_value = match.group(3)
+                self.shelf.debug("Adding hint '%s %s' to %s" %
+                    (arch_hint_name, hint_value, spec_key)
+                )
+                hint_map[spec_key][arch_hint_name] = hint_value
+                if (hint_name == 'rectify_permissions' and
+                    hint_value not in ('yes', 'no')):
+                    raise ValueError(
+                        "rectify_permissions must be 'yes' or 'no'"
+                    )
+        return [(key, hint_map[key]) for key in spec_keys]
+
+    def _compile_matcher(self, hint_list):
+        """Return a function which, given a source name, returns the list
+        of hints (dicts) whose spec keys match it, in file order.
+
+        Spec keys without any glob characters are looked up directly;
+        the rest are compiled once, and also combined into a single
+        regex, so that a source name which matches none of them is
+        rejected in a single match.
+
+        """
+        literals = {}
+        globs = []
+        for (position, (key, hints)) in enumerate(hint_list):
+            if re.search(r'[*?[]', key):
+                globs.append((position, key, hints))
+            else:
+                literals[key] = (position, hints)
+        compiled = [
+            (position, re.compile(fnmatch.translate(key)), hints)
+            for (position, key, hints) in globs
+        ]
+        any_glob = None
+        if globs:
+            any_glob = re.compile('|'.join(
+                ['(?:%s)' % fnmatch.translate(key) for (p, key, h) in globs]
+            ))
+
+        def matcher(name):
+            found = []
+            if name in literals:
+                found.append(literals[name])
+            if any_glob is not None and any_glob.match(name):
+                for (position, pattern, hints) in compiled:
+                    if pattern.match(name):
+                        found.append((position, hints))
+            return [hints for (position, hints) in sorted(found)]
+
+        return matcher
 
     @property
     def hint_maps(self):
@@ -263,15 +654,17 @@ class Cookies(object):
         return self._hint_maps
 
     def apply_hints(self, source):
-        for hint_map in self.hint_maps:
-            found_in_map = False
-            for (key, hints) in hint_map.iteritems():
-                pattern = fnmatch.translate(key)
-                match = re.match(pattern, source.name)
-                if match:
-                    source.hints.update(hints)
-                    found_in_map = True
-            if found_in_map:
+        """Apply to the given Source the hints of every spec key that
+        matches it in the first cookies file that has any such spec key.
+
+        """
+        if self._matchers is None:
+            self._load_hints()
+        for matcher in self._matchers:
+            found = matcher(source.name)
+            for hints in found:
+                source.hints.update(hints)
+            if found:
                 break
 
 
@@ -314,6 +707,325 @@ class Blacklist(object):
         return source.name in self._blacklist_map
 
 
+class DockedIndex(object):
+    """An index of the docked sources (that is, of the host, user and
+    project directories under `$TOOLSHELF`,) for resolving docked
+    source specs without listing those directories every time.
+
+    Persisted in `.toolshelf/docked.json`, along with the modification
+    time of every host and user directory (and of `$TOOLSHELF` itself.)
+    When loaded, each of these directories is `stat`ed, and only the
+    ones which have changed since are listed again.
+
+    Whenever it changes, the index is also written out, as a resolution
+    table (see `resolution_table`,) to `table_filename`, in the form of
+    a POSIX shell `case` statement, which sets `TOOLSHELF_DIR` to the
+    directory of the source that the spec in `$1` resolves to.  This
+    lets the `toolshelf cd` of `init.sh` resolve specs without running
+    toolshelf at all.
+
+    """
+    def __init__(self, shelf, filename, table_filename=None):
+        self.shelf = shelf
+        self.filename = filename
+        self.table_filename = table_filename
+        self._tree = None
+        self._mtimes = None
+        self.dirty = False
+
+    def _ensure_loaded(self):
+        if self._tree is not None:
+            return
+        with self.shelf.lock:
+            if self._tree is not None:
+                return
+            self.load()
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as index_file:
+                try:
+                    data = load_json(index_file)
+                except ValueError as e:
+                    self.shelf.warn("Ignoring corrupt docked index %s: %s" %
+                                    (self.filename, e))
+        self._tree = data.get('tree', {})
+        self._mtimes = data.get('mtimes', {})
+        self.refresh()
+        self.shelf.debug("Loaded docked index %s" % self.filename)
+
+    def save(self):
+        if self._tree is None:
+            return
+        if self.table_filename is not None and (
+            self.dirty or not os.path.exists(self.table_filename)
+        ):
+            self.save_resolution_table()
+        if not self.dirty:
+            return
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as index_file:
+            json.dump({'tree': self._tree, 'mtimes': self._mtimes},
+                      index_file, indent=0, sort_keys=True)
+        os.rename(temp_filename, self.filename)
+        self.dirty = False
+
+    def resolution_table(self):
+        """Return a list of (spec, (host, user, project)) pairs, one for
+        each docked source spec which resolves to exactly one docked
+        source (see `Toolshelf.expand_docked_spec`), apart from specs
+        which depend on the working directory or name a tag.
+
+        """
+        self._ensure_loaded()
+        table = []
+        for source in self._sources:
+            (host, user, project) = source
+            if project == 'all':
+                continue
+            table.append(('%s/%s/%s' % source, source))
+            same = [s for s in self._by_user[user] if s[2] == project]
+            if len(same) == 1:
+                table.append(('%s/%s' % (user, project), source))
+            # a spec ending in '+' is a prefix, even if a project's
+            # name ends in '+'
+            if len(self._by_project[project]) == 1 and \
+               not project.endswith('+') and \
+               not project.startswith(('.', '@')):
+                table.append((project, source))
+        claimed = set()
+        for project in self._project_names:
+            source = self._by_project[project][0]
+            for length in xrange(len(project) + 1):
+                prefix = project[:length]
+                if prefix not in claimed:
+                    claimed.add(prefix)
+                    table.append((prefix + '+', source))
+        return table
+
+    def save_resolution_table(self):
+        specs = {}
+        for (spec, source) in self.resolution_table():
+            specs.setdefault(source, []).append(spec)
+        temp_filename = self.table_filename + '.tmp'
+        with open(temp_filename, 'w') as table_file:
+            table_file.write(
+                '# Generated by toolshelf whenever sources are docked or '
+                'removed.\n'
+                '# Sets TOOLSHELF_DIR to the directory of the docked '
+                'source $1 resolves to.\n'
+                'case "$1" in\n'
+            )
+            for source in sorted(specs):
+                table_file.write('  %s)\n' % '|'.join([
+                    pipes.quote(spec) for spec in specs[source]
+                ]))
+                table_file.write('    TOOLSHELF_DIR="$TOOLSHELF"/%s ;;\n' %
+                                 pipes.quote('/'.join(source)))
+            table_file.write('  *)\n    TOOLSHELF_DIR= ;;\nesac\n')
+        os.rename(temp_filename, self.table_filename)
+
+    def _listing(self, dirname, old_names, new_mtimes):
+        """Return the sorted names of the subdirectories of `dirname`,
+        re-using `old_names` if the directory has not changed since they
+        were recorded.
+
+        """
+        mtime = os.stat(dirname).st_mtime
+        new_mtimes[dirname] = mtime
+        if old_names is not None and self._mtimes.get(dirname) == mtime:
+            return old_names
+        self.shelf.debug("Listing %s for docked index" % dirname)
+        self.dirty = True
+        return sorted([
+            name for name in os.listdir(dirname)
+            if not name.startswith('.') and
+               os.path.isdir(os.path.join(dirname, name))
+        ])
+
+    def refresh(self):
+        """Bring the index up to date with the directories under
+        `$TOOLSHELF`.
+
+        """
+        if self._tree is None:
+            return  # not loaded yet; it will be brought up to date then
+        old_tree = self._tree
+        tree = {}
+        mtimes = {}
+        hosts = self._listing(self.shelf.dir, sorted(old_tree.keys()), mtimes)
+        for host in hosts:
+            host_dir = os.path.join(self.shelf.dir, host)
+            old_users = old_tree.get(host)
+            if old_users is not None:
+                old_users = sorted(old_users.keys())
+            tree[host] = {}
+            for user in self._listing(host_dir, old_users, mtimes):
+                user_dir = os.path.join(host_dir, user)
+                old_projects = old_tree.get(host, {}).get(user)
+                tree[host][user] = self._listing(user_dir, old_projects, mtimes)
+        if set(mtimes) != set(self._mtimes):
+            self.dirty = True
+        self._tree = tree
+        self._mtimes = mtimes
+        self._build_lookups()
+
+    def _build_lookups(self):
+        self._sources = []
+        for host in sorted(self._tree):
+            for user in sorted(self._tree[host]):
+                for project in self._tree[host][user]:
+                    self._sources.append((host, user, project))
+        self._by_project = {}
+        self._by_user = {}
+        for source in self._sources:
+            (host, user, project) = source
+            self._by_project.setdefault(project, []).append(source)
+            self._by_user.setdefault(user, []).append(source)
+        self._project_names = sorted(self._by_project)
+
+    def _touch(self, *dirnames):
+        # called right after we change these directories ourselves, so
+        # that our own changes do not make them look stale later on.
+        for dirname in dirnames:
+            if os.path.isdir(dirname):
+                self._mtimes[dirname] = os.stat(dirname).st_mtime
+        self.dirty = True
+
+    def add(self, source):
+        """Record that the given Source has just been docked."""
+        self._ensure_loaded()
+        with self.shelf.lock:
+            users = self._tree.setdefault(source.host, {})
+            projects = users.setdefault(source.user, [])
+            if source.project not in projects:
+                projects.append(source.project)
+                projects.sort()
+            host_dir = os.path.join(self.shelf.dir, source.host)
+            self._touch(self.shelf.dir, host_dir, source.user_dir)
+            self._build_lookups()
+
+    def discard(self, source):
+        """Record that the given Source has just been removed."""
+        self._ensure_loaded()
+        with self.shelf.lock:
+            projects = self._tree.get(source.host, {}).get(source.user, [])
+            if source.project in projects:
+                projects.remove(source.project)
+            self._touch(source.user_dir)
+            self._build_lookups()
+
+    def all(self):
+        """Return a list of (host, user, project) tuples, one for
+        every docked source, in sorted order.
+
+        """
+        self._ensure_loaded()
+        return list(self._sources)
+
+    def by_project(self, project):
+        self._ensure_loaded()
+        return list(self._by_project.get(project, []))
+
+    def by_user(self, user):
+        self._ensure_loaded()
+        return list(self._by_user.get(user, []))
+
+    def by_host_user(self, host, user):
+        self._ensure_loaded()
+        return [(host, user, project)
+                for project in self._tree.get(host, {}).get(user, [])]
+
+    def first_by_prefix(self, prefix):
+        """Return the first docked source (in order of project name)
+        whose project name starts with the given prefix, or None.
+
+        """
+        self._ensure_loaded()
+        index = bisect.bisect_left(self._project_names, prefix)
+        if (index < len(self._project_names) and
+            self._project_names[index].startswith(prefix)):
+            return self._by_project[self._project_names[index]][0]
+        return None
+
+
+class BuildStamps(object):
+    """A record, for each docked source, of what it was built from when
+    it was last built successfully, so that `Source.build` can skip
+    sources which have not changed since (see `Source.build_stamp`.)
+    Also records the SHA-256 of the distfile each distfile-based source
+    was extracted from, as they have no head ref to go by.
+
+    Persisted in `.toolshelf/builds.json`.
+
+    """
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self._stamps = None
+        self._distfiles = None
+        self.dirty = False
+
+    def _ensure_loaded(self):
+        if self._stamps is not None:
+            return
+        with self.shelf.lock:
+            if self._stamps is not None:
+                return
+            self.load()
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as stamps_file:
+                try:
+                    data = load_json(stamps_file)
+                except ValueError as e:
+                    self.shelf.warn("Ignoring corrupt build stamps %s: %s" %
+                                    (self.filename, e))
+        self._stamps = data.get('sources', {})
+        self._distfiles = data.get('distfiles', {})
+
+    def save(self):
+        if self._stamps is None or not self.dirty:
+            return
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as stamps_file:
+            json.dump({'sources': self._stamps, 'distfiles': self._distfiles},
+                      stamps_file, indent=0, sort_keys=True)
+        os.rename(temp_filename, self.filename)
+        self.dirty = False
+
+    def get(self, source):
+        self._ensure_loaded()
+        return self._stamps.get(source.dir)
+
+    def set(self, source, stamp):
+        self._ensure_loaded()
+        with self.shelf.lock:
+            self._stamps[source.dir] = stamp
+            self.dirty = True
+
+    def distfile_checksum(self, source):
+        self._ensure_loaded()
+        return self._distfiles.get(source.dir)
+
+    def set_distfile_checksum(self, source, checksum):
+        self._ensure_loaded()
+        with self.shelf.lock:
+            self._distfiles[source.dir] = checksum
+            self.dirty = True
+
+    def discard(self, source):
+        self._ensure_loaded()
+        with self.shelf.lock:
+            if self._stamps.pop(source.dir, None) is not None:
+                self.dirty = True
+            if self._distfiles.pop(source.dir, None) is not None:
+                self.dirty = True
+
+
 class Path(object):
     """For historical purposes only, although may still be used to
     see if executables shadow other executables in the search path.
@@ -344,18 +1056,242 @@ class Path(object):
         return found
 
 
+class LinkManifest(object):
+    """An index of the links in all of the link farms, recording which
+    docked source owns each link, so that the links belonging to a
+    source can be found without listing and reading every link farm.
+
+    It also records, for each source, what `Source.relink` needs in
+    order to tell whether that source has changed since it was last
+    relinked.
+
+    Persisted in `.toolshelf/links.json`.  Along with the links, the
+    modification time of each link farm directory is recorded; if a
+    link farm has been changed behind our back (or the manifest was not
+    saved after it was last changed,) the index for that link farm is
+    rebuilt from the directory itself when the manifest is loaded.
+
+    """
+    def __init__(self, shelf, filename):
+        self.shelf = shelf
+        self.filename = filename
+        self._farms = None
+        self._by_source = None
+        self._mtimes = None
+        self._relink_states = None
+        self.dirty = False
+
+    def _ensure_loaded(self):
+        if self._farms is not None:
+            return
+        with self.shelf.lock:
+            if self._farms is not None:
+                return
+            self.load()
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as manifest_file:
+                try:
+                    data = load_json(manifest_file)
+                except ValueError as e:
+                    self.shelf.warn("Ignoring corrupt link manifest %s: %s" %
+                                    (self.filename, e))
+        farms = data.get('farms', {})
+        self._relink_states = data.get('sources', {})
+        self._farms = {}
+        self._by_source = {}
+        self._mtimes = {}
+        stale = []
+        for (farm, link_farm) in self.shelf.link_farms.iteritems():
+            recorded = farms.get(farm)
+            if recorded is None or recorded['mtime'] != link_farm.mtime():
+                stale.append(farm)
+                continue
+            self._mtimes[farm] = recorded['mtime']
+            self._farms[farm] = {}
+            for (name, target) in recorded['links'].iteritems():
+                self._add(farm, name, target)
+        for farm in stale:
+            self.shelf.debug("Rebuilding link manifest for [%s]" % farm)
+            self.rebuild(farm)
+        self.shelf.debug("Loaded link manifest %s" % self.filename)
+
+    def save(self):
+        if self._farms is None or not self.dirty:
+            return
+        data = {'farms': {}, 'sources': self._relink_states}
+        for (farm, links) in self._farms.iteritems():
+            data['farms'][farm] = {
+                'mtime': self._mtimes[farm],
+                'links': links,
+            }
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as manifest_file:
+            json.dump(data, manifest_file, indent=0, sort_keys=True)
+        os.rename(temp_filename, self.filename)
+        self.dirty = False
+
+    def source_dir_of(self, target):
+        """Return the directory of the docked source which the given
+        link target lies within, or None if it is not in a docked source.
+
+        """
+        relative = os.path.relpath(target, self.shelf.dir)
+        components = relative.split(os.sep)
+        if (len(components) < 4 or components[0] == '..' or
+            components[0].startswith('.')):
+            return None
+        return os.path.join(self.shelf.dir, *components[:3])
+
+    def _add(self, farm, name, target):
+        self._farms[farm][name] = target
+        source_dir = self.source_dir_of(target)
+        self._by_source.setdefault(source_dir, {}).setdefault(
+            farm, set()
+        ).add(name)
+
+    def _remove(self, farm, name):
+        target = self._farms[farm].pop(name, None)
+        if target is None:
+            return
+        source_dir = self.source_dir_of(target)
+        names = self._by_source.get(source_dir, {}).get(farm, set())
+        names.discard(name)
+
+    def _touch(self, farm):
+        # called right after we change a link farm, so that our own
+        # changes do not make it look stale the next time we load.
+        self._mtimes[farm] = self.shelf.link_farms[farm].mtime()
+        self.dirty = True
+
+    def add(self, farm, name, target):
+        """Record that a link has just been made in the given link farm."""
+        self._ensure_loaded()
+        self._remove(farm, name)
+        self._add(farm, name, target)
+        self._touch(farm)
+
+    def remove(self, farm, name):
+        """Record that a link has just been removed from the given
+        link farm.
+
+        """
+        self._ensure_loaded()
+        self._remove(farm, name)
+        self._touch(farm)
+
+    def target(self, farm, name):
+        """Return the target of the named link in the given link farm,
+        or None if there is no such link.
+
+        """
+        self._ensure_loaded()
+        return self._farms[farm].get(name)
+
+    def links(self, farm):
+        """Return a list of (name, target) tuples for the given link farm."""
+        self._ensure_loaded()
+        return sorted(self._farms[farm].iteritems())
+
+    def links_for_source(self, source_dir):
+        """Return a list of (farm, name, target) tuples for the links
+        which point into the docked source in the given directory.
+
+        """
+        self._ensure_loaded()
+        result = []
+        for (farm, names) in self._by_source.get(source_dir, {}).iteritems():
+            for name in names:
+                result.append((farm, name, self._farms[farm][name]))
+        return sorted(result)
+
+    def relink_state(self, source_dir):
+        """Return what was recorded about the docked source in the given
+        directory when it was last relinked, or None.
+
+        """
+        self._ensure_loaded()
+        return self._relink_states.get(source_dir)
+
+    def set_relink_state(self, source_dir, state):
+        self._ensure_loaded()
+        self._relink_states[source_dir] = state
+        self.dirty = True
+
+    def rebuild(self, farm):
+        """Replace the index for the given link farm with what is
+        actually in its directory.  Returns a list of descriptions of
+        the differences that were found.
+
+        """
+        old_links = {}
+        if self._farms.get(farm) is not None:
+            old_links = dict(self._farms[farm])
+            for name in list(old_links.keys()):
+                self._remove(farm, name)
+        self._farms[farm] = {}
+        self._mtimes[farm] = self.shelf.link_farms[farm].mtime()
+        found = dict(
+            (os.path.basename(linkname), target)
+            for (linkname, target) in self.shelf.link_farms[farm].scan_links()
+        )
+        for (name, target) in found.iteritems():
+            self._add(farm, name, target)
+        differences = []
+        for name in sorted(set(old_links) | set(found)):
+            if name not in found:
+                differences.append("[%s] %s: in manifest, not in farm" %
+                                   (farm, name))
+            elif name not in old_links:
+                differences.append("[%s] %s: in farm, not in manifest" %
+                                   (farm, name))
+            elif old_links[name] != found[name]:
+                differences.append("[%s] %s: manifest has %s, farm has %s" %
+                                   (farm, name, old_links[name], found[name]))
+        self.dirty = True
+        return differences
+
+    def verify(self):
+        """Check the index of every link farm against the link farm
+        directories, repairing it where they differ.  Returns a list
+        of descriptions of the differences that were found.
+
+        """
+        self._ensure_loaded()
+        differences = []
+        for farm in sorted(self.shelf.link_farms):
+            differences.extend(self.rebuild(farm))
+        return differences
+
+
 class LinkFarm(object):
     """A link farm is a directory which contains symbolic links
     to files (typically executables, libraries, modules, etc.)
     in various other parts of the filesystem.
 
+    The links are tracked in the shelf's `LinkManifest`, so that
+    they need not be read back from the directory.
+
     """
-    def __init__(self, shelf, dirname):
+    def __init__(self, shelf, dirname, name=None):
         self.shelf = shelf
         self.dirname = dirname
+        if name is None:
+            name = os.path.basename(dirname).lstrip('.')
+        self.name = name
         makedirs(dirname)
 
-    def links(self):
+    @property
+    def manifest(self):
+        return self.shelf.link_manifest
+
+    def mtime(self):
+        return os.stat(self.dirname).st_mtime
+
+    def scan_links(self):
+        """Read the links from the link farm directory itself."""
         for name in os.listdir(self.dirname):
             fullfilename = os.path.join(self.dirname, name)
             if not os.path.islink(fullfilename):
@@ -363,35 +1299,56 @@ class LinkFarm(object):
             source = os.readlink(fullfilename)
             yield (fullfilename, source)
 
+    def links(self):
+        for (name, source) in self.manifest.links(self.name):
+            yield (os.path.join(self.dirname, name), source)
+
     def get_link(self, filename):
         filename = os.path.realpath(os.path.abspath(filename))
-        linkname = os.path.join(self.dirname, os.path.basename(filename))
-        if not os.path.islink(linkname):
+        name = os.path.basename(filename)
+        source = self.manifest.target(self.name, name)
+        if source is None:
             return None
-        source = os.readlink(linkname)
-        return (linkname, source)
+        return (os.path.join(self.dirname, name), source)
 
     def create_link(self, filename):
         filename = os.path.abspath(filename)
-        linkname = os.path.join(self.dirname, os.path.basename(filename))
+        name = os.path.basename(filename)
+        linkname = os.path.join(self.dirname, name)
         # We do trample existing links
-        if os.path.islink(linkname):
+        existing = self.manifest.target(self.name, name)
+        if existing is not None:
             # TODO only produce this message if the source link and
             # dest link are in different sources?
             self.shelf.warn("Trampling existing [%s] link %s" %
                 (os.path.basename(self.dirname), linkname)
             )
-            self.shelf.warn("  was: %s" % os.readlink(linkname))
+            self.shelf.warn("  was: %s" % existing)
             self.shelf.warn("  now: %s" % filename)
-            os.unlink(linkname)
+            self.remove_link(linkname)
         self.shelf.symlink(filename, linkname)
+        self.manifest.add(self.name, name, filename)
+
+    def remove_link(self, linkname):
+        try:
+            os.unlink(linkname)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        if os.path.islink(linkname):
+            raise IOError("could not unlink %s" % linkname)
+        self.manifest.remove(self.name, os.path.basename(linkname))
 
     def clean(self, prefix=''):
-        for (linkname, sourcename) in self.links():
+        for (linkname, sourcename) in list(self.links()):
             if sourcename.startswith(prefix):
-                os.unlink(linkname)
-                if os.path.islink(linkname):
-                    raise IOError("could not unlink %s" % linkname)
+                self.remove_link(linkname)
+
+    def clean_source(self, source):
+        """Remove all links which point into the given Source."""
+        for (farm, name, target) in self.manifest.links_for_source(source.dir):
+            if farm == self.name:
+                self.remove_link(os.path.join(self.dirname, name))
 
 
 class Source(object):
@@ -408,6 +1365,12 @@ class Source(object):
         self.local = local
         self.tag = tag
         self.hints = {}
+        self.permissions_rectified = False
+        # (hits, misses) of the compiler cache during the last build
+        self.compiler_cache_stats = None
+        # whether its upstream has moved on, if it has been probed (see
+        # `probe_upstream`)
+        self.upstream_changed = None
         self.shelf.cookies.apply_hints(self)
 
     def __repr__(self):
@@ -418,14 +1381,44 @@ class Source(object):
 
     @property
     def distfile(self):
+        """The filename of this source's distfile, or None if it is not
+        a distfile-based source, or its distfile has not been fetched.
+
+        """
         if self.local:
             return self.url
-        if self.type in ('zip', 'tgz', 'tar.gz', 'tar.xz', 'tar.bz2'):
-            return os.path.join(self.shelf.dir, '.distfiles',
-                                '%s.%s' % (self.project, self.type))
+        if self.type in DISTFILE_TYPES:
+            return self.shelf.distfile_cache.lookup(
+                self.url, checksum=self.hints.get('distfile_sha256')
+            )
         else:
             return None
 
+    def fetch_distfile(self):
+        """Return the filename of this source's distfile, downloading
+        it into the distfile cache first if need be.
+
+        """
+        if self.local:
+            if not os.path.exists(self.url):
+                raise IOError("local distfile '%s' doesn't exist?!" % self.url)
+            return self.url
+        cache = self.shelf.distfile_cache
+        checksum = self.hints.get('distfile_sha256')
+        # distfiles used to be kept under the project name; adopt any
+        # such distfile into the cache rather than fetching it again
+        legacy = os.path.join(self.shelf.dir, '.distfiles',
+                              '%s.%s' % (self.project, self.type))
+        if (os.path.isfile(legacy) and
+            cache.lookup(self.url, checksum=checksum) is None):
+            from toolshelf.download import DownloadError
+            self.shelf.note("Adopting `%s` into the distfile cache" % legacy)
+            try:
+                return cache.adopt(self.url, legacy, checksum=checksum)
+            except DownloadError as e:
+                self.shelf.warn("Not adopting `%s`: %s" % (legacy, e))
+        return cache.fetch(self.url, checksum=checksum)
+
     @property
     def name(self):
         return os.path.join(self.host, self.user, self.project)
@@ -444,114 +1437,259 @@ class Source(object):
 
     def checkout(self):
         self.shelf.note("Checking out %s..." % self.name)
+        # whatever was built here before, this tree has not been built
+        self.shelf.build_stamps.discard(self)
 
         makedirs(self.user_dir)
         self.shelf.chdir(self.user_dir)
 
         if self.type == 'git':
-            self.shelf.run('git', 'clone', self.url)
+            self.clone('git')
         elif self.type == 'hg':
-            self.shelf.run('hg', 'clone', self.url)
+            self.clone('hg')
         elif self.type == 'hg-or-git':
             try:
                 # better would be to check hg's error output for
                 # 'Http Error 406'
-                self.shelf.run('hg', 'clone', self.url)
+                self.clone('hg')
             except subprocess.CalledProcessError:
                 self.shelf.note("`hg clone` failed, so trying git")
-                self.shelf.run('git', 'clone', self.url)
-        elif self.distfile is not None:
-            self.shelf.run('mkdir', '-p',
-                           os.path.join(self.shelf.dir, '.distfiles'))
-            if not os.path.exists(self.distfile):
-                if self.local:
-                    raise IOError("local distfile '%s' doesn't exist?!" % self.distfile)
-                else:
-                    self.shelf.run('wget', '-nc', '-O', self.distfile, self.url)
-            extract_dir = os.path.join(
-                self.shelf.dir, '.extract_' + self.project
+                self.clone('git')
+        elif self.type in DISTFILE_TYPES:
+            from toolshelf.download import file_sha256
+            from toolshelf.extract import extract_distfile
+            distfile = self.fetch_distfile()
+            self.shelf.build_stamps.set_distfile_checksum(
+                self, file_sha256(distfile)
             )
-            self.shelf.run('mkdir', '-p', extract_dir)
-            self.shelf.chdir(extract_dir)
-            if self.type == 'zip':
-                self.shelf.run('unzip', self.distfile)
-            elif self.type in ('tgz', 'tar.gz'):
-                self.shelf.run('tar', '-z', '-x', '-v', '-f', self.distfile)
-            elif self.type == 'tar.xz':
-                self.shelf.run('tar', '-J', '-x', '-v', '-f', self.distfile)
-            elif self.type == 'tar.bz2':
-                self.shelf.run('tar', '-j', '-x', '-v', '-f', self.distfile)
-
-            files = os.listdir(extract_dir)
-            if len(files) == 1:
-                self.shelf.note("Archive is well-structured "
-                                "(all files in one directory)")
-                extracted_dir = os.path.join(extract_dir, files[0])
-                if not os.path.isdir(extracted_dir):
-                    extracted_dir = extract_dir
-            else:
-                self.shelf.note("Archive is a 'tarbomb' "
-                                "(all files in the root of the archive)")
-                extracted_dir = extract_dir
-            self.shelf.run('mv', extracted_dir, self.dir)
-            self.shelf.run('rm', '-rf', extract_dir)
+            rectify = None
+            if self.wants_rectified_permissions():
+                rectify = self.is_interesting
+            extract_distfile(self.shelf, distfile, self.type, self.dir,
+                             rectify=rectify)
+            self.permissions_rectified = rectify is not None
         else:
             raise NotImplementedError(self.type)
         self.update_to_tag(self.tag)
 
+    def clone(self, type):
+        """Clone this source's repository with `type` ('git' or 'hg'),
+        using the shelf's mirror of it if mirrors are enabled.
+
+        git clones may be shallow (see `clone_depth`) and may check out
+        only some paths (see `sparse_paths`.)  Shallow clones are not
+        made through the mirror, as that would fetch the full history
+        anyway.
+
+        """
+        depth = self.clone_depth()
+        sparse_paths = self.sparse_paths()
+        if type != 'git' and (depth or sparse_paths):
+            self.shelf.warn("Shallow and sparse clones are only supported "
+                            "for git; cloning all of %s" % self.name)
+            depth = sparse_paths = None
+        args = []
+        if depth:
+            args += ['--depth', str(depth)]
+            if self.tag:
+                args += ['--branch', self.tag]
+        if sparse_paths:
+            args.append('--no-checkout')
+
+        mirror_store = None
+        if not (self.local or depth):
+            mirror_store = self.shelf.mirror_store
+        if mirror_store is None:
+            self.shelf.run(type, 'clone', *(args + [self.url, self.dir]))
+        else:
+            mirror_store.clone(type, self.url, self.dir, *args)
+
+        if sparse_paths:
+            self.shelf.note("Checking out only %s" % ' '.join(sparse_paths))
+            self.shelf.run('git', 'config', 'core.sparseCheckout', 'true',
+                           cwd=self.dir)
+            info_dir = os.path.join(self.dir, '.git', 'info')
+            makedirs(info_dir)
+            with open(os.path.join(info_dir, 'sparse-checkout'), 'w') as f:
+                for path in sparse_paths:
+                    f.write('/%s/\n' % path.strip('/'))
+            self.shelf.run('git', 'read-tree', '-m', '-u', 'HEAD',
+                           cwd=self.dir)
+
+    def clone_depth(self):
+        """Return the number of commits of history to clone, or None to
+        clone all of it.  This is given by the `clone_depth` hint, or is
+        1 if --shallow was given.
+
+        """
+        depth = self.hints.get('clone_depth')
+        if depth is None:
+            if not getattr(self.shelf.options, 'shallow', False):
+                return None
+            depth = '1'
+        if not depth.isdigit() or int(depth) < 1:
+            raise ValueError(
+                "clone_depth should be a positive integer"
+            )
+        return int(depth)
+
+    def sparse_paths(self):
+        """Return the list of paths to check out, if the `sparse_checkout`
+        hint asks for only the `only_paths` to be checked out, or None
+        to check out everything.
+
+        """
+        sparse_checkout = self.hints.get('sparse_checkout', 'no')
+        if sparse_checkout not in ('yes', 'no'):
+            raise ValueError(
+                "sparse_checkout should be 'yes' or 'no'"
+            )
+        if sparse_checkout == 'no':
+            return None
+        only_paths = self.hints.get('only_paths')
+        if not only_paths:
+            self.shelf.warn("sparse_checkout given without only_paths; "
+                            "checking out all of %s" % self.name)
+            return None
+        return only_paths.split(' ')
+
     def update_to_tag(self, tag):
         """'tag' may also be the name of a branch."""
         if tag is None:
             return
         self.shelf.note("Updating %s to %s..." % (self.dir, tag))
         self.shelf.chdir(self.dir)
-        if os.path.isdir('.hg'):
+        if os.path.isdir(os.path.join(self.dir, '.hg')):
             self.shelf.run('hg', 'up', tag)
-        elif os.path.isdir('.git'):
+        elif os.path.isdir(os.path.join(self.dir, '.git')):
             self.shelf.run('git', 'checkout', tag)
         else:
             self.shelf.warn("Can't update to %s -- not version-controlled" % tag)
 
-    def build(self):
+    def build(self, rebuild=None):
+        """Build this source, unless it has not changed since it was last
+        built successfully (see `build_stamp`.)  Pass `rebuild` (or give
+        the --rebuild option) to build it regardless.
+
+        If the build cache has a build of this source, with the same
+        build stamp, it is restored instead of building the source.
+        Builds of sources which have never been built before (so that
+        everything the build produces can be told apart from the
+        pristine tree) are added to the build cache.
+
+        """
+        if rebuild is None:
+            rebuild = getattr(self.shelf.options, 'rebuild', False)
+        stamp = self.build_stamp()
+        previous_stamp = self.shelf.build_stamps.get(self)
+        if stamp is None:
+            self.shelf.note("Can't tell what %s is built from; "
+                            "building it" % self.name)
+        elif rebuild:
+            self.shelf.note("Rebuilding %s, as requested" % self.name)
+        elif previous_stamp == stamp:
+            self.shelf.note("%s is unchanged since it was last built, "
+                            "not rebuilding" % self.name)
+            return
+        else:
+            self.shelf.note("%s has changed since it was last built "
+                            "(or was never built)" % self.name)
+
         self.shelf.note("Building %s..." % self.dir)
 
         build_requires = self.hints.get('build_requires', '')
         if build_requires:
             search_path = Path()
+            search_path.add_component(self.shelf.link_farms['bin'].dirname)
             for executable in build_requires.strip().split(' '):
                 if not search_path.which(executable):
                     self.shelf.warn("Requires %s to build, not found on search path" % executable)
                     return
 
-        self.shelf.chdir(self.dir)
-        build_command = self.hints.get('build_command@' + self.shelf.uname, None)
-        if not build_command:
-            build_command = self.hints.get('build_command', None)
-        if build_command:
-            self.shelf.run(build_command, shell=True)
-        elif os.path.isfile('build.sh'):
-            self.shelf.run('./build.sh')
-        elif os.path.isfile('make.sh'):
-            self.shelf.run('./make.sh')
-        elif os.path.isfile('build.xml'):
-            self.shelf.run('ant')
-        else:
-            if (os.path.isfile('autogen.sh') and
-                not os.path.isfile('configure')):
-                self.shelf.run('./autogen.sh')
-            if (os.path.isfile('configure.in') and
-                not os.path.isfile('configure')):
-                self.shelf.run('autoconf')
-            if os.path.isfile('configure'):
-                self.shelf.run('./configure', "--prefix=%s" %
-                               os.path.join(self.dir, 'install'))
-                self.shelf.run('make')
-                self.shelf.run('make', 'install')
-            elif os.path.isfile('Makefile') or os.path.isfile('makefile'):
-                self.shelf.run('make')
-            elif os.path.isfile('src/Makefile'):
-                self.shelf.chdir('src')
-                self.shelf.run('make')
+        build_cache = None
+        if stamp is not None:
+            build_cache = self.shelf.build_cache
+        if build_cache is not None:
+            cache_key = build_cache.key(self, stamp)
+            if not rebuild and build_cache.restore(self, cache_key):
+                self.shelf.build_stamps.set(self, stamp)
+                return
+            snapshot = None
+            if previous_stamp is None:
+                snapshot = build_cache.snapshot(self)
+
+        # every `make` this build runs shares the shelf's job slots
+        jobserver = self.shelf.jobserver
+        env = jobserver.environ()
+        run = lambda *args, **kwargs: self.shelf.run(*args, env=env, **kwargs)
+        compiler_cache = self.shelf.compiler_cache
+        ccache_log = None
+        if compiler_cache is not None:
+            (env, ccache_log) = compiler_cache.environ(env)
+        try:
+            with jobserver.slot():
+                self.shelf.chdir(self.dir)
+                has_file = lambda name: os.path.isfile(os.path.join(self.dir, name))
+                build_command = self.hints.get('build_command@' + self.shelf.uname, None)
+                if not build_command:
+                    build_command = self.hints.get('build_command', None)
+                if build_command:
+                    run(build_command, shell=True)
+                elif has_file('build.sh'):
+                    run('./build.sh')
+                elif has_file('make.sh'):
+                    run('./make.sh')
+                elif has_file('build.xml'):
+                    run('ant')
+                else:
+                    if has_file('autogen.sh') and not has_file('configure'):
+                        run('./autogen.sh')
+                    if has_file('configure.in') and not has_file('configure'):
+                        run('autoconf')
+                    if has_file('configure'):
+                        run('./configure', "--prefix=%s" %
+                            os.path.join(self.dir, 'install'))
+                        run('make')
+                        run('make', 'install')
+                    elif has_file('Makefile') or has_file('makefile'):
+                        run('make')
+                    elif has_file('src/Makefile'):
+                        self.shelf.chdir(os.path.join(self.dir, 'src'))
+                        run('make')
+        finally:
+            if ccache_log is not None:
+                self.compiler_cache_stats = compiler_cache.stats(ccache_log)
+        if build_cache is not None and snapshot is not None:
+            build_cache.store(self, cache_key, snapshot)
+        if stamp is not None:
+            self.shelf.build_stamps.set(self, stamp)
+
+    def build_stamp(self):
+        """Return a string which changes whenever what this source would
+        be built from changes: its head ref and any uncommitted changes
+        to the files it tracks (or, for a distfile, the SHA-256 of the
+        distfile,) the hints which determine how it is built, or the OS.
+        Returns None if none of the former can be determined.
+
+        """
+        try:
+            identity = self.head_ref()
+        except NotImplementedError:
+            identity = None
+        if identity:
+            changes = self.uncommitted_changes(identity)
+            if changes:
+                identity += ' ' + hashlib.sha1(changes).hexdigest()
+        if not identity:
+            identity = self.shelf.build_stamps.distfile_checksum(self)
+        if not identity:
+            return None
+        hints = sorted([
+            (name, value) for (name, value) in self.hints.iteritems()
+            if name.startswith('build_command') or name == 'build_requires'
+        ])
+        data = json.dumps([identity, hints, self.shelf.uname])
+        return hashlib.sha1(data).hexdigest()
 
     def update(self, upstream=None):
         """Returns True if there were changes, False if there were none.
@@ -559,12 +1697,25 @@ class Source(object):
         """
         self.shelf.chdir(self.dir)
         old_head_ref = self.head_ref()
-        if os.path.isdir('.git'):
+        mirror_store = None
+        if upstream is None and not self.local:
+            mirror_store = self.shelf.mirror_store
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            if mirror_store is not None:
+                url = self.url or self.shelf.get_it(
+                    'git config --get remote.origin.url'
+                ).strip()
+                if url:
+                    mirror_store.prefetch('git', url, self.dir)
             if upstream is None:
                 self.shelf.run('git', 'pull')
             else:
                 self.shelf.run('git', 'pull', upstream)
-        elif os.path.isdir('.hg'):
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            if mirror_store is not None:
+                url = self.url or self.shelf.get_it('hg paths default').strip()
+                if url:
+                    mirror_store.prefetch('hg', url, self.dir)
             if upstream is None:
                 self.shelf.run('hg', 'pull', '-u')
             else:
@@ -576,77 +1727,151 @@ class Source(object):
         new_head_ref = self.head_ref()
         return old_head_ref != new_head_ref
 
-    def relink(self):
+    def relink(self, force=None):
         """Search this source for linkable files, and place them in
         the link farms.
 
-        Requires that the current directory is self.dir.
+        If this source has not changed since it was last relinked (see
+        `relink_fingerprint`), the links found then are re-used instead
+        of searching the source again, and if those links are all still
+        in place, the link farms are not touched at all.  Pass `force`
+        (or give the --force option) to always search the source.
+
+        Only one source is relinked at a time.
 
         """
-        # TODO: refactor all this to make it more efficient.
-        self.shelf.link_farms['bin'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(
-                              self.is_interesting_executable
-                            ):
-                self.shelf.link_farms['bin'].create_link(filename)
-
-        self.shelf.link_farms['lib'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(is_library):
-                self.shelf.link_farms['lib'].create_link(filename)
-
-        self.shelf.link_farms['python'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            python_modules = self.hints.get('python_modules')
-            if python_modules is not None:
-                for filename in python_modules.split(' '):
-                    self.shelf.link_farms['python'].create_link(filename)
-            else:
-                for filename in self.linkable_python_packages():
-                    self.shelf.link_farms['python'].create_link(filename)                
-
-        self.shelf.link_farms['lua'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            lua_modules = self.hints.get('lua_modules')
-            if lua_modules is not None:
-                for filename in lua_modules.split(' '):
-                    self.shelf.link_farms['lua'].create_link(filename)
-            else:
-                for filename in self.linkable_files(is_lua_module):
-                    if not self.is_interesting(filename):
-                        continue
-                    self.shelf.link_farms['lua'].create_link(filename)
-
-        self.shelf.link_farms['pkgconfig'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            for filename in self.linkable_files(is_pkgconfig_data):
-                self.shelf.link_farms['pkgconfig'].create_link(filename)
-
-        self.shelf.link_farms['include'].clean(prefix=self.dir)
-        if self not in self.shelf.blacklist:
-            include_dirs = self.hints.get('include_dirs', None)
-            if include_dirs is None:
-                if os.path.exists(os.path.join(self.dir, 'install', 'include')):
-                    include_dirs = 'install/include'
-            if include_dirs is not None:
-                for dirname in include_dirs.split(' '):
-                    dirname = os.path.join(self.dir, dirname)
-                    if not os.path.isdir(dirname):
-                        self.shelf.warn('No such directory: %s' % dirname)
-                        continue
-                    for filename in os.listdir(dirname):
-                        i_filename = os.path.join(dirname, filename)
-                        self.shelf.link_farms['include'].create_link(i_filename)
+        with self.shelf.span('relink', source=self.name):
+            with self.shelf.relink_lock:
+                self._relink(force)
+
+    def _relink(self, force):
+        if force is None:
+            force = self.shelf.options.force
+        manifest = self.shelf.link_manifest
+        fingerprint = self.relink_fingerprint()
+        linkable = None
+        found = None
+        state = manifest.relink_state(self.dir)
+        if (not force and state is not None and
+            state['fingerprint'] == fingerprint and
+            dirs_unchanged(state['dirs'])):
+            current = set([
+                (farm, target) for (farm, name, target)
+                in manifest.links_for_source(self.dir)
+            ])
+            found = set([tuple(link) for link in state['links']])
+            # a link whose name has since been taken by another source is
+            # left to that source; it is only restored once it is free
+            restorable = set([
+                (farm, target) for (farm, target) in found
+                if manifest.target(farm, os.path.basename(target))
+                   in (None, target)
+            ])
+            if current == restorable:
+                self.shelf.note("%s is unchanged, not relinking" % self.name)
+                return
+            self.shelf.note("%s is unchanged, restoring its links" % self.name)
+            linkable = {}
+            for (farm, target) in restorable:
+                linkable.setdefault(farm, []).append(target)
+
+        dir_mtimes = {}
+        if linkable is None:
+            linkable = {}
+            if self not in self.shelf.blacklist:
+                linkable = self.find_linkable_files(dir_mtimes=dir_mtimes)
+        else:
+            dir_mtimes = state['dirs']
+        for farm in LINK_FARM_NAMES:
+            link_farm = self.shelf.link_farms[farm]
+            link_farm.clean_source(self)
+            for filename in linkable.get(farm, ()):
+                link_farm.create_link(filename)
+        if found is None:
+            found = set([
+                (farm, os.path.abspath(filename))
+                for (farm, filenames) in linkable.iteritems()
+                for filename in filenames
+            ])
+        # every link found is recorded, including those which are left
+        # to other sources, so that they can be restored later
+        manifest.set_relink_state(self.dir, {
+            'fingerprint': fingerprint,
+            'dirs': dir_mtimes,
+            'links': sorted([list(link) for link in found]),
+        })
+
+    def relink_fingerprint(self):
+        """Return a string which changes whenever the head ref, the hints,
+        or the disabled-ness of this source change.  (Changes to the
+        files in this source are detected by the modification times of
+        its directories, which are recorded separately.)
+
+        """
+        try:
+            head_ref = self.head_ref()
+        except NotImplementedError:
+            head_ref = None
+        data = json.dumps([
+            head_ref, sorted(self.hints.iteritems()), self in self.shelf.blacklist
+        ])
+        return hashlib.sha1(data).hexdigest()
+
+    def find_linkable_files(self, dir_mtimes=None):
+        """Return a dict which maps the name of each link farm to a list
+        of the files (or directories) in this source which should be
+        linked into it.
+
+        If `dir_mtimes` is given, the modification time of every
+        directory which was searched is recorded in it.
+
+        """
+        if dir_mtimes is None:
+            dir_mtimes = {}
+        linkable = self.scan_linkable_files(dir_mtimes=dir_mtimes)
+
+        python_modules = self.hints.get('python_modules')
+        if python_modules is not None:
+            linkable['python'] = [
+                os.path.join(self.dir, filename)
+                for filename in python_modules.split(' ')
+            ]
+
+        lua_modules = self.hints.get('lua_modules')
+        if lua_modules is not None:
+            linkable['lua'] = [
+                os.path.join(self.dir, filename)
+                for filename in lua_modules.split(' ')
+            ]
+
+        include_dirs = self.hints.get('include_dirs', None)
+        if include_dirs is None:
+            for dirname in (self.dir, os.path.join(self.dir, 'install')):
+                if os.path.isdir(dirname):
+                    dir_mtimes[dirname] = os.stat(dirname).st_mtime
+            if os.path.exists(os.path.join(self.dir, 'install', 'include')):
+                include_dirs = 'install/include'
+        linkable['include'] = []
+        if include_dirs is not None:
+            for dirname in include_dirs.split(' '):
+                dirname = os.path.join(self.dir, dirname)
+                if not os.path.isdir(dirname):
+                    self.shelf.warn('No such directory: %s' % dirname)
+                    continue
+                dir_mtimes[dirname] = os.stat(dirname).st_mtime
+                for filename in os.listdir(dirname):
+                    linkable['include'].append(os.path.join(dirname, filename))
+
+        return linkable
 
     def status(self):
         self.shelf.chdir(self.dir)
         output = None
-        if os.path.isdir('.git'):
+        if os.path.isdir(os.path.join(self.dir, '.git')):
             output = self.shelf.get_it('git status')
             if 'working directory clean' in output:
                 output = ''
-        elif os.path.isdir('.hg'):
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
             output = self.shelf.get_it('hg status')
         if output:
             print self.dir
@@ -659,121 +1884,308 @@ class Source(object):
         interesting_executables = self.hints.get('interesting_executables', '').split(' ')
         if basename in interesting_executables:
             return True
-        for pattern in UNINTERESTING_EXECUTABLES:
-            if re.match('^' + pattern + '$', basename):
-                return False
-        return True
+        return not UNINTERESTING_EXECUTABLES_RE.match(basename)
 
     def is_interesting_executable(self, filename):
         return self.is_interesting(filename) and is_executable(filename)
 
+    def probe_upstream(self):
+        """Cheaply find out, without fetching anything, whether this
+        source's upstream repository has moved on since it was last
+        pulled.  Returns True if it has, False if it has not, or None if
+        that can't be told (in which case it should just be pulled.)
+
+        For git, the branch the source tracks is looked up with
+        `git ls-remote` and compared to the remote-tracking ref, which
+        must also already be merged into HEAD.  For hg, the head of the
+        working directory's branch is looked up with `hg identify`, both
+        upstream and locally.
+
+        """
+        from toolshelf.repometa import UnsupportedRepository
+        self.shelf.chdir(self.dir)
+        if os.path.isdir(os.path.join(self.dir, '.git')):
+            tracking = self.shelf.get_it(
+                'git rev-parse --abbrev-ref --symbolic-full-name @{u} '
+                '2>/dev/null'
+            ).strip()
+            if '/' not in tracking:
+                return None
+            (remote, branch) = tracking.split('/', 1)
+            output = self.shelf.get_it(
+                'git ls-remote %s %s 2>/dev/null' % (
+                    pipes.quote(remote), pipes.quote('refs/heads/' + branch)
+                )
+            ).split()
+            local = None
+            metadata = self.repository_metadata()
+            if metadata is not None:
+                try:
+                    local = metadata.ref('refs/remotes/' + tracking)
+                except UnsupportedRepository:
+                    pass
+            if local is None:
+                local = self.shelf.get_it(
+                    'git rev-parse --verify -q %s' % pipes.quote(tracking)
+                ).strip()
+            if not output or not local:
+                return None
+            if output[0] != local:
+                return True
+            unmerged = self.shelf.get_it(
+                'git rev-list --count HEAD..%s' % pipes.quote(tracking)
+            ).strip()
+            return unmerged != '0'
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            branch = self.shelf.get_it('hg branch 2>/dev/null').strip()
+            if not branch:
+                return None
+            remote = self.shelf.get_it(
+                'hg identify --id -r %s default 2>/dev/null' %
+                pipes.quote(branch)
+            ).strip()
+            local = self.shelf.get_it(
+                'hg identify --id -r %s 2>/dev/null' % pipes.quote(branch)
+            ).strip()
+            parent = self.shelf.get_it('hg identify --id 2>/dev/null').strip()
+            if not remote or not local:
+                return None
+            return remote != local or parent.rstrip('+') != local
+        else:
+            return None
+
+    def repository_metadata(self):
+        """Return an object which reads this source's repository
+        metadata (see `toolshelf.repometa`,) or None if its repository
+        is not in a format which can be read without running `git` or
+        `hg`.
+
+        """
+        from toolshelf.repometa import (
+            GitMetadata, HgMetadata, UnsupportedRepository
+        )
+        try:
+            if os.path.exists(os.path.join(self.dir, '.git')):
+                return GitMetadata(self.dir)
+            elif os.path.isdir(os.path.join(self.dir, '.hg')):
+                return HgMetadata(self.dir)
+        except UnsupportedRepository as e:
+            self.shelf.debug("Can't read repository of %s (%s)" %
+                             (self.name, e))
+        return None
+
     def head_ref(self):
+        """Return the id of the revision which is checked out (or, for
+        an hg merge in progress, of both revisions, joined with `+`.)
+        For hg, as with `hg id`, a `+` is added if the working directory
+        has uncommitted changes.
+
+        """
+        from toolshelf.repometa import HgMetadata, UnsupportedRepository
+        metadata = self.repository_metadata()
+        if metadata is not None:
+            try:
+                head = metadata.head()
+                if (isinstance(metadata, HgMetadata) and
+                    metadata.possibly_modified()):
+                    head += self.hg_modified_marker()
+                return head
+            except UnsupportedRepository as e:
+                self.shelf.debug("Can't read repository of %s (%s)" %
+                                 (self.name, e))
         self.shelf.chdir(self.dir)
-        if os.path.isdir('.git'):
-            return self.shelf.get_it('git rev-parse HEAD')
-        elif os.path.isdir('.hg'):
-            return self.shelf.get_it('hg id')
+        if os.path.exists(os.path.join(self.dir, '.git')):
+            return self.shelf.get_it('git rev-parse HEAD').strip()
+        elif os.path.isdir(os.path.join(self.dir, '.hg')):
+            return self.shelf.get_it(
+                'hg log -r "parents()" --template "{node}+"'
+            ).rstrip('+') + self.hg_modified_marker()
         else:
             raise NotImplementedError(
                 "Can't get head ref of a non-version-controlled Source"
             )
 
-    def may_use_path(self, dirname):
-        exclude_paths = [p for p in UNINTERESTING_PATHS]
+    def hg_modified_marker(self):
+        """Return '+' if this hg source's working directory has
+        uncommitted changes, as `hg id` would show, or else ''.
+
+        """
+        self.shelf.chdir(self.dir)
+        if self.shelf.get_it('hg status -mard').strip():
+            return '+'
+        return ''
+
+    def uncommitted_changes(self, head_ref):
+        """Return a diff of the uncommitted changes to the files this
+        source's repository tracks, or '' if there are none.  For hg,
+        `head_ref` (as returned by `head_ref`) already tells whether
+        there are any.
+
+        """
+        self.shelf.chdir(self.dir)
+        if os.path.exists(os.path.join(self.dir, '.git')):
+            return self.shelf.get_it(
+                'git diff --no-ext-diff --no-textconv --binary HEAD'
+            )
+        elif head_ref.endswith('+'):
+            return self.shelf.get_it('hg diff --git')
+        return ''
+
+    def excluded_path_prefixes(self):
+        """Return a tuple of the path prefixes under which nothing may
+        be linked, suitable for passing to `str.startswith`.
+
+        """
+        exclude_paths = list(UNINTERESTING_PATHS)
         exclude_paths_hint = self.hints.get('exclude_paths', None)
         if exclude_paths_hint:
             exclude_paths.extend(exclude_paths_hint.split(' '))
-        for path in exclude_paths:
-            verboten = os.path.join(self.dir, path)
-            if dirname.startswith(verboten):
-                return False
-        return True
+        return tuple([os.path.join(self.dir, path) for path in exclude_paths])
+
+    def may_use_path(self, dirname):
+        return not dirname.startswith(self.excluded_path_prefixes())
+
+    def scan_linkable_files(self, dir_mtimes=None):
+        """Search this source for files (and Python packages) which should
+        be linked into the link farms, in a single walk of the tree.
+
+        Every entry found is classified against the predicates of all
+        the link farms at once.  Returns a dict which maps link farm
+        names to lists of filenames; link farms whose contents are given
+        by hints (`python_modules`, `lua_modules`) are not searched.
+        If `dir_mtimes` is given, the modification time of every
+        directory which was searched is recorded in it.
+
+        """
+        interesting_executables = set(
+            self.hints.get('interesting_executables', '').split(' ')
+        )
+        def is_interesting(name):
+            return (name in interesting_executables or
+                    not UNINTERESTING_EXECUTABLES_RE.match(name))
 
-    def linkable_files(self, predicate):
+        excluded = self.excluded_path_prefixes()
+        scan_python = self.hints.get('python_modules') is None
+        scan_lua = self.hints.get('lua_modules') is None
+
+        # files are only linked from within `only_paths`, if given, but
+        # Python packages are searched for in the entire tree.
         only_paths = self.hints.get('only_paths', None)
-        paths_to_try = [self.dir]
+        file_roots = [self.dir]
         if only_paths:
-            paths_to_try = [
-                os.path.join(os.path.join(self.dir, path))
+            file_roots = [
+                os.path.normpath(os.path.join(self.dir, path))
                 for path in only_paths.split(' ')
             ]
-        for path in paths_to_try:
-            for filename in self.find_linkable_file_set(predicate, path):
-                yield filename
-
-    def find_linkable_file_set(self, predicate, subdir):
-        found_files = {}
-        for root, dirs, files in os.walk(os.path.join(self.dir, subdir)):
-            if '.git' in dirs:
-                dirs.remove('.git')
-            if '.hg' in dirs:
-                dirs.remove('.hg')
-            if not self.may_use_path(root):
-                self.shelf.debug("%s excluded from search path" % root)
-                dirs[:] = []
+        file_prefixes = tuple([root + os.sep for root in file_roots])
+        walk_roots = file_roots
+        if scan_python:
+            walk_roots = [self.dir]
+
+        found = {}
+        for farm in ('bin', 'lib', 'pkgconfig', 'python', 'lua'):
+            found[farm] = {}
+
+        # entries are (dirname, whether it is inside a Python package);
+        # visited in the same (top-down) order that os.walk would.
+        stack = [(root, False) for root in reversed(walk_roots)]
+        while stack:
+            (dirname, in_package) = stack.pop()
+            if dirname.startswith(excluded):
+                self.shelf.debug("%s excluded from search path" % dirname)
                 continue
-            for name in files:
-                filename = os.path.join(self.dir, root, name)
-                if predicate(filename):
-                    self.shelf.debug("found linkable file: %s" % filename)
-                    found_files[os.path.basename(filename)] = filename
-        return found_files.values()
-
-    def linkable_python_packages(self):
-        for filename in self.find_linkable_dir_set(is_python_package,
-                                                   self.dir):
-            yield filename
-
-    def find_linkable_dir_set(self, predicate, subdir):
-        found_dirs = {}
-        for root, dirs, files in os.walk(os.path.join(self.dir, subdir)):
-            if '.git' in dirs:
-                dirs.remove('.git')
-            if '.hg' in dirs:
-                dirs.remove('.hg')
-            if not self.may_use_path(root):
-                self.shelf.debug("%s excluded from search path" % root)
-                dirs[:] = []
-            remove_these = []
-            for name in dirs:
-                dirname = os.path.join(self.dir, root, name)
-                if predicate(dirname):
-                    self.shelf.debug("found linkable dir: %s" % dirname)
-                    found_dirs[os.path.basename(dirname)] = dirname
-                    remove_these.append(name)
-            # now, don't recurse
-            for name in remove_these:
-                dirs.remove(name)
-        return found_dirs.values()
+            in_scope = (dirname + os.sep).startswith(file_prefixes)
+            try:
+                if dir_mtimes is not None:
+                    dir_mtimes[dirname] = os.stat(dirname).st_mtime
+                entries = iterdir(dirname)
+            except OSError as e:
+                self.shelf.debug("can't list %s: %s" % (dirname, e))
+                continue
+            subdirs = []
+            for entry in entries:
+                name = entry.name
+                if entry.is_dir():
+                    if name in ('.git', '.hg'):
+                        continue
+                    is_package = in_package
+                    if (scan_python and not in_package and
+                        name not in UNINTERESTING_PATHS and
+                        os.path.isfile(os.path.join(entry.path,
+                                                    '__init__.py'))):
+                        self.shelf.debug("found linkable dir: %s" %
+                                         entry.path)
+                        found['python'][name] = entry.path
+                        is_package = True
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, is_package))
+                    continue
+                if not in_scope:
+                    continue
+                if (is_interesting(name) and entry.is_file() and
+                    os.access(entry.path, os.X_OK)):
+                    found['bin'][name] = entry.path
+                if ((is_shared_object_name(name) or is_static_lib_name(name))
+                    and (entry.is_file() or entry.is_symlink())):
+                    found['lib'][name] = entry.path
+                if (scan_lua and name.endswith('.lua') and entry.is_file()
+                    and is_interesting(name)):
+                    found['lua'][name] = entry.path
+                if is_pkgconfig_data(entry.path):
+                    found['pkgconfig'][name] = entry.path
+            stack.extend(reversed(subdirs))
+
+        linkable = {}
+        for (farm, files) in found.iteritems():
+            for filename in files.itervalues():
+                self.shelf.debug("found linkable file: %s" % filename)
+            linkable[farm] = files.values()
+        if not scan_python:
+            del linkable['python']
+        if not scan_lua:
+            del linkable['lua']
+        return linkable
 
     def rectify_executable_permissions(self):
+        """Make every interesting file in this source executable by its
+        owner if it looks like an executable (see `looks_executable`),
+        and non-executable if it does not.
+
+        The files are examined in this thread; it is sources which are
+        processed concurrently (with --jobs,) not the files in them.
+        Symbolic links are left alone.
+
+        """
         for root, dirs, files in os.walk(self.dir):
             if '.git' in dirs:
                 dirs.remove('.git')
             if '.hg' in dirs:
                 dirs.remove('.hg')
             for name in files:
-                filename = os.path.join(self.dir, root, name)
                 # if it's not 'interesting', just skip it, so we don't
-                # have to call 'file' so many times.  it won't be put on
-                # the path anyway, whether it's executable or not.
-                if not self.is_interesting(filename):
+                # have to examine it.  it won't be put on the path anyway,
+                # whether it's executable or not.
+                if not self.is_interesting(name):
+                    continue
+                filename = os.path.join(root, name)
+                try:
+                    mode = os.lstat(filename).st_mode
+                except OSError:
                     continue
-                make_it_executable = False
-                pipe = subprocess.Popen(["file", filename],
-                                        stdout=subprocess.PIPE)
-                output = pipe.communicate()[0]
-                self.shelf.debug(output)
-                if 'executable' in output:
-                    make_it_executable = True
-                if make_it_executable:
-                    self.shelf.debug("Making %s executable" % filename)
-                    subprocess.check_call(["chmod", "u+x", filename])
+                if not stat.S_ISREG(mode):
+                    continue
+                if looks_executable(filename):
+                    new_mode = mode | stat.S_IXUSR
+                    if new_mode != mode:
+                        self.shelf.debug("Making %s executable" % filename)
                 else:
-                    self.shelf.debug("Making %s NON-executable" % filename)
-                    subprocess.check_call(["chmod", "u-x", filename])
+                    new_mode = mode & ~stat.S_IXUSR
+                    if new_mode != mode:
+                        self.shelf.debug("Making %s NON-executable" % filename)
+                if new_mode != mode:
+                    os.chmod(filename, stat.S_IMODE(new_mode))
 
-    def rectify_permissions_if_needed(self):
+    def wants_rectified_permissions(self):
         rectify_permissions = 'no'
         if self.type == 'zip':
             rectify_permissions = 'yes'
@@ -784,10 +2196,36 @@ class Source(object):
             raise ValueError(
                 "rectify_permissions should be 'yes' or 'no'"
             )
-        if rectify_permissions == 'yes':
+        return rectify_permissions == 'yes'
+
+    def rectify_permissions_if_needed(self):
+        # distfiles have their permissions rectified as they are extracted
+        if self.wants_rectified_permissions() and \
+           not self.permissions_rectified:
             self.rectify_executable_permissions()
 
     def each_tag(self):
+        """Yield the name and revision number of each tag of this (hg)
+        source, most recently applied first, as `hg tags` lists them.
+
+        """
+        from toolshelf.repometa import HgMetadata, UnsupportedRepository
+        metadata = self.repository_metadata()
+        if isinstance(metadata, HgMetadata):
+            try:
+                tags = metadata.tags()
+            except UnsupportedRepository as e:
+                self.shelf.debug("Can't read tags of %s (%s)" %
+                                 (self.name, e))
+                tags = None
+            if tags is not None:
+                for (revision, tag) in sorted(
+                    [(revision, tag) for (tag, revision) in tags.iteritems()],
+                    reverse=True
+                ):
+                    if tag not in ('default/master',):
+                        yield tag, revision
+                return
         self.shelf.chdir(self.dir)
         output = self.shelf.get_it('hg tags')
         for line in output.split('\n'):
@@ -801,7 +2239,7 @@ class Source(object):
         (hg only for now.)
 
         """
-        cwd = os.getcwd()
+        cwd = self.shelf.getcwd()
         latest_tag = None
         for tag, revision in self.each_tag():
             tags[tag] = revision
@@ -821,14 +2259,16 @@ class Source(object):
             r'^.*?\.txt$',
             r'^.*?\.lhs$',
         )
-        for root, dirnames, filenames in os.walk('.'):
+        for root, dirnames, filenames in os.walk(self.dir):
             if root.endswith((".hg", "bin", "fixture", "distrepos")):
                 del dirnames[:]
                 continue
             for filename in filenames:
                 for pattern in DOC_PATTERNS:
                     if re.match(pattern, filename):
-                        yield os.path.join(root, filename)[2:]
+                        yield os.path.relpath(
+                            os.path.join(root, filename), self.dir
+                        )
                         break
 
 
@@ -869,26 +2309,74 @@ class BaseCommand(object):
     def show_progress(self):
         return True
 
+    def concurrent(self):
+        """Return True if `perform` may be called for several Sources
+        at once, from different threads.  Commands which write output
+        that should appear in Source order, or which modify shared
+        state such as the link farms, should return False.
+
+        """
+        return True
+
+    def stage(self):
+        """Return the name of the stage this command runs in, when it
+        runs in a pipelined CommandSequence (see `toolshelf.pipeline`):
+        'network' if it mostly waits on the network, 'serial' if it may
+        not run concurrently (see `concurrent`), or otherwise 'cpu'.
+
+        """
+        if not self.concurrent():
+            return 'serial'
+        return 'cpu'
+
+    def builds_sources(self):
+        """Return True if `perform` builds the given Source, in which
+        case each Source is only processed once the Sources which
+        provide the executables it requires have been (see
+        `toolshelf.schedule`.)
+
+        """
+        return False
+
     def trigger_relink(self, shelf):
         return []
 
     def specs_are_external(self):
         return False
 
+    def name(self):
+        """Return the name of this command, which is the name of the
+        module it is defined in.
+
+        """
+        return self.__class__.__module__.split('.')[-1]
+
+    def traced_perform(self, shelf, source):
+        """Call `perform`, inside a 'perform' span (see `Toolshelf.span`)."""
+        with shelf.span('perform', self.name(), source=source.name):
+            self.perform(shelf, source)
+
     def execute(self, shelf, args):
         """This is just provisional.  We'll actually run more than one
         Command at once...
 
         """
-        sources = self.process_args(shelf, args)
-        self.setup(shelf)
+        with shelf.span('process_args', self.name()):
+            sources = self.process_args(shelf, args)
+        with shelf.span('setup', self.name()):
+            self.setup(shelf)
         progress = lambda x: x
         if self.show_progress():
             progress = tqdm
+        jobs = None
+        if not self.concurrent():
+            jobs = 1
         shelf.foreach_source(
-            sources, lambda s: self.perform(shelf, s), progress=progress
+            sources, lambda s: self.traced_perform(shelf, s),
+            progress=progress, jobs=jobs, build_order=self.builds_sources()
         )
-        self.teardown(shelf)
+        with shelf.span('teardown', self.name()):
+            self.teardown(shelf)
         relink_specs = self.trigger_relink(shelf)
         if relink_specs:
             specs = shelf.expand_docked_specs(relink_specs)
@@ -896,24 +2384,46 @@ class BaseCommand(object):
             # FIXME this should be handled better
             for source in sources:
                 shelf.debug("Relinking %s" % source)
-                shelf.chdir(source.dir)  # needed for create_link, but probably shouldn't be
                 source.relink()
 
 
 class CommandSequence(list):
+    def execute_each(self, shelf, sources):
+        """Perform all of the commands on each source in turn."""
+        # commands which are not concurrent still see one Source at a
+        # time, even while the other commands in the sequence do not.
+        serial_lock = threading.Lock()
+        def execute(s):
+            for command in self:
+                if command.concurrent():
+                    command.traced_perform(shelf, s)
+                else:
+                    with serial_lock:
+                        command.traced_perform(shelf, s)
+        build_order = any(command.builds_sources() for command in self)
+        shelf.foreach_source(sources, execute, build_order=build_order)
+
     def execute(self, shelf, args):
         # XXX this is hacky.  different command process args in different
         # ways; you ought to only be able to combine ones that do it the same
-        sources = self[0].process_args(shelf, args)
+        with shelf.span('process_args', self[0].name()):
+            sources = self[0].process_args(shelf, args)
         for command in self:
-            command.setup(shelf)
-        def execute(s):
-            for command in self:
-                command.perform(shelf, s)
-        shelf.foreach_source(sources, execute)
+            with shelf.span('setup', command.name()):
+                command.setup(shelf)
+        jobs = shelf.options.jobs or default_jobs()
+        if jobs > 1 and len(set([command.stage() for command in self])) > 1:
+            # each source goes through the commands independently, so
+            # that fetching, building and relinking different sources
+            # overlap
+            from toolshelf.pipeline import Pipeline
+            Pipeline(shelf, list(self), jobs).run(sources, progress=tqdm)
+        else:
+            self.execute_each(shelf, sources)
         relink_specs = set()
         for command in self:
-            command.teardown(shelf)
+            with shelf.span('teardown', command.name()):
+                command.teardown(shelf)
             relink_specs.update(set(command.trigger_relink(shelf)))
         if relink_specs:
             specs = shelf.expand_docked_specs(list(relink_specs))
@@ -921,7 +2431,6 @@ class CommandSequence(list):
             # FIXME this should be handled better
             for source in sources:
                 shelf.debug("Relinking %s" % source)
-                shelf.chdir(source.dir)  # needed for create_link, but probably shouldn't be
                 source.relink()
 
 
@@ -944,83 +2453,374 @@ class Toolshelf(object):
             class DefaultOptions(object):
                 break_on_error = True
                 verbose = False
+                quiet = False
                 build = True
                 debug = False
+                jobs = 1
+                force = False
+                trace = None
+                profile = False
+                profile_memory = False
+                profile_sources = False
+                mirrors = False
+                shallow = False
+                cpu_budget = None
+                rebuild = False
+                build_cache_size = 0
+                ccache = False
             options = DefaultOptions()
         self.options = options
 
+        # per-thread state; currently just the working directory
+        self._local = threading.local()
+        # guards output and shared state when sources are processed
+        # concurrently; it is only ever held briefly
+        self.lock = threading.RLock()
+        # held for the whole of each relink (see `Source.relink`), so
+        # that only one source changes the link farms at a time
+        self.relink_lock = threading.RLock()
+
         if uname is None:
-            uname = self.get_it('uname').strip()
+            uname = os.uname()[0]
         self.uname = uname
         if self.uname.upper().startswith('CYGWIN'):
             self.uname = 'Cygwin'
 
-        if link_farms is None:
-            link_farms = {}
-        for farm in LINK_FARM_NAMES:
-            link_farms.setdefault(farm,
-                LinkFarm(self, os.path.join(self.dir, '.' + farm))
-            )
-        self.link_farms = link_farms
+        # the link farms, cookies and blacklist are only set up once
+        # they are needed, so that commands which don't need them (such
+        # as `resolve`, run by `toolshelf cd`) start up sooner
+        self._link_farms = dict(link_farms or {})
 
-        if cookies is None:
-            cookies = Cookies(self)
-            cookies.add_file(os.path.join(
-                self.dir, '.toolshelf', 'local-cookies.catalog'
-            ))
-            cookies.add_file(os.path.join(
-                self.dir, '.toolshelf', 'cookies.catalog'
-            ))
-        self.cookies = cookies
+        self.link_manifest = LinkManifest(self, os.path.join(
+            self.dir, '.toolshelf', 'links.json'
+        ))
 
-        if blacklist is None:
-            blacklist = Blacklist(self, os.path.join(
-                self.dir, '.toolshelf', 'blacklist.txt'
-            ))
-            blacklist.load()
-        self.blacklist = blacklist
+        self.docked_index = DockedIndex(self, os.path.join(
+            self.dir, '.toolshelf', 'docked.json'
+        ), table_filename=os.path.join(
+            self.dir, '.toolshelf', 'resolve.sh'
+        ))
+        self.build_stamps = BuildStamps(self, os.path.join(
+            self.dir, '.toolshelf', 'builds.json'
+        ))
+
+        self._cookies = cookies
+        self._blacklist = blacklist
 
         if errors is None:
             errors = {}
         self.errors = errors
 
+        self._distfile_cache = None
+        self._mirror_store = None
+        self._jobserver = None
+        self._build_cache = None
+        self._compiler_cache = None
+        self._hg_servers = None
+        self._tracer = None
+        # set by main when the --profile options are given (see
+        # `toolshelf.profiling`)
+        self.profiler = None
+
+    def forget(self, name):
+        """Throw away the named part ('cookies', 'blacklist' or
+        'link_manifest') of the state loaded from `.toolshelf`, so that
+        it is loaded again when it is next needed.
+
+        """
+        with self.lock:
+            if name == 'cookies':
+                self._cookies = None
+            elif name == 'blacklist':
+                self._blacklist = None
+            elif name == 'link_manifest':
+                self.link_manifest = LinkManifest(
+                    self, self.link_manifest.filename
+                )
+            else:
+                raise KeyError(name)
+
+    @property
+    def link_farms(self):
+        """A dict mapping the name of each link farm to its `LinkFarm`."""
+        with self.lock:
+            for farm in LINK_FARM_NAMES:
+                if farm not in self._link_farms:
+                    self._link_farms[farm] = LinkFarm(
+                        self, os.path.join(self.dir, '.' + farm)
+                    )
+        return self._link_farms
+
+    @property
+    def cookies(self):
+        with self.lock:
+            if self._cookies is None:
+                cookies = Cookies(self, cache_filename=os.path.join(
+                    self.dir, '.toolshelf', 'cookies.cache.json'
+                ))
+                cookies.add_file(os.path.join(
+                    self.dir, '.toolshelf', 'local-cookies.catalog'
+                ))
+                cookies.add_file(os.path.join(
+                    self.dir, '.toolshelf', 'cookies.catalog'
+                ))
+                self._cookies = cookies
+        return self._cookies
+
+    @property
+    def blacklist(self):
+        with self.lock:
+            if self._blacklist is None:
+                blacklist = Blacklist(self, os.path.join(
+                    self.dir, '.toolshelf', 'blacklist.txt'
+                ))
+                blacklist.load()
+                self._blacklist = blacklist
+        return self._blacklist
+
+    @property
+    def distfile_cache(self):
+        with self.lock:
+            if self._distfile_cache is None:
+                from toolshelf.download import DistfileCache
+                self._distfile_cache = DistfileCache(
+                    self, os.path.join(self.dir, '.distfiles')
+                )
+        return self._distfile_cache
+
+    @property
+    def jobserver(self):
+        """The GNU make jobserver shared by all builds, with as many job
+        slots as the --cpu-budget option gives (by default, the number
+        of CPUs.)
+
+        """
+        with self.lock:
+            if self._jobserver is None:
+                from toolshelf.jobserver import JobServer
+                slots = getattr(self.options, 'cpu_budget', None)
+                self._jobserver = JobServer(slots or default_jobs())
+        return self._jobserver
+
+    @property
+    def build_cache(self):
+        """The cache of builds, or None if the --build-cache-size option
+        is 0.
+
+        """
+        with self.lock:
+            if self._build_cache is None:
+                size = getattr(self.options, 'build_cache_size', 0)
+                if size > 0:
+                    from toolshelf.buildcache import BuildCache
+                    self._build_cache = BuildCache(
+                        self,
+                        os.path.join(self.dir, '.toolshelf', 'build-cache'),
+                        size * 1024 * 1024
+                    )
+        return self._build_cache
+
+    @property
+    def compiler_cache(self):
+        """The compiler cache (ccache) which builds compile through, or
+        None if the --ccache option was not given, or ccache is not
+        installed.
+
+        """
+        if not getattr(self.options, 'ccache', False):
+            return None
+        with self.lock:
+            if self._compiler_cache is None:
+                found = Path().which('ccache')
+                if found:
+                    from toolshelf.ccache import CompilerCache
+                    self._compiler_cache = CompilerCache(
+                        self, os.path.join(self.dir, '.toolshelf', 'ccache'),
+                        found[0]
+                    )
+                else:
+                    self.warn("ccache not found on search path; "
+                              "building without a compiler cache")
+                    self._compiler_cache = False
+        return self._compiler_cache or None
+
+    @property
+    def mirror_store(self):
+        """The store of local mirrors of git and hg repositories, or None
+        if mirrors are not in use.  Mirrors are used once the mirror
+        directory exists; the --mirrors option creates it.
+
+        """
+        with self.lock:
+            if self._mirror_store is None:
+                dirname = os.path.join(self.dir, '.toolshelf', 'mirrors')
+                if getattr(self.options, 'mirrors', False):
+                    makedirs(dirname)
+                if os.path.isdir(dirname):
+                    from toolshelf.mirror import MirrorStore
+                    self._mirror_store = MirrorStore(self, dirname)
+        return self._mirror_store
+
+    @property
+    def hg_servers(self):
+        """The pool of Mercurial command servers which local `hg`
+        commands are run through (see `toolshelf.hgserver`.)
+
+        """
+        with self.lock:
+            if self._hg_servers is None:
+                from toolshelf.hgserver import CommandServerPool
+                self._hg_servers = CommandServerPool(self)
+        return self._hg_servers
+
+    @property
+    def tracer(self):
+        """The Tracer which records events in the file given by the
+        --trace option, or None if that option was not given (see
+        `toolshelf.trace`.)
+
+        """
+        filename = self.options.trace
+        if filename is None:
+            return None
+        filename = os.path.join(self.cwd, filename)
+        with self.lock:
+            if self._tracer is None or self._tracer.filename != filename:
+                from toolshelf.trace import Tracer
+                self._tracer = Tracer(filename)
+        return self._tracer
+
+    def span(self, name, command=None, source=None):
+        """Return a context manager which, when tracing, records the
+        named phase of the named command (on the named Source, if any)
+        as taking as long as the `with` block it is used in.
+
+        """
+        tracer = self.tracer
+        if tracer is None:
+            return NO_SPAN
+        return tracer.span(name, command=command, source=source)
+
     ### utility methods ###
 
     def run(self, *args, **kwargs):
         self.note("Running `%s`..." % ' '.join(args))
-        if 'ignore_exit_code' in kwargs:
-            del kwargs['ignore_exit_code']
-            subprocess.call(args, **kwargs)
+        kwargs.setdefault('cwd', self.getcwd())
+        ignore_exit_code = kwargs.pop('ignore_exit_code', False)
+        tracer = self.tracer
+        # hg is run directly when its output goes to a terminal, so that
+        # it still pages and colours it
+        if (args[0] == 'hg' and not sys.stdout.isatty() and
+            self.hg_servers.routable(args[1:], kwargs)):
+            started = time.time()
+            result = self.hg_servers.run(list(args[1:]), kwargs['cwd'])
+            if result is not None:
+                (code, output, errors) = result
+                if tracer is not None:
+                    tracer.subprocess(args, kwargs['cwd'], started, code,
+                                      len(output), len(errors),
+                                      via='hg command server')
+                with self.lock:
+                    sys.stdout.write(output)
+                    sys.stderr.write(errors)
+                if code != 0 and not ignore_exit_code:
+                    raise subprocess.CalledProcessError(code, args)
+                return
+        if tracer is not None:
+            code = tracer.call(args, **kwargs)
         else:
-            subprocess.check_call(args, **kwargs)
+            code = subprocess.call(args, **kwargs)
+        if code != 0 and not ignore_exit_code:
+            raise subprocess.CalledProcessError(code, args)
 
     def get_it(self, command):
         self.note("Running `%s`..." % command)
-        output = subprocess.Popen(
-            command, shell=True, stdout=subprocess.PIPE
-        ).communicate()[0]
+        output = None
+        if command.startswith('hg '):
+            output = self.get_it_from_hg_server(command)
+        if output is None:
+            tracer = self.tracer
+            started = time.time()
+            process = subprocess.Popen(
+                command, shell=True, stdout=subprocess.PIPE,
+                stderr=(None if tracer is None else subprocess.PIPE),
+                cwd=self.getcwd()
+            )
+            (output, errors) = process.communicate()
+            if tracer is not None:
+                with self.lock:
+                    sys.stderr.write(errors)
+                tracer.subprocess(command, self.getcwd(), started,
+                                  process.returncode, len(output),
+                                  len(errors))
         if self.options.verbose:
-            print output
+            with self.lock:
+                print output
+        return output
+
+    def get_it_from_hg_server(self, command):
+        """Run the given `hg` shell command through a Mercurial command
+        server, and return its output, or None if it can't be (because
+        it does anything more than run `hg`, say.)
+
+        """
+        discard_errors = command.endswith(' 2>/dev/null')
+        if discard_errors:
+            command = command[:-len(' 2>/dev/null')]
+        if re.search(r'[|;&<>`$\\\n]', command):
+            return None
+        args = shlex.split(command)[1:]
+        if not self.hg_servers.routable(args):
+            return None
+        started = time.time()
+        result = self.hg_servers.run(args, self.getcwd())
+        if result is None:
+            return None
+        (code, output, errors) = result
+        if self.tracer is not None:
+            self.tracer.subprocess(['hg'] + args, self.getcwd(), started,
+                                   code, len(output), len(errors),
+                                   via='hg command server')
+        if not discard_errors:
+            with self.lock:
+                sys.stderr.write(errors)
         return output
 
     def debug(self, msg):
         """Display a debugging message."""
         if self.options.debug:
-            print "DEBUG: ", msg
+            with self.lock:
+                print "DEBUG: ", msg
 
     def note(self, msg):
         """Display an informative message, but only if verbose was selected."""
         if self.options.verbose:
-            print "*", msg
+            with self.lock:
+                print "*", msg
 
     def warn(self, msg):
         """Display a warning, but only if quiet was not selected."""
         if not self.options.quiet:
-            print msg
+            with self.lock:
+                print msg
+
+    def getcwd(self):
+        """Return the working directory of the current thread.
+
+        Each thread has its own working directory, which is what
+        `run` and `get_it` execute commands in; the working directory
+        of the process itself is never changed.
+
+        """
+        return getattr(self._local, 'cwd', None) or self.cwd
 
     def chdir(self, dirname):
+        """Change the working directory of the current thread."""
         self.note("Changing dir to `%s`..." % dirname)
-        os.chdir(dirname)
+        dirname = os.path.normpath(os.path.join(self.getcwd(), dirname))
+        if not os.path.isdir(dirname):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), dirname)
+        self._local.cwd = dirname
 
     def symlink(self, sourcename, linkname):
         self.note("Symlinking `%s` to `%s`..." % (linkname, sourcename))
@@ -1028,8 +2828,16 @@ class Toolshelf(object):
 
     ### persist state ###
 
-    def save(self):
-        self.blacklist.save()
+    def save(self, blacklist=True):
+        """Save the state kept in `.toolshelf`.  The blacklist is left
+        alone if `blacklist` is False.
+
+        """
+        if blacklist and self._blacklist is not None:
+            self._blacklist.save()
+        self.link_manifest.save()
+        self.docked_index.save()
+        self.build_stamps.save()
 
     ### making Sources from specs ###
 
@@ -1048,23 +2856,15 @@ class Toolshelf(object):
         7. all                        all docked projects
         8. .                          the docked project (if any) in the cwd
 
+        The docked sources are looked up in the `DockedIndex`, rather than
+        by listing the directories under `$TOOLSHELF`.
+
         """
         new_specs = []
         match = re.match(r'^([^/]*)/([^/]*)$', name)
+        index = self.docked_index
         if name == 'all':  # case 7
-            for host in sorted(os.listdir(self.dir)):
-                if host.startswith('.'):
-                    continue
-                host_dirname = os.path.join(self.dir, host)
-                for user in sorted(os.listdir(host_dirname)):
-                    user_dirname = os.path.join(host_dirname, user)
-                    for project in sorted(os.listdir(user_dirname)):
-                        project_dirname = os.path.join(user_dirname,
-                                                       project)
-                        if not os.path.isdir(project_dirname):
-                            continue
-                        new_specs.append('%s/%s/%s' % (host, user, project))
-            return new_specs
+            found = index.all()
         elif name == '.' or name.startswith('.@'):  # case 8
             tag = None
             if '@' in name:
@@ -1082,67 +2882,34 @@ class Toolshelf(object):
                     new_spec += '@' + tag
                 new_specs.append(new_spec)
             # else complain with an error!
+            return new_specs
         elif name.startswith('@'):
-            new_specs.append(name)
+            return [name]
         elif match:  # case 3 or 4
             user = match.group(1)
             project = match.group(2)
-            for host in sorted(os.listdir(self.dir)):
-                if host.startswith('.'):
-                    continue
-                user_dirname = os.path.join(self.dir, host, user)
-                if project == 'all':  # case 4
-                    if os.path.isdir(user_dirname):
-                        for found_project in sorted(os.listdir(user_dirname)):
-                            project_dirname = os.path.join(user_dirname,
-                                                           found_project)
-                            if not os.path.isdir(project_dirname):
-                                continue
-                            new_specs.append('%s/%s/%s' %
-                                (host, user, found_project)
-                            )
-                else:  # case 3
-                    project_dirname = os.path.join(
-                        self.dir, host, user, project
-                    )
-                    if not os.path.isdir(project_dirname):
-                        continue
-                    new_specs.append('%s/%s/%s' % (host, user, project))
+            found = index.by_user(user)
+            if project != 'all':  # case 3
+                found = [s for s in found if s[2] == project]
         elif '/' not in name:  # cases 5 and 6
-            try:
-                for host in os.listdir(self.dir):
-                    if host.startswith('.'):
-                        # skip hidden dirs
-                        continue
-                    host_dirname = os.path.join(self.dir, host)
-                    for user in os.listdir(host_dirname):
-                        user_dirname = os.path.join(host_dirname, user)
-                        for project in os.listdir(user_dirname):
-                            if project == name:
-                                new_specs.append('%s/%s/%s' %
-                                                 (host, user, project))
-                            if (name.endswith('+') and
-                                project.startswith(name[:-1])):
-                                new_specs.append('%s/%s/%s' %
-                                                 (host, user, project))
-                                raise StopIteration
-            except StopIteration:
-                pass
+            if name.endswith('+'):
+                found = [index.first_by_prefix(name[:-1])]
+                if found == [None]:
+                    found = []
+            else:
+                found = index.by_project(name)
         else:  # case 1 or 2
             components = name.split('/')
             host = components[0]
             user = ','.join(components[1:-1])
             project = components[-1]
             if project == 'all':  # case 2
-                user_dirname = os.path.join(self.dir, host, user)
-                for found_project in sorted(os.listdir(user_dirname)):
-                    project_dirname = os.path.join(user_dirname, found_project)
-                    if not os.path.isdir(project_dirname):
-                        continue
-                    new_specs.append('%s/%s/%s' % (host, user, found_project))
+                found = index.by_host_user(host, user)
             else:  # case 1
-                new_specs.append(name)
+                return [name]
 
+        for (host, user, project) in found:
+            new_specs.append('%s/%s/%s' % (host, user, project))
         return new_specs
 
     def expand_docked_specs(self, specs):
@@ -1186,6 +2953,7 @@ class Toolshelf(object):
           git://host.dom/.../user/repo.git       git
           http[s]://host.dom/.../user/repo.git   git
           http[s]://host.dom/.../user/repo       Mercurial
+          file:///path/to/.../user/repo          local git or hg repo
           http[s]://host.dom/.../distfile.tgz    \
           http[s]://host.dom/.../distfile.tar.gz | remotely hosted archive
           http[s]://host.dom/.../distfile.tar.xz | ("distfile" or "tarball")
@@ -1254,6 +3022,18 @@ class Toolshelf(object):
             return Source(self, url=name, host=host, user=user, project=project,
                           type='hg-or-git', tag=tag)
 
+        match = re.match(r'^file:\/\/(.*?)/([^/]*?)/([^/]*?)(\.git)?\/?$',
+                         name)
+        if match:
+            user = match.group(2)
+            project = match.group(3)
+            type = 'git'
+            if os.path.isdir(os.path.join(match.group(1), user, project,
+                                          '.hg')):
+                type = 'hg'
+            return Source(self, url=name, host='localhost', user=user,
+                          project=project, type=type, tag=tag)
+
         # local distfile
         match = re.match(r'^(.*?\/)([^/]*?)\.(zip|tgz|tar\.gz|tar\.xz|tar\.bz2)$', name)
         if match:
@@ -1331,28 +3111,58 @@ class Toolshelf(object):
 
     ### processing sources ###
 
-    def foreach_source(self, sources, fun, progress=tqdm):
+    def foreach_source(self, sources, fun, progress=tqdm, jobs=None,
+                       build_order=False):
         """Call `fun` for each Source in the given iterable sources.
 
-        The working directory is changed to that Source's directory
-        before `fun` is called.  (It is not changed back afterwards.)
-        In addition, if `fun` raises an error, it will be caught and
-        collected (unless the --break-on-error option was given.)
+        The working directory (see `getcwd`) is changed to that Source's
+        directory before `fun` is called.  (It is not changed back
+        afterwards.)  In addition, if `fun` raises an error, it will be
+        caught and collected (unless the --break-on-error option was
+        given.)
+
+        Up to `jobs` calls (by default, the value of the --jobs option)
+        are made concurrently, each in its own thread.  If `build_order`
+        is given, `fun` is not called for a Source until it has returned
+        for every Source which that Source requires (see `BuildScheduler`.)
 
         Note that a single spec among the specs can result in
         multiple Sources.
 
         """
-        for source in progress(sources):
-            if os.path.isdir(source.dir):
-                self.chdir(source.dir)
-            else:
-                self.chdir(self.dir)
-            try:
+        if jobs is None:
+            jobs = self.options.jobs or default_jobs()
+        if build_order:
+            from toolshelf.schedule import BuildScheduler
+            BuildScheduler(self, sources).run(fun, progress=progress,
+                                              jobs=jobs)
+            return
+        if jobs <= 1:
+            for source in progress(sources):
+                self.perform_on_source(source, fun)
+            return
+        pool = WorkerPool(jobs)
+        try:
+            for source in progress(sources):
+                if not pool.submit(self.perform_on_source, source, fun):
+                    break
+        finally:
+            pool.join()
+
+    def perform_on_source(self, source, fun):
+        if os.path.isdir(source.dir):
+            self.chdir(source.dir)
+        else:
+            self.chdir(self.dir)
+        try:
+            if self.profiler is None:
                 fun(source)
-            except Exception as e:
-                if self.options.break_on_error:
-                    raise
+            else:
+                self.profiler.call(source.name, fun, source)
+        except Exception as e:
+            if self.options.break_on_error:
+                raise
+            with self.lock:
                 self.errors.setdefault(source.name, []).append(str(e))
 
     def coalesce_catalog_args(self, args):
@@ -1391,27 +3201,19 @@ class Toolshelf(object):
 
 
 def available_commands():
-    fromlist = ["toolshelf.commands"]
-    command_modules = dict([
-        (name, __import__("toolshelf.commands.%s" % name, fromlist=fromlist))
-        for name in COMMANDS
-    ])
-
-    def short_desc(command):
-        doc = command_modules[command].__doc__
-        if not doc:
-            return "(no description available)"
-        return doc.strip().split('\n')[0]
-
     text = "Available commands are:"
     for command in COMMANDS:
-        text += "\n  %s: %s" % (command, short_desc(command))
+        text += "\n  %s: %s" % (command, COMMAND_DESCRIPTIONS[command])
     for alias in sorted(ALIASES.keys()):
         text += "\n  %s: alias for %s" % (alias, ALIASES[alias])
     return text
 
 
-def main(args):
+def make_option_parser(cwd=None):
+    """Return the parser of toolshelf's command-line options, as if run
+    in `cwd` (by default, the current directory.)
+
+    """
     parser = optparse.OptionParser(__doc__)
 
     parser.add_option("--bb-prefix-template",
@@ -1428,14 +3230,55 @@ def main(args):
                            "does not imply --verbose")
     parser.add_option("--output-dir",
                       dest="output_dir", metavar='DIR',
-                      default=os.path.realpath(os.path.abspath('.')),
+                      default=os.path.realpath(os.path.abspath(cwd or '.')),
                       help="for certain commands (release and export), "
-                           "write the results into this directory "
+                           "and for --profile, write the results into this "
+                           "directory "
                            "(default: %default)")
     parser.add_option("-K", "--break-on-error", dest="break_on_error",
                       default=False, action="store_true",
                       help="abort if error occurs with a single "
                            "source when processing multiple sources")
+    parser.add_option("--force", dest="force",
+                      default=False, action="store_true",
+                      help="relink sources even if they appear to be "
+                           "unchanged since they were last relinked")
+    parser.add_option("--rebuild", dest="rebuild",
+                      default=False, action="store_true",
+                      help="build sources even if they appear to be "
+                           "unchanged since they were last built")
+    parser.add_option("--build-cache-size", dest="build_cache_size",
+                      default=0, type="int", metavar='MB',
+                      help="keep the results of up to MB megabytes of builds "
+                           "in .toolshelf/build-cache, to restore instead of "
+                           "building again (this costs a walk of the source "
+                           "tree before and after each first build, and "
+                           "archiving what it produced); 0 disables "
+                           "(default: %default)")
+    parser.add_option("--ccache", dest="ccache",
+                      default=False, action="store_true",
+                      help="compile C and C++ code through ccache, with a "
+                           "cache in .toolshelf/ccache shared by all sources, "
+                           "if ccache is installed")
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      default=None, type="int", metavar='N',
+                      help="process up to N sources concurrently "
+                           "(default: the number of CPUs)")
+    parser.add_option("--mirrors", dest="mirrors",
+                      default=False, action="store_true",
+                      help="keep local mirrors of git and hg repositories "
+                           "in .toolshelf/mirrors and clone from them (once "
+                           "that directory exists, it is always used)")
+    parser.add_option("--shallow", dest="shallow",
+                      default=False, action="store_true",
+                      help="when tethering or docking git sources, clone "
+                           "only the most recent commit (or as many as "
+                           "given by the clone_depth hint)")
+    parser.add_option("--cpu-budget", dest="cpu_budget",
+                      default=None, type="int", metavar='N',
+                      help="run at most N make jobs at once, shared among "
+                           "all concurrent builds (default: the number of "
+                           "CPUs)")
     parser.add_option("--login", dest="login",
                       default=None, metavar='USERNAME',
                       help="username to login with when using the "
@@ -1444,33 +3287,69 @@ def main(args):
                       default=False, action="store_true",
                       help="abort if given specs do not resolve to "
                            "exactly one source")
+    parser.add_option("--trace", dest="trace",
+                      default=None, metavar='FILE',
+                      help="record each phase of each command, and each "
+                           "command run, with how long it took, as lines "
+                           "of JSON in FILE (see the chrometrace command)")
+    parser.add_option("--profile", dest="profile",
+                      default=False, action="store_true",
+                      help="profile toolshelf itself, report the functions "
+                           "which took the most time on standard error, and "
+                           "write the profile to toolshelf.pstats in the "
+                           "output directory")
+    parser.add_option("--profile-sources", dest="profile_sources",
+                      default=False, action="store_true",
+                      help="with --profile, also report on each source "
+                           "separately")
+    parser.add_option("--profile-memory", dest="profile_memory",
+                      default=False, action="store_true",
+                      help="report on standard error how much toolshelf's "
+                           "peak memory use and number of objects grew, in "
+                           "all and for each source")
     parser.add_option("-q", "--quiet", dest="quiet",
                       default=False, action="store_true",
                       help="suppress output of warning messages")
     parser.add_option("-v", "--verbose", dest="verbose",
                       default=False, action="store_true",
                       help="report steps taken to standard output")
+    return parser
 
-    (options, args) = parser.parse_args(args)
-    if len(args) == 0:
-        print "Usage: " + __doc__ + available_commands()
-        sys.exit(2)
 
-    t = Toolshelf(options=options)
+def subcommands_for(command):
+    """Return the list of subcommands which the given command (or alias,
+    or `+`-separated commands) stands for, or exit with a usage message
+    if any of them are unknown.
 
-    subcommands = ALIASES.get(args[0], args[0]).split('+')
+    """
+    subcommands = ALIASES.get(command, command).split('+')
     for subcommand in subcommands:
         if subcommand not in COMMANDS:
             print "Unknown command '%s'." % subcommand
             print
             print "Usage: " + __doc__ + available_commands()
             sys.exit(2)
+    return subcommands
 
-    args = t.coalesce_catalog_args(args[1:])
-    if len(subcommands) > 1:
-        t.run_commands(subcommands, args)
-    else:
-        t.run_command(subcommands[0], args)
+
+def execute(t, subcommands, args):
+    """Run the given subcommands on the given arguments with the given
+    Toolshelf, and report any errors.  Returns the exit status.
+
+    """
+    args = t.coalesce_catalog_args(args)
+    try:
+        if len(subcommands) > 1:
+            t.run_commands(subcommands, args)
+        else:
+            t.run_command(subcommands[0], args)
+    except Exception:
+        # what was done to the sources which were finished still counts.
+        # (every worker pool has been joined by now; but not so after a
+        # KeyboardInterrupt, which may leave workers changing the state
+        # as it is saved, so nothing is saved then.)
+        t.save(blacklist=False)
+        raise
     if t.errors:
         sys.stderr.write('\nERRORS:\n\n')
         for name in sorted(t.errors.keys()):
@@ -1479,9 +3358,37 @@ def main(args):
                 sys.stderr.write(msg + '\n')
             sys.stderr.write('\n')
         sys.stderr.write('For usage, run `toolshelf --help`.\n')
-        sys.exit(1)
+        # the links, build stamps and so forth which were recorded for
+        # the sources which succeeded are saved all the same (but the
+        # blacklist, as before, is only saved on success)
+        t.save(blacklist=False)
+        return 1
+    t.save()
+    return 0
+
+
+def main(args):
+    (options, args) = make_option_parser().parse_args(args)
+    if len(args) == 0:
+        print "Usage: " + __doc__ + available_commands()
+        sys.exit(2)
+
+    t = Toolshelf(options=options)
+
+    subcommands = subcommands_for(args[0])
+    if options.profile or options.profile_memory:
+        from toolshelf.profiling import Profiler
+        t.profiler = Profiler(t, cpu=options.profile,
+                              memory=options.profile_memory,
+                              by_source=options.profile_sources)
+        try:
+            status = t.profiler.run(execute, t, subcommands, args[1:])
+        finally:
+            t.profiler.report()
     else:
-        t.save()
+        status = execute(t, subcommands, args[1:])
+    if status != 0:
+        sys.exit(status)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+"""
+Recording what toolshelf spends its time on, for the --trace option.
+
+Each event is written as one line of JSON to the trace file, as soon as
+it is over:
+
+*   a 'phase' event for each phase of each command: `process_args`,
+    `setup`, `perform` (once for each Source), `teardown`, and `relink`
+    (once for each Source relinked, by whichever command);
+*   a 'subprocess' event for each command toolshelf runs: its argv (or
+    shell command line), working directory, exit code, and how many
+    bytes it wrote to standard output and to standard error.
+
+Every event has the time it started (`ts`, in seconds since the epoch,)
+its `duration` (in seconds,) and the process and thread it happened in,
+so that events from sources processed concurrently (with --jobs) can be
+told apart.  An event which ended in an exception also has an `error`.
+
+`chrome_trace` converts a trace file to the Trace Event Format read by
+Chrome's about:tracing, Perfetto, speedscope and the like, in which
+each thread is a track and nested phases and subprocesses are stacked
+as in a flame graph.
+
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+class Span(object):
+    """The context manager returned by `Tracer.span`."""
+
+    def __init__(self, tracer, fields):
+        self.tracer = tracer
+        self.fields = fields
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None:
+            self.fields['error'] = str(exc_value) or exc_type.__name__
+        self.tracer.record(self.started, **self.fields)
+        return False
+
+
+class Tracer(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'w')
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def record(self, started, **fields):
+        """Write an event which started at `started` and is over now."""
+        fields['ts'] = started
+        fields['duration'] = time.time() - started
+        fields['pid'] = self.pid
+        fields['thread'] = threading.current_thread().name
+        line = json.dumps(fields, sort_keys=True) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def span(self, name, command=None, source=None):
+        """Return a context manager which records a 'phase' event
+        covering the `with` block.
+
+        """
+        fields = {'event': 'phase', 'name': name}
+        if command is not None:
+            fields['command'] = command
+        if source is not None:
+            fields['source'] = source
+        return Span(self, fields)
+
+    def subprocess(self, argv, cwd, started, exit_code,
+                   stdout_bytes=None, stderr_bytes=None, **extra):
+        """Record a 'subprocess' event for a command which was started
+        at `started` and has exited.  `argv` may be a list of arguments
+        or a shell command line.  Byte counts which are not known should
+        be given as None.
+
+        """
+        if not isinstance(argv, basestring):
+            argv = list(argv)
+        self.record(started, event='subprocess', argv=argv, cwd=cwd,
+                    exit_code=exit_code, stdout_bytes=stdout_bytes,
+                    stderr_bytes=stderr_bytes, **extra)
+
+    def call(self, argv, **kwargs):
+        """Run a command as `subprocess.call` does, and record it.
+
+        To count what the command outputs, its standard output and
+        standard error (unless they are redirected by `kwargs`) are
+        piped through toolshelf, which copies them on to its own, so
+        they are not terminals as far as the command is concerned.
+
+        """
+        started = time.time()
+        pipes = {}
+        for (name, out) in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+            if kwargs.get(name) is None:
+                kwargs[name] = subprocess.PIPE
+                pipes[name] = out
+        try:
+            process = subprocess.Popen(argv, **kwargs)
+        except OSError as e:
+            self.subprocess(argv, kwargs.get('cwd'), started, None,
+                            error=str(e))
+            raise
+        counts = {}
+        def copy(name, out):
+            pipe = getattr(process, name)
+            count = 0
+            while True:
+                data = os.read(pipe.fileno(), 65536)
+                if not data:
+                    break
+                count += len(data)
+                out.write(data)
+                out.flush()
+            pipe.close()
+            counts[name] = count
+        threads = [threading.Thread(target=copy, args=item)
+                   for item in pipes.iteritems()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        code = process.wait()
+        self.subprocess(argv, kwargs.get('cwd'), started, code,
+                        counts.get('stdout'), counts.get('stderr'))
+        return code
+
+
+def read_events(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def chrome_trace(events):
+    """Convert the given trace events to a dict in the Trace Event
+    Format, ready to be dumped as JSON.
+
+    """
+    trace_events = []
+    thread_ids = {}
+    for event in events:
+        key = (event['pid'], event['thread'])
+        if key not in thread_ids:
+            thread_ids[key] = len(thread_ids) + 1
+            trace_events.append({
+                'ph': 'M', 'name': 'thread_name',
+                'pid': event['pid'], 'tid': thread_ids[key],
+                'args': {'name': event['thread']},
+            })
+        if event['event'] == 'subprocess':
+            argv = event['argv']
+            if not isinstance(argv, basestring):
+                argv = ' '.join(argv)
+            name = argv
+        else:
+            name = ' '.join([event[field] for field in
+                             ('command', 'name', 'source') if field in event])
+        args = dict((field, value) for (field, value) in event.iteritems()
+                    if field not in ('ts', 'duration', 'pid', 'thread'))
+        trace_events.append({
+            'ph': 'X', 'name': name, 'cat': event['event'],
+            'ts': int(event['ts'] * 1000000),
+            'dur': int(event['duration'] * 1000000),
+            'pid': event['pid'], 'tid': thread_ids[key],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
@@ -0,0 +1,191 @@
+"""
+Tests for cloning and updating git sources through mirrors, and for
+shallow and sparse clones, against repositories on the local filesystem
+(given by file:// URLs.)
+
+Run with `python -m unittest discover -s test` from the top of the
+repository.
+"""
+
+from os.path import realpath, dirname, join
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from toolshelf.toolshelf import Toolshelf
+
+
+def git(cwd, *args):
+    return subprocess.check_output(
+        ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] +
+        list(args), cwd=cwd
+    )
+
+
+class CloneTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.upstream = join(self.dir, 'repos', 'alice', 'hello')
+        os.makedirs(self.upstream)
+        git(self.upstream, 'init', '-q')
+        for n in xrange(3):
+            self.commit('commit %d' % n)
+        self.url = 'file://' + self.upstream
+        self.shelf_dir = join(self.dir, 'shelf')
+        os.makedirs(join(self.shelf_dir, '.toolshelf'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def commit(self, message, filename='README'):
+        path = join(self.upstream, filename)
+        if not os.path.isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        with open(path, 'a') as f:
+            f.write(message + '\n')
+        git(self.upstream, 'add', filename)
+        git(self.upstream, 'commit', '-q', '-m', message)
+
+    def make_shelf(self, mirrors=False):
+        shelf = Toolshelf(directory=self.shelf_dir)
+        shelf.options.mirrors = mirrors
+        return shelf
+
+    def dock(self, shelf, hints={}):
+        source = shelf.make_source_from_spec(self.url)
+        source.hints.update(hints)
+        source.checkout()
+        return source
+
+    def upstream_head(self):
+        return git(self.upstream, 'rev-parse', 'HEAD').strip()
+
+    def commit_count(self, source):
+        return int(git(source.dir, 'rev-list', '--count', 'HEAD').strip())
+
+
+class MirrorTest(CloneTest):
+    def test_clone_without_mirrors(self):
+        shelf = self.make_shelf()
+        source = self.dock(shelf)
+        self.assertEqual(shelf.mirror_store, None)
+        self.assertEqual(source.head_ref(), self.upstream_head())
+        self.assertEqual(self.commit_count(source), 3)
+
+    def test_clone_through_mirror(self):
+        shelf = self.make_shelf(mirrors=True)
+        source = self.dock(shelf)
+        mirror_dir = shelf.mirror_store.mirror_dir('git', self.url)
+        self.assertTrue(os.path.isdir(mirror_dir))
+        self.assertEqual(source.head_ref(), self.upstream_head())
+        self.assertEqual(self.commit_count(source), 3)
+        # the clone pulls from upstream, and does not need the mirror
+        self.assertEqual(
+            git(source.dir, 'config', '--get', 'remote.origin.url').strip(),
+            self.url
+        )
+        self.assertFalse(os.path.exists(
+            join(source.dir, '.git', 'objects', 'info', 'alternates')
+        ))
+        shutil.rmtree(mirror_dir)
+        git(source.dir, 'fsck', '--no-progress')
+
+    def test_mirror_is_refreshed_when_docking_again(self):
+        shelf = self.make_shelf(mirrors=True)
+        source = self.dock(shelf)
+        shutil.rmtree(source.dir)
+        self.commit('commit 3')
+        source = self.dock(self.make_shelf())
+        self.assertEqual(source.head_ref(), self.upstream_head())
+        mirror_dir = shelf.mirror_store.mirror_dir('git', self.url)
+        self.assertEqual(
+            git(mirror_dir, 'rev-parse', 'HEAD').strip(),
+            self.upstream_head()
+        )
+
+    def test_update_through_mirror(self):
+        shelf = self.make_shelf(mirrors=True)
+        source = self.dock(shelf)
+        self.assertFalse(source.update())
+        self.commit('commit 3')
+        self.assertTrue(source.update())
+        self.assertEqual(source.head_ref(), self.upstream_head())
+        mirror_dir = shelf.mirror_store.mirror_dir('git', self.url)
+        self.assertEqual(
+            git(mirror_dir, 'rev-parse', 'HEAD').strip(),
+            self.upstream_head()
+        )
+
+
+class ShallowSparseTest(CloneTest):
+    def test_clone_depth_hint(self):
+        source = self.dock(self.make_shelf(), hints={'clone_depth': '2'})
+        self.assertEqual(source.head_ref(), self.upstream_head())
+        self.assertEqual(self.commit_count(source), 2)
+
+    def test_shallow_option(self):
+        shelf = self.make_shelf()
+        shelf.options.shallow = True
+        source = self.dock(shelf)
+        self.assertEqual(self.commit_count(source), 1)
+
+    def test_shallow_clone_bypasses_mirror(self):
+        shelf = self.make_shelf(mirrors=True)
+        source = self.dock(shelf, hints={'clone_depth': '1'})
+        self.assertEqual(self.commit_count(source), 1)
+        self.assertFalse(os.path.exists(
+            shelf.mirror_store.mirror_dir('git', self.url)
+        ))
+
+    def test_bad_clone_depth(self):
+        shelf = self.make_shelf()
+        self.assertRaises(ValueError, self.dock, shelf,
+                          hints={'clone_depth': 'lots'})
+
+    def test_sparse_checkout(self):
+        self.commit('docs', filename=join('doc', 'index.txt'))
+        self.commit('code', filename=join('src', 'main.c'))
+        source = self.dock(self.make_shelf(), hints={
+            'sparse_checkout': 'yes', 'only_paths': 'src',
+        })
+        self.assertTrue(os.path.exists(join(source.dir, 'src', 'main.c')))
+        self.assertFalse(os.path.exists(join(source.dir, 'doc')))
+        self.assertEqual(self.commit_count(source), 5)
+
+    def test_sparse_checkout_without_only_paths(self):
+        self.commit('docs', filename=join('doc', 'index.txt'))
+        source = self.dock(self.make_shelf(),
+                           hints={'sparse_checkout': 'yes'})
+        self.assertTrue(os.path.exists(join(source.dir, 'doc', 'index.txt')))
+
+
+class BuildStampTest(CloneTest):
+    def test_uncommitted_changes_change_build_stamp(self):
+        source = self.dock(self.make_shelf())
+        stamp = source.build_stamp()
+        readme = join(source.dir, 'README')
+        with open(readme, 'a') as f:
+            f.write('edited\n')
+        edited_stamp = source.build_stamp()
+        self.assertNotEqual(edited_stamp, stamp)
+        with open(readme, 'a') as f:
+            f.write('edited again\n')
+        self.assertNotIn(source.build_stamp(), (stamp, edited_stamp))
+        git(source.dir, 'checkout', '-q', 'README')
+        self.assertEqual(source.build_stamp(), stamp)
+
+    def test_untracked_files_do_not_change_build_stamp(self):
+        source = self.dock(self.make_shelf())
+        stamp = source.build_stamp()
+        with open(join(source.dir, 'a.out'), 'w') as f:
+            f.write('built\n')
+        self.assertEqual(source.build_stamp(), stamp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+Tests for `toolshelf.download`, against an HTTP server on localhost.
+
+Run with `python -m unittest discover -s test` from the top of the
+repository.
+"""
+
+from os.path import realpath, dirname, join
+import os
+import re
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from toolshelf.download import DownloadError, file_sha256
+from toolshelf.toolshelf import Toolshelf
+
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's `root`, honouring `Range: bytes=N-`
+    requests (or answering them from the server's `range_start`, if that
+    is not None,) and records each request in the server's `requests`.
+
+    """
+    def translate_path(self, path):
+        return join(self.server.root, path.split('?')[0].lstrip('/'))
+
+    def do_GET(self):
+        range = self.headers.getheader('Range')
+        self.server.requests.append((self.path, range))
+        if range is None:
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+        with open(self.translate_path(self.path), 'rb') as f:
+            data = f.read()
+        start = int(re.match(r'^bytes=(\d+)-$', range).group(1))
+        if self.server.range_start is not None:
+            # answer with some other range than was asked for
+            start = self.server.range_start
+        if start >= len(data):
+            self.send_response(416)
+            self.end_headers()
+            return
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+            start, len(data) - 1, len(data)
+        ))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHTTPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DistfileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.root = join(self.dir, 'www')
+        os.makedirs(self.root)
+        self.data = ''.join(chr(n % 251) for n in xrange(300000))
+        with open(join(self.root, 'foo-1.0.tgz'), 'wb') as f:
+            f.write(self.data)
+        self.server = LocalHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.root = self.root
+        self.server.requests = []
+        self.server.range_start = None
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.shelf = Toolshelf(directory=join(self.dir, 'shelf'))
+        self.cache = self.shelf.distfile_cache
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.server.server_address[1], name)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_fetch_stores_by_content(self):
+        url = self.url('foo-1.0.tgz')
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual(filename,
+                         self.cache.content_path(file_sha256(filename)))
+        self.assertEqual(self.cache.lookup(url), filename)
+
+    def test_fetch_uses_cache(self):
+        url = self.url('foo-1.0.tgz')
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.cache.fetch(url), filename)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_same_contents_stored_once(self):
+        shutil.copyfile(join(self.root, 'foo-1.0.tgz'),
+                        join(self.root, 'foo-copy-1.0.tgz'))
+        self.assertEqual(self.cache.fetch(self.url('foo-1.0.tgz')),
+                         self.cache.fetch(self.url('foo-copy-1.0.tgz')))
+
+    def test_checksum_mismatch(self):
+        url = self.url('foo-1.0.tgz')
+        self.assertRaises(DownloadError, self.cache.fetch, url,
+                          checksum='0' * 64)
+        self.assertEqual(self.cache.lookup(url), None)
+        # nothing is left behind to be mistaken for a partial download
+        partial_dir = join(self.cache.dirname, 'partial')
+        self.assertEqual(os.listdir(partial_dir), [])
+
+    def test_checksum_match(self):
+        url = self.url('foo-1.0.tgz')
+        checksum = file_sha256(join(self.root, 'foo-1.0.tgz'))
+        filename = self.cache.fetch(url, checksum=checksum)
+        self.assertEqual(self.read(filename), self.data)
+
+    def test_resume(self):
+        url = self.url('foo-1.0.tgz')
+        partial_dir = join(self.cache.dirname, 'partial')
+        os.makedirs(partial_dir)
+        partial = join(partial_dir, self.cache._url_key(url)) + '.part'
+        with open(partial, 'wb') as f:
+            f.write(self.data[:100000])
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual(self.server.requests,
+                         [('/foo-1.0.tgz', 'bytes=100000-')])
+
+    def test_resume_complete_partial(self):
+        # the server answers 416; the download starts over
+        url = self.url('foo-1.0.tgz')
+        partial_dir = join(self.cache.dirname, 'partial')
+        os.makedirs(partial_dir)
+        partial = join(partial_dir, self.cache._url_key(url)) + '.part'
+        with open(partial, 'wb') as f:
+            f.write(self.data + 'extra')
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual([range for (path, range) in self.server.requests],
+                         ['bytes=%d-' % (len(self.data) + 5), None])
+
+    def write_partial(self, url, data):
+        partial_dir = join(self.cache.dirname, 'partial')
+        os.makedirs(partial_dir)
+        partial = join(partial_dir, self.cache._url_key(url)) + '.part'
+        with open(partial, 'wb') as f:
+            f.write(data)
+
+    def test_resume_answered_from_start(self):
+        url = self.url('foo-1.0.tgz')
+        self.write_partial(url, self.data[:100000])
+        self.server.range_start = 0
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_resume_answered_with_other_range(self):
+        # the partial file is not appended to; the download starts over
+        url = self.url('foo-1.0.tgz')
+        self.write_partial(url, self.data[:100000])
+        self.server.range_start = 50000
+        filename = self.cache.fetch(url)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual([range for (path, range) in self.server.requests],
+                         ['bytes=100000-', None])
+
+    def test_missing_file(self):
+        self.assertRaises(DownloadError, self.cache.fetch,
+                          self.url('nonexistent-1.0.tgz'))
+
+    def test_adopt_leaves_file(self):
+        legacy = join(self.dir, 'legacy.tgz')
+        shutil.copyfile(join(self.root, 'foo-1.0.tgz'), legacy)
+        url = self.url('foo-1.0.tgz')
+        filename = self.cache.adopt(url, legacy)
+        self.assertEqual(self.read(filename), self.data)
+        self.assertEqual(self.read(legacy), self.data)
+        self.assertEqual(self.cache.fetch(url), filename)
+        self.assertEqual(self.server.requests, [])
+
+    def test_adopt_mismatch_leaves_file(self):
+        legacy = join(self.dir, 'legacy.tgz')
+        shutil.copyfile(join(self.root, 'foo-1.0.tgz'), legacy)
+        self.assertRaises(DownloadError, self.cache.adopt,
+                          self.url('foo-1.0.tgz'), legacy, checksum='0' * 64)
+        self.assertEqual(self.read(legacy), self.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
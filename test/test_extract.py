@@ -0,0 +1,128 @@
+"""
+Tests for `toolshelf.extract`, with archives made on the fly.
+
+Run with `python -m unittest discover -s test` from the top of the
+repository.
+"""
+
+from os.path import realpath, dirname, join
+import os
+import shutil
+import StringIO
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from toolshelf.extract import extract_distfile
+from toolshelf.toolshelf import Toolshelf
+
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.outside = join(self.dir, 'outside')
+        os.makedirs(self.outside)
+        self.dest_dir = join(self.dir, 'shelf', 'alice', 'foo-1.0')
+        self.shelf = Toolshelf(directory=join(self.dir, 'shelf'))
+        self.shelf.options.verbose = False
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_tarball(self, members):
+        """Make a tarball of the given members, each a tuple of a name
+        and either the contents of a file, or ('symlink', linkname).
+
+        """
+        filename = join(self.dir, 'foo-1.0.tgz')
+        tar = tarfile.open(filename, 'w:gz')
+        for (name, contents) in members:
+            info = tarfile.TarInfo(name)
+            if isinstance(contents, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = contents[1]
+                tar.addfile(info)
+            else:
+                info.size = len(contents)
+                info.mode = 0644
+                tar.addfile(info, StringIO.StringIO(contents))
+        tar.close()
+        return (filename, 'tgz')
+
+    def make_zipfile(self, members):
+        filename = join(self.dir, 'foo-1.0.zip')
+        archive = zipfile.ZipFile(filename, 'w')
+        for (name, contents) in members:
+            info = zipfile.ZipInfo(name)
+            info.create_system = 3
+            if isinstance(contents, tuple):
+                info.external_attr = (0120777 << 16)
+                contents = contents[1]
+            else:
+                info.external_attr = (0100644 << 16)
+            archive.writestr(info, contents)
+        archive.close()
+        return (filename, 'zip')
+
+    def extract(self, (filename, type)):
+        extract_distfile(self.shelf, filename, type, self.dest_dir)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def check_symlinks(self, make):
+        self.extract(make([
+            ('foo-1.0/README', 'hello\n'),
+            ('foo-1.0/bin/foo', 'foo\n'),
+            ('foo-1.0/link', ('symlink', 'bin/foo')),
+        ]))
+        link = join(self.dest_dir, 'link')
+        self.assertEqual(os.readlink(link), 'bin/foo')
+        self.assertEqual(self.read(link), 'foo\n')
+
+    def check_absolute_symlink(self, make):
+        archive = make([
+            ('foo-1.0/README', 'hello\n'),
+            ('foo-1.0/evil', ('symlink', self.outside)),
+            ('foo-1.0/evil/x', 'gotcha\n'),
+        ])
+        self.assertRaises(ValueError, self.extract, archive)
+        self.assertEqual(os.listdir(self.outside), [])
+        self.assertFalse(os.path.exists(self.dest_dir))
+
+    def check_escaping_symlink(self, make):
+        archive = make([
+            ('foo-1.0/README', 'hello\n'),
+            ('foo-1.0/evil', ('symlink', '../../../outside')),
+            ('foo-1.0/evil/x', 'gotcha\n'),
+        ])
+        self.assertRaises(ValueError, self.extract, archive)
+        self.assertEqual(os.listdir(self.outside), [])
+        self.assertFalse(os.path.exists(self.dest_dir))
+
+    def test_tar_symlinks(self):
+        self.check_symlinks(self.make_tarball)
+
+    def test_tar_absolute_symlink(self):
+        self.check_absolute_symlink(self.make_tarball)
+
+    def test_tar_escaping_symlink(self):
+        self.check_escaping_symlink(self.make_tarball)
+
+    def test_zip_symlinks(self):
+        self.check_symlinks(self.make_zipfile)
+
+    def test_zip_absolute_symlink(self):
+        self.check_absolute_symlink(self.make_zipfile)
+
+    def test_zip_escaping_symlink(self):
+        self.check_escaping_symlink(self.make_zipfile)
+
+
+if __name__ == '__main__':
+    unittest.main()
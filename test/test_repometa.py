@@ -0,0 +1,122 @@
+"""
+Tests for `toolshelf.repometa`, against Mercurial repositories laid out
+by hand, and made by `hg` (if it is installed.)
+
+Run with `python -m unittest discover -s test` from the top of the
+repository.
+"""
+
+from os.path import realpath, dirname, join
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src'))
+
+from toolshelf.repometa import (
+    HgMetadata, UnsupportedRepository, REVLOG_ENTRY
+)
+
+
+NULL_REV = 0xffffffff  # -1, as the revlog stores it
+
+
+def have_hg():
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.call(['hg', '--version'], stdout=null,
+                                   stderr=null) == 0
+    except OSError:
+        return False
+
+
+def write(filename, contents):
+    if not os.path.isdir(dirname(filename)):
+        os.makedirs(dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(contents)
+
+
+class ShareSafeLayoutTest(unittest.TestCase):
+    """A repository laid out as `hg init` has by default since
+    Mercurial 6.1, with the requirements of the store kept in the store.
+
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.hgdir = join(self.dir, '.hg')
+        self.nodes = [hashlib.sha1(str(n)).digest() for n in xrange(3)]
+        write(join(self.hgdir, 'requires'), 'share-safe\n')
+        write(join(self.hgdir, 'store', 'requires'),
+              'dotencode\nfncache\ngeneraldelta\nrevlogv1\nsparserevlog\n'
+              'store\n')
+        # what hg leaves where the changelog used to be
+        write(join(self.hgdir, '00changelog.i'),
+              '\0\0\xff\xff dummy changelog to prevent using the old repo '
+              'layout')
+        entries = ''.join([
+            REVLOG_ENTRY.pack(0, 0, 0, rev, rev, (rev - 1) & NULL_REV,
+                              NULL_REV, node)
+            for (rev, node) in enumerate(self.nodes)
+        ])
+        version = '\0\x02\0\x01'  # revlogv1, generaldelta, not inline
+        write(join(self.hgdir, 'store', '00changelog.i'),
+              version + entries[4:])
+        write(join(self.hgdir, 'dirstate'), self.nodes[2] + '\0' * 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_tip(self):
+        metadata = HgMetadata(self.dir)
+        self.assertEqual(metadata.tip(), (2, self.nodes[2].encode('hex')))
+        self.assertEqual(metadata.head(), self.nodes[2].encode('hex'))
+
+    def test_unknown_store_requirement(self):
+        with open(join(self.hgdir, 'store', 'requires'), 'a') as f:
+            f.write('exp-something-new\n')
+        self.assertRaises(UnsupportedRepository, HgMetadata, self.dir)
+
+    def test_tags_cache_with_filtered_hash(self):
+        write(join(self.hgdir, 'cache', 'tags2-visible'),
+              '2 %s %s\n%s v1\n' % (self.nodes[2].encode('hex'), '0' * 40,
+                                    self.nodes[0].encode('hex')))
+        self.assertEqual(HgMetadata(self.dir).tags(), {'v1': 0, 'tip': 2})
+
+
+@unittest.skipUnless(have_hg(), "hg is not installed")
+class HgInitTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='toolshelf-test-')
+        self.hg('init')
+        write(join(self.dir, 'README'), 'hello\n')
+        self.hg('add', 'README')
+        self.hg('commit', '-m', 'one')
+        self.hg('tag', 'v1')
+        write(join(self.dir, 'README'), 'hello again\n')
+        self.hg('commit', '-m', 'two')
+        self.hg('tags')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def hg(self, *args):
+        return subprocess.check_output(
+            ['hg', '--config', 'ui.username=Test'] + list(args),
+            cwd=self.dir
+        )
+
+    def test_metadata(self):
+        metadata = HgMetadata(self.dir)
+        tip = self.hg('log', '-r', 'tip', '--template', '{rev} {node}')
+        self.assertEqual('%d %s' % metadata.tip(), tip)
+        self.assertEqual(metadata.head(), tip.split()[1])
+        self.assertEqual(metadata.tags(), {'v1': 0, 'tip': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
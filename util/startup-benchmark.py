@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Times how long `toolshelf resolve` takes to start up and resolve a
+# single docked source spec, as `toolshelf cd` does, in a scratch
+# toolshelf with a few hundred (empty) docked sources, and fails if
+# the median of several runs is over budget.
+#
+# Usage: startup-benchmark.py [budget-in-seconds [number-of-runs]]
+
+from os.path import realpath, dirname, join
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+DEFAULT_BUDGET = 0.2
+DEFAULT_RUNS = 11
+TOOLSHELF_PY = join(dirname(realpath(sys.argv[0])), '..', 'bin', 'toolshelf.py')
+
+
+def make_scratch_toolshelf(dirname, count=300):
+    os.makedirs(join(dirname, '.toolshelf'))
+    for n in range(count):
+        source_dir = join(dirname, 'github.com', 'user%d' % (n % 30),
+                          'project%d' % n)
+        os.makedirs(join(source_dir, '.git'))
+
+
+def time_resolve(dirname, spec):
+    env = dict(os.environ)
+    env['TOOLSHELF'] = dirname
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        subprocess.check_call(
+            [sys.executable, TOOLSHELF_PY, 'resolve', spec],
+            env=env, stdout=devnull
+        )
+        return time.time() - started
+
+
+def main(args):
+    budget = float(args[0]) if len(args) > 0 else DEFAULT_BUDGET
+    runs = int(args[1]) if len(args) > 1 else DEFAULT_RUNS
+    dirname = tempfile.mkdtemp(prefix='toolshelf-bench-')
+    try:
+        make_scratch_toolshelf(dirname)
+        # the first run builds the docked source index
+        time_resolve(dirname, 'project123')
+        times = sorted([
+            time_resolve(dirname, 'project123') for n in range(runs)
+        ])
+    finally:
+        shutil.rmtree(dirname)
+    median = times[len(times) // 2]
+    print("toolshelf resolve: median %.3fs, min %.3fs, max %.3fs "
+          "over %d runs (budget %.3fs)" %
+          (median, times[0], times[-1], runs, budget))
+    if median > budget:
+        print("OVER BUDGET")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])